@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import pandas as pd
+import scipy.io as sio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import synthetic
+from lemonade20k import ADEIndex as ind_class
+
+'''
+Setup time of ADEIndex from index_ade20k.mat: the row-by-row ingestion the
+index used to do (iterrows() and per-row .loc assignments) against the
+current vectorized ingestion, on a synthetic index of realistic shape
+
+  python benchmarks/bench_ingest.py [--images N] [--objects K] [--legacy-images N]
+
+The legacy ingestion grows its DataFrames one row at a time, so it is only
+run on the first --legacy-images images (and the first --legacy-images
+objects) and its time is reported next to the vectorized ingestion of the
+same slice.
+'''
+
+def _legacy_ingest(_matindex):
+  _filename_col_nested = pd.DataFrame(_matindex['filename'].T, columns=['filename'])
+  _filename_col = pd.DataFrame(columns=['filename'])
+  for index, row in _filename_col_nested.iterrows():
+    _filename_col.loc[index] = _filename_col_nested['filename'][index][0]
+
+  _folder_col_nested = pd.DataFrame(_matindex['folder'].T, columns=['folder'])
+  _folder_col = pd.DataFrame(columns=['folder'])
+  for index, row in _folder_col_nested.iterrows():
+    _folder_col.loc[index] = _folder_col_nested['folder'][index][0]
+
+  _typeset_col = pd.DataFrame(_matindex['typeset'], columns=['typeset'])
+  _scene_col = pd.DataFrame(_matindex['scene'].T, columns=['scene'])
+  image_index = pd.concat([_filename_col, _folder_col, _typeset_col, _scene_col], axis=1)
+
+  object_name_list_nested = pd.DataFrame(_matindex['objectnames'].T, columns=['objectnames'])
+  object_name_list = pd.DataFrame(columns=['objectnames'])
+  for index, row in object_name_list_nested.iterrows():
+    object_name_list.loc[index] = object_name_list_nested['objectnames'][index][0]
+
+  object_image_matrix = pd.DataFrame(_matindex['objectPresence'].T,
+                                     columns=object_name_list['objectnames'],
+                                     index=_filename_col['filename'])
+  return image_index, object_name_list, object_image_matrix
+
+def _vectorized_ingest(_matindex):
+  ade_index = ind_class.ADEIndex.__new__(ind_class.ADEIndex)
+  ade_index._from_matindex(_matindex)
+  return ade_index
+
+def _slice(_matindex, num_images, num_objects):
+  return {'filename': _matindex['filename'][:, :num_images],
+          'folder': _matindex['folder'][:, :num_images],
+          'typeset': _matindex['typeset'][:num_images],
+          'scene': _matindex['scene'][:, :num_images],
+          'objectnames': _matindex['objectnames'][:, :num_objects],
+          'objectPresence': _matindex['objectPresence'][:num_objects, :num_images]}
+
+def _timed(fn, *args):
+  start = time.perf_counter()
+  fn(*args)
+  return time.perf_counter() - start
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Time ADEIndex setup from a synthetic index_ade20k.mat')
+  parser.add_argument('--images', type=int, default=synthetic.NUM_IMAGES)
+  parser.add_argument('--objects', type=int, default=synthetic.NUM_OBJECTS)
+  parser.add_argument('--legacy-images', type=int, default=2000)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as root:
+    mat_path = synthetic.write_index_mat(root, num_images=args.images,
+                                         num_objects=args.objects)
+    start = time.perf_counter()
+    _matindex = sio.loadmat(mat_path)['index'][0, 0]
+    load_time = time.perf_counter() - start
+
+  full = _slice(_matindex, args.images, args.objects)
+  part = _slice(_matindex, args.legacy_images, args.legacy_images)
+
+  print('loadmat (' + str(args.images) + ' images x ' + str(args.objects)
+        + ' objects): %.3fs' % load_time)
+  print('vectorized ingestion, full index: %.3fs' % _timed(_vectorized_ingest, full))
+  print('legacy ingestion, first ' + str(args.legacy_images)
+        + ' images/objects: %.3fs' % _timed(_legacy_ingest, part))
+  print('vectorized ingestion, first ' + str(args.legacy_images)
+        + ' images/objects: %.3fs' % _timed(_vectorized_ingest, part))
+
+if __name__ == '__main__':
+  main()
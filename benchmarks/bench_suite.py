@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import synthetic
+
+'''
+Benchmarks of the hot paths of the package, on a synthetic dataset
+
+  python benchmarks/bench_suite.py [--images N] [--objects K]
+                                   [--files-for-images N] [--repeats R]
+                                   [--output results.json]
+                                   [--compare baseline.json]
+
+A synthetic ADE20K-shaped dataset (see synthetic.py) is written to a temporary
+directory, which the package is then pointed at. The suite times:
+
+  index_load_cold       ADEIndex() from index_ade20k.mat (no index cache)
+  index_load_warm       ADEIndex() from the binary index cache
+  query_single_group    get_filepaths() with one phrase group
+  query_multi_group     get_filepaths() with three phrase groups
+  query_memoized        the multi-group query, answered by the query cache
+  check_object_matches  synonym lookup of a phrase (check_object_matches())
+  knockout_cold         _knockout_segmap() writing whitelisted segmaps
+  knockout_warm         _knockout_segmap() on up-to-date segmaps (cache hits)
+  materialize_parallel  materialize_whitelist() on a process pool
+
+Results are written as JSON (to --output, or stdout): the run parameters and
+environment, then for every benchmark the per-repeat times in seconds, their
+min/median/mean, and items per second where a benchmark processes several
+items. --compare prints the change of every median against an earlier run.
+'''
+
+def _stats(times, items=None):
+  result = {'times': times,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times)}
+  if items is not None:
+    result['items'] = items
+    result['items_per_second'] = items / result['median'] if result['median'] else None
+  return result
+
+def _repeat(fn, repeats, setup=None):
+  times = []
+  for r in range(repeats):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return times
+
+def run_suite(root, repeats, knockout_images):
+  # The package finds the dataset at sys.path[0]
+  sys.path.insert(0, root)
+  from lemonade20k import ADEIndex as ind_class
+  from lemonade20k import funcs
+
+  cache_folder = os.path.join(root, 'indexCache')
+  results = {}
+
+  results['index_load_cold'] = _stats(_repeat(
+    ind_class.ADEIndex, repeats,
+    setup=lambda: shutil.rmtree(cache_folder, ignore_errors=True)))
+  results['index_load_warm'] = _stats(_repeat(ind_class.ADEIndex, repeats))
+
+  ade_index = funcs.get_index()
+  # the most common objects of the synthetic index are object0, object1, ...
+  single = [('object0', 1)]
+  multi = [('object0', 1), (['object1', 'object2'], 2), ('object3', 1)]
+
+  funcs.set_query_cache(max_entries=0)
+  results['query_single_group'] = _stats(_repeat(lambda: funcs.get_filepaths(single), repeats))
+  results['query_multi_group'] = _stats(_repeat(lambda: funcs.get_filepaths(multi), repeats))
+  funcs.set_query_cache()
+  funcs.get_filepaths(multi)
+  results['query_memoized'] = _stats(_repeat(lambda: funcs.get_filepaths(multi), repeats))
+
+  # one query per object, as in per-class subset selection
+  batch = [[('object' + str(i), 1), ('object' + str(i + 1), 2)] for i in range(200)]
+  funcs.set_query_cache(max_entries=0)
+  results['query_loop'] = _stats(_repeat(
+    lambda: [funcs.match_queries([phrases]) for phrases in batch], repeats), items=len(batch))
+  results['query_batch'] = _stats(_repeat(
+    lambda: funcs.match_queries(batch), repeats), items=len(batch))
+  funcs.set_query_cache()
+
+  results['check_object_matches'] = _stats(_repeat(
+    lambda: funcs.check_object_matches('object1'), repeats))
+
+  rows = [row for row, paths in
+          enumerate(ade_index.path_manifest.segmap_paths(range(ade_index.num_images_total)))
+          if paths][:knockout_images]
+  segmap_paths = [paths[0] for paths in ade_index.path_manifest.segmap_paths(rows)]
+  folder_paths = ade_index.image_index['folder'].iloc[rows].tolist()
+  whitelist = ('object0', 'object1', 'object2', 'object3', 'object4')
+  whitelist_root = os.path.join(root, funcs._whitelist_root(whitelist))
+
+  def knockout_all():
+    for segmap_path, folder_path in zip(segmap_paths, folder_paths):
+      funcs._knockout_segmap(segmap_path, folder_path, whitelist)
+
+  results['knockout_cold'] = _stats(_repeat(
+    knockout_all, repeats, setup=lambda: shutil.rmtree(whitelist_root, ignore_errors=True)),
+    items=len(rows))
+  results['knockout_warm'] = _stats(_repeat(knockout_all, repeats), items=len(rows))
+
+  def materialize_all():
+    funcs._materialize_whitelist(segmap_paths, folder_paths, whitelist, chunksize=8,
+                                 progress=None)
+
+  results['materialize_parallel'] = _stats(_repeat(
+    materialize_all, repeats, setup=lambda: shutil.rmtree(whitelist_root, ignore_errors=True)),
+    items=len(rows))
+  return results
+
+def _compare(results, baseline):
+  for name, result in results.items():
+    if name not in baseline:
+      continue
+    before, after = baseline[name]['median'], result['median']
+    change = (after - before) / before * 100 if before else float('nan')
+    print('%-22s %10.4fs -> %10.4fs  %+7.1f%%' % (name, before, after, change))
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Benchmark index load, queries and whitelist knockout on a synthetic dataset')
+  parser.add_argument('--images', type=int, default=synthetic.NUM_IMAGES)
+  parser.add_argument('--objects', type=int, default=synthetic.NUM_OBJECTS)
+  parser.add_argument('--files-for-images', type=int, default=200,
+                      help='number of images written to disk (with their segmaps)')
+  parser.add_argument('--repeats', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='write the JSON results to this file')
+  parser.add_argument('--compare', help='JSON results of an earlier run')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as root:
+    synthetic.write_dataset(root, files_for_images=args.files_for_images, seed=args.seed,
+                            num_images=args.images, num_objects=args.objects)
+    results = run_suite(root, args.repeats, args.files_for_images)
+
+  report = {'parameters': {'images': args.images,
+                           'objects': args.objects,
+                           'files_for_images': args.files_for_images,
+                           'repeats': args.repeats,
+                           'seed': args.seed},
+            'environment': {'python': platform.python_version(),
+                            'platform': platform.platform(),
+                            'cpus': os.cpu_count()},
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'results': results}
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=1)
+  else:
+    json.dump(report, sys.stdout, indent=1)
+    print()
+
+  if args.compare:
+    with open(args.compare) as f:
+      _compare(results, json.load(f)['results'])
+
+if __name__ == '__main__':
+  main()
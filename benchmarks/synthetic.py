@@ -0,0 +1,137 @@
+import numpy as np
+import scipy.io as sio
+import os
+
+'''
+Synthetic stand-ins for the ADE20K dataset, for benchmarks
+
+The defaults match the shape of ADE20K_2016_07_26/index_ade20k.mat: about
+22k images and 3k objects, each image containing a handful of distinct
+objects (so the presence matrix is ~99.5% zeros).
+'''
+
+NUM_IMAGES = 22210
+NUM_OBJECTS = 3148
+OBJECTS_PER_IMAGE = 15
+SCENES = ['abbey', 'airport_terminal', 'bathroom', 'bedroom', 'beach',
+          'kitchen', 'living_room', 'street', 'highway', 'office']
+
+'''
+Object names in the format of the dataset: lists of synonyms joined by ", "
+'''
+def object_names(num_objects, seed=0):
+  rng = np.random.default_rng(seed)
+  names = []
+  for i in range(num_objects):
+    num_synonyms = rng.integers(1, 4)
+    names.append(', '.join(['object' + str(i)]
+                           + ['synonym' + str(i) + '_' + str(j)
+                              for j in range(1, num_synonyms)]))
+  return names
+
+def _cellstr(strings):
+  cells = np.empty((1, len(strings)), dtype=object)
+  for i, string in enumerate(strings):
+    cells[0, i] = string
+  return cells
+
+'''
+Builds the fields of a synthetic MATLAB index.
+
+@return dict of field name -> array, in the layout loadmat() gives the real
+        index: 1 x N cell arrays of strings, N x 1 typeset, K x N presence
+'''
+def index_fields(num_images=NUM_IMAGES, num_objects=NUM_OBJECTS,
+                 objects_per_image=OBJECTS_PER_IMAGE, seed=0):
+  rng = np.random.default_rng(seed)
+
+  filenames, folders, scenes = [], [], []
+  for i in range(num_images):
+    scene = SCENES[i % len(SCENES)]
+    split = 'validation' if i % 10 == 0 else 'training'
+    prefix = 'ADE_val_' if split == 'validation' else 'ADE_train_'
+    filenames.append(prefix + '%08d' % (i + 1) + '.jpg')
+    folders.append('/'.join(['ADE20K_2016_07_26', 'images', split, scene[0], scene]))
+    scenes.append(scene)
+
+  # A few objects (walls, floors, ...) are in most images, the rest are rare
+  popularity = 1.0 / np.arange(1, num_objects + 1)
+  popularity /= popularity.sum()
+  presence = np.zeros((num_objects, num_images), dtype=np.uint8)
+  for i in range(num_images):
+    objects = rng.choice(num_objects, size=min(objects_per_image, num_objects),
+                         replace=False, p=popularity)
+    presence[objects, i] = rng.integers(1, 6, size=objects.size)
+
+  return {'filename': _cellstr(filenames),
+          'folder': _cellstr(folders),
+          'typeset': np.ones((num_images, 1)),
+          'scene': _cellstr(scenes),
+          'objectnames': _cellstr(object_names(num_objects, seed)),
+          'objectPresence': presence}
+
+'''
+Writes a synthetic index_ade20k.mat to
+root/ADE20K_2016_07_26/index_ade20k.mat and returns its path
+'''
+def write_index_mat(root, **kwargs):
+  return _write_fields(root, index_fields(**kwargs))
+
+def _write_fields(root, fields):
+  folder = os.path.join(root, 'ADE20K_2016_07_26')
+  os.makedirs(folder, exist_ok=True)
+  path = os.path.join(folder, 'index_ade20k.mat')
+  sio.savemat(path, {'index': fields}, do_compression=True)
+  return path
+
+'''
+Paints a segmap in the dataset encoding (R/10*256 + G = object code): every
+object present in the image gets a few rectangles, more for higher counts,
+over an "unknown" (code 0) background
+'''
+def _segmap(rng, columns, counts, size):
+  h, w = size
+  segmap = np.zeros((h, w, 3), dtype=np.uint8)
+  for col, count in zip(columns, counts):
+    code = col + 1
+    for instance in range(count):
+      top, left = rng.integers(h), rng.integers(w)
+      bottom = min(h, top + rng.integers(h // 8, h // 2 + 1))
+      right = min(w, left + rng.integers(w // 8, w // 2 + 1))
+      segmap[top:bottom, left:right, 0] = (code // 256) * 10
+      segmap[top:bottom, left:right, 1] = code % 256
+      segmap[top:bottom, left:right, 2] = instance + 1
+  return segmap
+
+'''
+Writes a synthetic dataset below root: the MATLAB index, and a .jpg image and
+*_seg.png segmap (consistent with the presence matrix) for the first
+files_for_images images of the index. The remaining images are only in the
+index, which keeps large indexes cheap to generate.
+
+@param size - (height, width) of the images and segmaps
+@param index_kwargs - passed to index_fields()
+
+@return path of the MATLAB index
+'''
+def write_dataset(root, files_for_images=500, size=(96, 128), seed=0, **index_kwargs):
+  # skimage is slow to import, and only needed to write images
+  from skimage.io import imsave
+
+  fields = index_fields(seed=seed, **index_kwargs)
+  path = _write_fields(root, fields)
+
+  rng = np.random.default_rng(seed)
+  presence = fields['objectPresence']
+  num_images = presence.shape[1]
+  for i in range(min(files_for_images, num_images)):
+    folder = os.path.join(root, fields['folder'][0, i])
+    os.makedirs(folder, exist_ok=True)
+    name = fields['filename'][0, i][:-len('.jpg')]
+
+    columns = np.flatnonzero(presence[:, i])
+    imsave(os.path.join(folder, name + '_seg.png'),
+           _segmap(rng, columns, presence[columns, i], size), check_contrast=False)
+    imsave(os.path.join(folder, name + '.jpg'),
+           rng.integers(0, 256, size=size + (3,), dtype=np.uint8), check_contrast=False)
+  return path
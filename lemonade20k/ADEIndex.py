@@ -1,136 +1,562 @@
 import scipy.io as sio
+import scipy.sparse as sp
 import numpy as np
 import pandas as pd
+import logging
 import sys
 import os
 import shutil
+from . import indexcache
+from . import manifest
+from . import incremental
+from . import metaindex
+
+_logger = logging.getLogger(__name__)
 
 class ADEIndex:  
 
-  def __init__(self, refreshCSVs=False):
+  def __init__(self, refreshCSVs=False, exportCSVs=False):
 
-    self.image_index = None
-    self.object_name_list = None
-    self.object_image_matrix = None
-    self._CSVsExist = False
-    self._csv_folderpath = os.path.join(sys.path[0], 'csvIndexes')
-    self.num_images_total = None
+    self._init_attributes()
+
+    _cached_arrays = None
+    if not refreshCSVs:
+      _cached_arrays = indexcache.load(self._cache_folderpath, self._mat_filename)
+
+    if _cached_arrays is not None:
+
+      _logger.info("Now loading data from the binary index cache")
+      self._from_arrays(_cached_arrays)
+      # segments and build id from one read of the manifest, see add_folders()
+      cache_manifest = indexcache.read_manifest(self._cache_folderpath) or {}
+      self._append_segments(indexcache.load_segments(self._cache_folderpath,
+                                                     manifest=cache_manifest))
+      self.build_id = cache_manifest.get('build_id')
+      self._load_path_manifest()
+      self._load_object_areas()
+
+      if exportCSVs:
+        self._export_CSVs()
+      return
 
-    if os.path.exists(self._csv_folderpath)\
+    if not os.path.exists(self._mat_filename)\
+      and os.path.exists(self._csv_folderpath)\
       and os.path.exists(os.path.join(self._csv_folderpath, 'image_index.csv'))\
       and os.path.exists(os.path.join(self._csv_folderpath, 'object_name_list.csv'))\
       and os.path.exists(os.path.join(self._csv_folderpath,'object_image_matrix.csv')):
 
-      print("Now loading data from CSV files")
+      # Legacy CSV indexes are only read when the MATLAB index they were built
+      # from is gone; otherwise rebuilding the binary cache is much cheaper
+      _logger.info("Now loading data from CSV files")
       self.image_index = pd.read_csv(os.path.join(self._csv_folderpath, 'image_index.csv'))
-      self.object_name_list = pd.read_csv(os.path.join(self._csv_folderpath, 'object_name_list.csv'))
-      self.object_image_matrix = pd.read_csv(os.path.join(self._csv_folderpath, 'object_image_matrix.csv'))
+      self.object_name_list = pd.read_csv(os.path.join(self._csv_folderpath, 'object_name_list.csv'), index_col=0)
+      _dense_matrix = pd.read_csv(os.path.join(self._csv_folderpath, 'object_image_matrix.csv'), index_col=0)
+      self._set_presence(sp.csc_matrix(_dense_matrix.to_numpy()))
+      self._index_metadata()
       self._CSVsExist = True
 
       self.num_images_total = self.image_index.shape[0]
 
     else:
 
-      _mat_filename = os.path.join(sys.path[0], 'ADE20K_2016_07_26', 'index_ade20k.mat')
-
       try:
-        _mat_contents = sio.loadmat(_mat_filename)
+        _mat_contents = sio.loadmat(self._mat_filename)
       except FileNotFoundError:
-        print("index_ade20k.mat was not found, likely due to a problem during package setup.")
-        print('You can resolve this error by manually placing index_ade20k.mat'
+        _logger.error("index_ade20k.mat was not found, likely due to a problem during package setup."
+         + ' You can resolve this error by manually placing index_ade20k.mat'
          + ' (available from https://groups.csail.mit.edu/vision/datasets/ADE20K/)'
          + ' into ./ADE20K_2016_07_26/')
         return
         # exit()
 
-      print("No CSVs found - will save CSVs after loading MATLAB data")
-
-      _matindex = _mat_contents['index'][0,0]
+      _logger.info("No index cache found - will save one after loading MATLAB data")
 
-      # When read with scipy, the MATLAB index does NOT have a consistent row 
-      # or column structure.
-      # The columns are transposed occasionally because otherwise they don't fit
-      # together - they're imported from MATLAB with a bunch of inconsistent 
-      # dimensions.
-      self.num_images_total = _matindex[_matindex.dtype.names[1]].size
+      self._from_matindex(_mat_contents['index'][0,0])
 
-      # putting image attributes in a DataFrame
+    self._set_synonyms(*_build_synonym_index(self.object_name_list['objectnames']))
 
-      _filename_col_nested = pd.DataFrame(_matindex['filename'].T, columns=['filename'])
-      
-      _filename_col = pd.DataFrame(columns=['filename'])
+    _logger.info("Now saving the binary index cache")
+    self.save_cache()
+    _logger.info("Your index cache is now toasty and warm")
 
-      for index, row in _filename_col_nested.iterrows():
-        _filename_col.loc[index] = _filename_col_nested['filename'][index][0]
+    self._load_path_manifest(rebuild=True)
 
-      _folder_col_nested = pd.DataFrame(_matindex['folder'].T, columns=['folder'])
+    if refreshCSVs or exportCSVs:
+      self._export_CSVs()
 
-      _folder_col = pd.DataFrame(columns=['folder'])
-      for index, row in _folder_col_nested.iterrows():
-        _folder_col.loc[index] = _folder_col_nested['folder'][index][0]
+  '''
+  Builds an index from arrays in the layout of _to_arrays() (e.g. attached
+  from shared memory, see sharing.py) without reading or writing any file
+  '''
+  @classmethod
+  def from_arrays(cls, arrays, path_manifest=None, build_id=None):
+    ade_index = cls.__new__(cls)
+    ade_index._init_attributes()
+    ade_index._from_arrays(arrays)
+    ade_index.path_manifest = path_manifest
+    ade_index.build_id = build_id
+    return ade_index
 
+  def _init_attributes(self):
+    # metadata columns and object names as loaded from the index cache (or
+    # shared memory); the DataFrames are only built from them on first use
+    self._metadata_arrays = None
+    self._objectname_array = None
+    self.image_index = None
+    self.object_name_list = None
+    # images x objects instance counts, CSC for per-object (column) queries
+    # and a CSR mirror for per-image (row) lookups
+    self.object_presence = None
+    self.object_presence_csr = None
+    self._object_image_matrix = None
+    # sorted synonym tokens, and offsets into the object columns they name
+    self._synonym_arrays = None
+    # rows of every folder and scene, see metaindex.py
+    self.folder_index = None
+    self.scene_index = None
+    # paths of the segmap files of every image, see manifest.py
+    self.path_manifest = None
+    # images x objects pixel areas and pixels per image, see pixelstats.py
+    # (None until they are measured)
+    self.object_areas = None
+    self.pixel_totals = None
+    # changes whenever the areas are measured again (see querycache.py)
+    self.areas_id = None
+    self._CSVsExist = False
+    self._csv_folderpath = os.path.join(sys.path[0], 'csvIndexes')
+    self._cache_folderpath = os.path.join(sys.path[0], 'indexCache')
+    self._mat_filename = os.path.join(sys.path[0], 'ADE20K_2016_07_26', 'index_ade20k.mat')
+    self.num_images_total = None
+    # changes whenever the cache is rebuilt (see indexcache.py)
+    self.build_id = None
+
+  '''
+  Image attributes: filename, folder, typeset and scene of every image (rows
+  line up with the rows of the presence matrix)
+
+  Built on first access when the index was loaded from arrays, so processes
+  that only query the index create no Python object per row.
+  '''
+  @property
+  def image_index(self):
+    if self._image_index is None and self._metadata_arrays is not None:
+      arrays = self._metadata_arrays
+      self._image_index = pd.DataFrame({
+        'filename': arrays['filename'].astype(object),
+        'folder': pd.Categorical.from_codes(arrays['folder_codes'],
+                                            arrays['folder_categories'].astype(object)),
+        'typeset': arrays['typeset'],
+        'scene': pd.Categorical.from_codes(arrays['scene_codes'],
+                                           arrays['scene_categories'].astype(object))})
+    return self._image_index
+
+  @image_index.setter
+  def image_index(self, image_index):
+    self._image_index = image_index
+    self._metadata_arrays = None
+
+  @property
+  def object_name_list(self):
+    if self._object_name_list is None and self._objectname_array is not None:
+      self._object_name_list = pd.DataFrame(
+        {'objectnames': self._objectname_array.astype(object)})
+    return self._object_name_list
+
+  @object_name_list.setter
+  def object_name_list(self, object_name_list):
+    self._object_name_list = object_name_list
+    self._objectname_array = None
+
+  '''
+  @param name - a column of image_index ('filename', 'typeset', ...)
+
+  @return NumPy array of the column, read from the arrays the index was
+          loaded from while image_index has not been built
+  '''
+  def column_values(self, name):
+    if self._metadata_arrays is not None and name in self._metadata_arrays:
+      return self._metadata_arrays[name]
+    return self.image_index[name].to_numpy()
+
+  '''
+  @return NumPy array of the object names, one per column of the presence
+          matrix
+  '''
+  def object_names(self):
+    if self._objectname_array is not None:
+      return self._objectname_array
+    return self.object_name_list['objectnames'].to_numpy()
+
+  '''
+  Builds the index from the MATLAB struct loaded from index_ade20k.mat
+
+  Every table is built in one shot from whole columns: the MATLAB cell arrays
+  are unpacked with NumPy, not row by row.
+  '''
+  def _from_matindex(self, _matindex):
+    # When read with scipy, the MATLAB index does NOT have a consistent row 
+    # or column structure.
+    # The columns are transposed occasionally because otherwise they don't fit
+    # together - they're imported from MATLAB with a bunch of inconsistent 
+    # dimensions.
+
+    # putting image attributes in a DataFrame (rows of the image index line up
+    # with the rows of the presence matrix by position)
+    self.image_index = pd.DataFrame({
+      'filename': _unpack_cellstr(_matindex['filename']),
+      'folder': _unpack_cellstr(_matindex['folder']),
       # I don't know what this column is for (it's not documented on the dataset site)
-      _typeset_col = pd.DataFrame(_matindex['typeset'], columns=['typeset'])
-
+      'typeset': np.ravel(_matindex['typeset']),
       # scene type of each image
-      _scene_col = pd.DataFrame(_matindex['scene'].T, columns=['scene'])
-
-      # putting the columns together
-      _int_indexed_image_index = pd.concat([_filename_col, _folder_col, _typeset_col, _scene_col], axis=1)
-
-      self.image_index = _int_indexed_image_index.set_index('filename')
-      # Need filename col to be the index AND a query-able column
-      # (because conversion to csv makes the index just an int)
-      # self.image_index = pd.concat([self.image_index, filename_col], axis=1)
-
-      # print(image_index.index)
-      # print(image_index)
-      # print(image_index['ADE_train_00011093.jpg'])
-
-      # image_index.to_csv("csvIndexes/image_index.csv")
-
-      # print(image_index['ADE_train_00011093.jpg'])
-
-      # -------
-
-      # Putting object attributes in a DataFrame
-
-      object_name_list_nested = pd.DataFrame(_matindex['objectnames'].T, columns=['objectnames'])
-
-      self.object_name_list = pd.DataFrame(columns=['objectnames'])
-      for index, row in object_name_list_nested.iterrows():
-        self.object_name_list.loc[index] = object_name_list_nested['objectnames'][index][0]
-
-      # ----
-
-      # Extracting object frequency matrix (gives number of times each object
-      # in the list of objects occurs in each image)
-      # We could have gotten this ourselves from the text files in each 
-      # image-segmap directory if we wanted, but the parsing format is not fun,
-      # so I decided to stick with converting the MATLAB code
-
-      # image filenames are rows, and words (object names) are columns
-
-      self.object_image_matrix = pd.DataFrame(_matindex['objectPresence'].T, 
-                                        columns=self.object_name_list['objectnames'],
-                                        index=_filename_col['filename'])
-
-      # object_cols_that_match = object_image_matrix.loc[:,[x for x in object_image_matrix.columns if 'vcr' in x]]
-      # for (colName, colData) in object_cols_that_match.iteritems():
-      #   image_rows_to_add = object_image_matrix.loc[object_image_matrix[colName] != 0]
-      #   print(image_rows_to_add)
-
-    if refreshCSVs or (not self._CSVsExist):
-      if os.path.exists(self._csv_folderpath):
-        shutil.rmtree(self._csv_folderpath)
-      os.mkdir(self._csv_folderpath)
-      print("Now saving CSV files")
-      self.save_all_CSVs()
-      print("Your CSV files are now toasty and warm")
-
-  # Function to produce all 3 CSV files
+      'scene': _unpack_cellstr(_matindex['scene']),
+    })
+
+    # Putting object attributes in a DataFrame
+    self.object_name_list = pd.DataFrame({
+      'objectnames': _unpack_cellstr(_matindex['objectnames'])})
+
+    # Extracting object frequency matrix (gives number of times each object
+    # in the list of objects occurs in each image)
+    # We could have gotten this ourselves from the text files in each 
+    # image-segmap directory if we wanted, but the parsing format is not fun,
+    # so I decided to stick with converting the MATLAB code
+
+    # image filenames are rows, and words (object names) are columns
+    # Almost every entry is zero, so the matrix is kept sparse
+    self._set_presence(sp.csc_matrix(_matindex['objectPresence'].T))
+    self._index_metadata()
+
+    self.num_images_total = self.image_index.shape[0]
+
+  '''
+  Stores the folder and scene columns as categoricals (one small integer code
+  per row) and indexes their rows, see metaindex.py
+  '''
+  def _index_metadata(self):
+    for name in _CATEGORICAL_COLUMNS:
+      if not isinstance(self.image_index[name].dtype, pd.CategoricalDtype):
+        self.image_index[name] = self.image_index[name].astype('category')
+    self.folder_index = metaindex.CategoryIndex(self.image_index['folder'])
+    self.scene_index = metaindex.CategoryIndex(self.image_index['scene'])
+
+  '''
+  Arrays written to (and read back from) the binary index cache, see
+  indexcache.py. Strings are stored as fixed-width unicode arrays so that they
+  can be memory-mapped like the numeric arrays. Categorical columns are stored
+  as their codes and categories.
+  '''
+  def _to_arrays(self):
+    csc = self.object_presence
+    csr = self.object_presence_csr
+    if self._metadata_arrays is not None:
+      arrays = dict(self._metadata_arrays)
+    else:
+      folder = self.image_index['folder'].cat
+      scene = self.image_index['scene'].cat
+      arrays = {
+        'filename': _as_str_array(self.image_index['filename']),
+        'folder_codes': folder.codes.to_numpy(),
+        'folder_categories': _as_str_array(folder.categories.to_series()),
+        'typeset': self.image_index['typeset'].to_numpy(),
+        'scene_codes': scene.codes.to_numpy(),
+        'scene_categories': _as_str_array(scene.categories.to_series())}
+    if self._objectname_array is not None:
+      arrays['objectnames'] = self._objectname_array
+    else:
+      arrays['objectnames'] = _as_str_array(self.object_name_list['objectnames'])
+    arrays.update({
+      'presence_shape': np.array(csc.shape, dtype=np.int64),
+      'presence_data': csc.data,
+      'presence_indices': csc.indices,
+      'presence_indptr': csc.indptr,
+      'presence_csr_data': csr.data,
+      'presence_csr_indices': csr.indices,
+      'presence_csr_indptr': csr.indptr,
+      'synonym_tokens': self._synonym_arrays[0],
+      'synonym_indptr': self._synonym_arrays[1],
+      'synonym_columns': self._synonym_arrays[2]})
+    return arrays
+
+  '''
+  Inverse of _to_arrays(). The arrays are used as they are (views of the
+  memory-mapped cache or of shared memory): the DataFrames, and the rows of
+  each folder and scene, are only built once they are used.
+  '''
+  def _from_arrays(self, arrays):
+    self.image_index = None
+    self.object_name_list = None
+    self._metadata_arrays = {name: arrays[name] for name in _METADATA_ARRAYS}
+    self._objectname_array = arrays['objectnames']
+    # copy=False keeps the memory-mapped sparse components zero-copy
+    shape = tuple(int(n) for n in arrays['presence_shape'])
+    self.object_presence = sp.csc_matrix((arrays['presence_data'],
+                                          arrays['presence_indices'],
+                                          arrays['presence_indptr']),
+                                         shape=shape, copy=False)
+    self.object_presence_csr = sp.csr_matrix((arrays['presence_csr_data'],
+                                              arrays['presence_csr_indices'],
+                                              arrays['presence_csr_indptr']),
+                                             shape=shape, copy=False)
+    self._object_image_matrix = None
+    self._set_synonyms(arrays['synonym_tokens'], arrays['synonym_indptr'],
+                       arrays['synonym_columns'])
+    self.folder_index = metaindex.CategoryIndex.from_codes(arrays['folder_codes'],
+                                                           arrays['folder_categories'])
+    self.scene_index = metaindex.CategoryIndex.from_codes(arrays['scene_codes'],
+                                                          arrays['scene_categories'])
+    self.num_images_total = arrays['filename'].shape[0]
+
+  '''
+  Appends the rows (and new object columns) of segments built by
+  incremental.build_segment(), in order
+  '''
+  def _append_segments(self, segments):
+    if not segments:
+      return
+
+    frames = [self.image_index]
+    names = self.object_names().tolist()
+    num_names = len(names)
+    rows, cols, counts = [], [], []
+    num_rows = self.num_images_total
+    for segment in segments:
+      frames.append(pd.DataFrame({'filename': segment['filename'].astype(object),
+                                  'folder': segment['folder'].astype(object),
+                                  'typeset': segment['typeset'],
+                                  'scene': segment['scene'].astype(object)}))
+      names += segment['objectnames'].tolist()
+      rows.append(segment['presence_rows'] + num_rows)
+      cols.append(segment['presence_columns'])
+      counts.append(segment['presence_counts'])
+      num_rows += segment['filename'].size
+
+    old = self.object_presence
+    # existing rows get zeros in the new columns, new rows follow them
+    widened = sp.hstack([old, sp.csc_matrix((old.shape[0], len(names) - old.shape[1]),
+                                            dtype=old.dtype)])
+    appended = sp.coo_matrix((np.concatenate(counts),
+                              (np.concatenate(rows) - old.shape[0], np.concatenate(cols))),
+                             shape=(num_rows - old.shape[0], len(names)))
+
+    # categoricals with different categories concatenate to plain columns,
+    # which _index_metadata() turns back into categoricals
+    self.image_index = pd.concat([frame.astype({'folder': object, 'scene': object})
+                                  for frame in frames], ignore_index=True)
+    self._index_metadata()
+    self.object_name_list = pd.DataFrame({'objectnames': np.array(names, dtype=object)})
+    self._set_presence(sp.vstack([widened, appended]))
+    if len(names) > num_names:
+      self._set_synonyms(*_build_synonym_index(names))
+    self.num_images_total = num_rows
+
+  '''
+  Adds the annotated images (those with an *_atr.txt file) of folders that are
+  not in the index yet, without rewriting the index cache: their rows are
+  saved as a new segment of it (see incremental.py). Object names that are
+  not in the index yet become new columns.
+
+  Rebuilding the index from index_ade20k.mat drops the added rows; call this
+  again afterwards to add them back.
+
+  If the cache changed since this index was loaded (another process added
+  rows), the index is loaded again from the cache before the folders are
+  scanned; if the cache is missing or unreadable, it is rebuilt first.
+
+  @param folders - folders relative to the dataset root, as in the folder
+                   column of image_index, or None to look through every image
+                   folder below ADE20K_2016_07_26/images
+
+  @return number of images added
+  '''
+  def add_folders(self, folders=None):
+    root = sys.path[0]
+    if folders is None:
+      folders = incremental.find_image_folders(
+        root, os.path.join(os.path.dirname(self._mat_filename), 'images'))
+    else:
+      folders = [os.path.relpath(os.path.join(root, folder), root).replace(os.sep, '/')
+                 for folder in folders]
+
+    # the manifest is locked from the check to the append, so no other
+    # process adds rows in between
+    with indexcache.manifest_lock(self._cache_folderpath):
+      if not indexcache.is_current(self._cache_folderpath, self.build_id):
+        _logger.info('The index cache changed since it was loaded, loading it again')
+        self.__init__()
+
+      known = set(zip(self.image_index['folder'], self.image_index['filename']))
+      images = incremental.scan_folders(root, folders, known)
+      if not images:
+        return 0
+
+      segment = incremental.build_segment(images, self.object_names().tolist())
+      self.build_id = indexcache.append_segment(self._cache_folderpath, segment)
+    self._append_segments([segment])
+    self._load_path_manifest()
+    # areas were measured for the previous rows, see pixelstats.py
+    self.object_areas = None
+    self.pixel_totals = None
+    self.areas_id = None
+    _logger.info('Added %d images to the index', len(images))
+    return len(images)
+
+  def _set_presence(self, presence):
+    presence = sp.csc_matrix(presence)
+    presence.eliminate_zeros()
+    max_count = int(presence.data.max(initial=0))
+    presence = presence.astype(np.min_scalar_type(max_count))
+    presence.sort_indices()
+    self.object_presence = presence
+    self.object_presence_csr = presence.tocsr()
+    self._object_image_matrix = None
+
+  '''
+  The synonym index is stored as three flat arrays: the distinct tokens,
+  sorted, and CSR-style offsets into the object columns each token names.
+  Tokens are looked up by binary search, so no dict is built per process.
+  '''
+  def _set_synonyms(self, tokens, indptr, columns):
+    self._synonym_arrays = (tokens, indptr, columns)
+
+  '''
+  @param phrase - a single object name (one synonym, no commas)
+
+  @return array of the object columns whose list of synonyms contains phrase
+  '''
+  def columns_matching(self, phrase):
+    tokens, indptr, columns = self._synonym_arrays
+    i = int(np.searchsorted(tokens, phrase))
+    if i < tokens.size and tokens[i] == phrase:
+      return columns[indptr[i]:indptr[i + 1]]
+    return _NO_COLUMNS
+
+  '''
+  Pandas view of the presence matrix (images are rows, object names are
+  columns), built on first access. The DataFrame is backed by sparse columns,
+  so it is still much smaller than the dense table the CSVs used to hold.
+  '''
+  @property
+  def object_image_matrix(self):
+    if self._object_image_matrix is None and self.object_presence is not None:
+      self._object_image_matrix = pd.DataFrame.sparse.from_spmatrix(
+        self.object_presence, columns=self.object_name_list['objectnames'])
+    return self._object_image_matrix
+
+  '''
+  @param row - integer row of the image in image_index
+
+  @return 2-tuple: (object columns present in the image, instance counts)
+  '''
+  def objects_in_image(self, row):
+    start, end = self.object_presence_csr.indptr[row:row + 2]
+    return (self.object_presence_csr.indices[start:end],
+            self.object_presence_csr.data[start:end])
+
+  '''
+  Loads the segmap manifest saved with the index cache (listing again the
+  folders that changed since), or builds it with one listing per folder
+  '''
+  def _load_path_manifest(self, rebuild=False):
+    manifest_path = os.path.join(self._cache_folderpath, manifest.MANIFEST_FILENAME)
+    filenames = self.column_values('filename')
+    folders = self.folder_index
+
+    if not rebuild:
+      self.path_manifest = manifest.PathManifest.load(manifest_path, sys.path[0],
+                                                      filenames, folders)
+    if rebuild or self.path_manifest is None:
+      _logger.info("Now listing the segmap files of the dataset")
+      self.path_manifest = manifest.PathManifest.build(sys.path[0], filenames, folders)
+      self.path_manifest.save(manifest_path)
+    elif self.path_manifest.refresh():
+      self.path_manifest.save(manifest_path)
+
+  def _load_object_areas(self):
+    from . import pixelstats
+    loaded = pixelstats.load(os.path.join(self._cache_folderpath, pixelstats.AREAS_FILENAME),
+                             self.build_id)
+    if loaded is not None:
+      self.object_areas, self.pixel_totals, self.areas_id = loaded
+
+  '''
+  Sets the object areas measured by pixelstats.build() and saves them with
+  the index cache
+  '''
+  def set_object_areas(self, areas, pixels):
+    self.object_areas = areas
+    self.pixel_totals = pixels
+    from . import pixelstats
+    self.areas_id = pixelstats.save(os.path.join(self._cache_folderpath,
+                                                 pixelstats.AREAS_FILENAME),
+                                    areas, pixels, self.build_id)
+
+  def save_cache(self):
+    self.build_id = indexcache.save(self._cache_folderpath, self._to_arrays(),
+                                    self._mat_filename)
+
+  def _export_CSVs(self):
+    if os.path.exists(self._csv_folderpath):
+      shutil.rmtree(self._csv_folderpath)
+    os.mkdir(self._csv_folderpath)
+    _logger.info("Now saving CSV files")
+    self.save_all_CSVs()
+    _logger.info("Your CSV files are now toasty and warm")
+
+  # Function to produce all 3 CSV files (opt-in, the index itself is loaded
+  # from the binary cache)
   # THE LAST ONE IS KINDA BIG (for a CSV) - around 300 MB
   def save_all_CSVs(self):
-    self.image_index.to_csv(os.path.join(self._csv_folderpath,"image_index.csv"))
+    self.image_index.to_csv(os.path.join(self._csv_folderpath,"image_index.csv"), index=False)
     self.object_name_list.to_csv(os.path.join(self._csv_folderpath, 'object_name_list.csv'))
-    self.object_image_matrix.to_csv(os.path.join(self._csv_folderpath,"object_image_matrix.csv"))
\ No newline at end of file
+    self.object_image_matrix.to_csv(os.path.join(self._csv_folderpath,"object_image_matrix.csv"))
+
+_CATEGORICAL_COLUMNS = ('folder', 'scene')
+
+# arrays of _to_arrays() that image_index is built from
+_METADATA_ARRAYS = ('filename', 'folder_codes', 'folder_categories', 'typeset',
+                    'scene_codes', 'scene_categories')
+
+_NO_COLUMNS = np.array([], dtype=np.int32)
+_NO_COLUMNS.setflags(write=False)
+
+'''
+Splits every object name into its synonyms and groups object columns by
+synonym. Tokens are sorted, and columns are listed in increasing order for
+every token.
+
+@return 3-tuple of arrays: (tokens, offsets into columns, columns)
+'''
+def _build_synonym_index(object_names):
+  token_cols = {}
+  for col, name in enumerate(object_names):
+    for token in dict.fromkeys(name.split(", ")):
+      token_cols.setdefault(token, []).append(col)
+  # sorted for the binary search of columns_matching()
+  token_cols = dict(sorted(token_cols.items()))
+
+  tokens = np.array(list(token_cols), dtype=str)
+  lengths = [len(cols) for cols in token_cols.values()]
+  indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+  columns = np.array([col for cols in token_cols.values() for col in cols],
+                     dtype=np.int32)
+  return tokens, indptr, columns
+
+'''
+Converts a column of strings to a fixed-width unicode array
+'''
+def _as_str_array(column):
+  return np.asarray(column.fillna(''), dtype=str)
+
+'''
+Unpacks a MATLAB cell array of strings, which scipy loads as an object array
+of 1-element string arrays (0-element for empty strings), into an object
+array of Python strings
+'''
+def _unpack_cellstr(cells):
+  cells = cells.ravel()
+  values = np.concatenate(cells) if cells.size else np.array([], dtype=str)
+  if values.size != cells.size:
+    # some cells are empty, so concatenating them would misalign the rows
+    values = np.array([cell.flat[0] if cell.size else '' for cell in cells],
+                      dtype=str)
+  return values.astype(object)
@@ -1,33 +1,246 @@
-from skimage.io import imread
+from collections import OrderedDict, deque
+import io
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from . import batchio
 
 # Corresponding image-segmap-filename entries have the same index in all 3 lists
+#
+# Images and segmaps are only decoded when they are accessed: subset[i],
+# subset.imgs[i] and subset.segmaps[i] decode on demand, the most recently
+# decoded entries are kept in a bounded LRU, and iterating over the subset can
+# decode the next few entries ahead of time on a thread pool. Subsets far larger
+# than RAM can be streamed this way.
+#
+# With a label_store (see labelstore.py), segmaps found in the store are read
+# from it as uint16 object codes instead of being decoded from their PNG.
+#
+# With a fetcher (storage.AsyncFetcher), files are read through its storage
+# backend (e.g. an HTTP server) instead of the local filesystem, and the files
+# of several entries are pulled in parallel: iterating fetches prefetch
+# entries at a time (the fetcher's concurrency when prefetch is 0), the next
+# ones while the current ones are decoded, and fetch() loads any batch of
+# entries at once.
 class ADESubset:
-    def __init__(self, images, image_paths, segmaps, segmap_paths, folder_paths,
-     whitelisted_folder_paths=None):
-      
-      self.imgs = images
+    def __init__(self, image_paths, segmap_paths, folder_paths,
+     whitelisted_folder_paths=None, cache_size=64, prefetch=0, max_workers=None,
+     label_store=None, fetcher=None):
+
       self.img_paths = image_paths
-      self.segmaps = segmaps
       self.segmap_paths = segmap_paths
       self.folder_paths = folder_paths
       self.whitelisted_folder_paths = whitelisted_folder_paths
 
-    '''  
-    This method is NOT used in get_images() because image caching is handled
-    better by skimage.io.imread_collection() than by repeated calls to
-    skimage.io.imread()
+      # number of decoded (image, segmap) entries kept in memory
+      self.cache_size = cache_size
+      # number of entries decoded ahead of the one being consumed when
+      # iterating (0 decodes in the calling thread, one at a time)
+      self.prefetch = prefetch
+      self.max_workers = max_workers
+      self.label_store = label_store
+      self.fetcher = fetcher
+
+      self._cache = OrderedDict()
+      self._cache_lock = threading.Lock()
+
+      self.imgs = _LazyColumn(self, 0)
+      self.segmaps = _LazyColumn(self, 1)
+
+    def __len__(self):
+      return len(self.img_paths)
+
+    '''
+    @return 2-tuple: (image, segmap) for the ith image. The segmap is a single
+            array, or a list of arrays (primary segmap first, then the _parts_*
+            maps) for entries with several segmap files.
+
+    Slicing returns a new lazy ADESubset over the selected entries.
+    '''
+    def __getitem__(self, i):
+      if isinstance(i, slice):
+        return ADESubset(self.img_paths[i], self.segmap_paths[i], self.folder_paths[i],
+                         None if self.whitelisted_folder_paths is None
+                         else self.whitelisted_folder_paths[i],
+                         self.cache_size, self.prefetch, self.max_workers,
+                         self.label_store, self.fetcher)
+
+      if i < 0:
+        i += len(self)
+      if not 0 <= i < len(self):
+        raise IndexError('ADESubset index out of range')
+
+      with self._cache_lock:
+        if i in self._cache:
+          self._cache.move_to_end(i)
+          return self._cache[i]
+
+      blobs = None if self.fetcher is None else self._fetch_blobs([i])
+      return self._remember(i, self._decode(i, blobs))
+
+    def _remember(self, i, entry):
+      with self._cache_lock:
+        self._cache[i] = entry
+        self._cache.move_to_end(i)
+        while len(self._cache) > self.cache_size:
+          self._cache.popitem(last=False)
+      return entry
 
-    This method is NOT intended for constructing a large number of ADEImage
-    objects, since doing so requires importing a large number of images, and
-    images can take up a lot of memory
-    --> Use get_images() (from funcs.py) to import a large number of images
+    '''
+    Loads entries, pulling the files of all of them in parallel through the
+    fetcher (entries already in memory are not fetched again)
+
+    @return list of (image, segmap) entries, in the order of indices
+    '''
+    def fetch(self, indices):
+      indices = [i + len(self) if i < 0 else i for i in indices]
+      with self._cache_lock:
+        missing = [i for i in dict.fromkeys(indices) if i not in self._cache]
+      if missing:
+        blobs = None if self.fetcher is None else self._fetch_blobs(missing)
+        for i in missing:
+          self._remember(i, self._decode(i, blobs))
+      return [self[i] for i in indices]
+
+    def _fetch_blobs(self, indices):
+      paths = []
+      for i in indices:
+        paths.append(self.img_paths[i])
+        segmap_paths = self.segmap_paths[i]
+        for path in [segmap_paths] if isinstance(segmap_paths, str) else segmap_paths:
+          if self.label_store is None or path not in self.label_store:
+            paths.append(path)
+      paths = list(dict.fromkeys(paths))
+      return dict(zip(paths, self.fetcher.fetch_all(paths)))
+
+    def __iter__(self):
+      if self.fetcher is not None:
+        yield from self._iter_fetched()
+        return
+
+      if self.prefetch <= 0:
+        for i in range(len(self)):
+          yield self[i]
+        return
+
+      executor = ThreadPoolExecutor(max_workers=self.max_workers or self.prefetch)
+      try:
+        pending = deque()
+        next_i = 0
+        while next_i < len(self) and len(pending) < self.prefetch:
+          pending.append(executor.submit(self.__getitem__, next_i))
+          next_i += 1
+
+        while pending:
+          entry = pending.popleft().result()
+          if next_i < len(self):
+            pending.append(executor.submit(self.__getitem__, next_i))
+            next_i += 1
+          yield entry
+      finally:
+        executor.shutdown(wait=True)
+
+    # Iterates in windows of entries: the files of the next window are
+    # fetched (all at once) while the entries of the current one are decoded
+    def _iter_fetched(self):
+      window = max(1, min(self.prefetch or self.fetcher.concurrency, self.cache_size))
+      windows = [range(start, min(start + window, len(self)))
+                 for start in range(0, len(self), window)]
+
+      def fetch_window(indices):
+        with self._cache_lock:
+          missing = [i for i in indices if i not in self._cache]
+        return missing, self._fetch_blobs(missing) if missing else {}
+
+      executor = ThreadPoolExecutor(max_workers=1)
+      try:
+        pending = executor.submit(fetch_window, windows[0]) if windows else None
+        for k in range(len(windows)):
+          missing, blobs = pending.result()
+          if k + 1 < len(windows):
+            pending = executor.submit(fetch_window, windows[k + 1])
+          missing = set(missing)
+          for i in windows[k]:
+            if i in missing:
+              yield self._remember(i, self._decode(i, blobs))
+            else:
+              yield self[i]
+      finally:
+        executor.shutdown(wait=True)
+
+    '''
+    @param blobs - dict of path -> file contents fetched ahead, or None to
+                   read the files from the local filesystem
+    '''
+    def _decode(self, i, blobs=None):
+      if blobs is None:
+        imread = batchio.imread
+      else:
+        imread = lambda path: batchio.imread(io.BytesIO(blobs[path]))
+
+      image = imread(self.img_paths[i])
+
+      paths = self.segmap_paths[i]
+      if isinstance(paths, str):
+        segmap = self._read_segmap(paths, imread)
+      elif len(paths) == 1:
+        segmap = self._read_segmap(paths[0], imread)
+      else:
+        segmap = [self._read_segmap(path, imread) for path in paths]
+
+      return image, segmap
+
+    def _read_segmap(self, path, imread):
+      if self.label_store is not None and path in self.label_store:
+        return self.label_store.get(path)
+      return imread(path)
+
+    '''
+    Subset of the images with the given filenames, in that order (e.g.
+    ADESubset.from_filename(['ADE_train_00000001.jpg']))
+
+    The filenames are looked up in the index one by one: to select images by
+    the objects they show, use get_images() (from funcs.py) instead
+
+    @param filenames - image filename, or list of image filenames
+    @param withParts - also list each image's parts segmaps
+    @param kwargs - passed to ADESubset() (cache_size, prefetch, ...)
+
+    @raise ValueError if a filename is not in the index
     '''
     @classmethod
-    def from_filename(cls, filenames):
-      # TODO: query, import, construct ADEImage
+    def from_filename(cls, filenames, withParts=False, **kwargs):
+      # funcs imports this module, so it is only imported here
+      from . import funcs
+
+      if isinstance(filenames, str):
+        filenames = [filenames]
+      ade_index = funcs.get_index()
+      row_of = {name: row for row, name
+                in enumerate(ade_index.column_values('filename').tolist())}
+      missing = [name for name in filenames if name not in row_of]
+      if missing:
+        raise ValueError('Not in the index: ' + ', '.join(missing))
+
+      rows = [row_of[name] for name in filenames]
+      image_paths, segmap_paths, folder_paths = \
+        funcs._filepaths(ade_index, rows, None, withParts)
+      return cls(image_paths, segmap_paths, folder_paths, **kwargs)
+
+# Read-only sequence over one element of the (image, segmap) entries of an
+# ADESubset, so that subset.imgs[i] and subset.segmaps[i] keep working
+class _LazyColumn:
+    def __init__(self, subset, position):
+      self._subset = subset
+      self._position = position
+
+    def __len__(self):
+      return len(self._subset)
 
-      # view contents of filename (directory for ADEImage)
-      # regex to separate photo filepath and segmap filepath(s)
-      # import each
+    def __getitem__(self, i):
+      if isinstance(i, slice):
+        return [self[j] for j in range(*i.indices(len(self)))]
+      return self._subset[i][self._position]
 
-      return cls(images, segmaps, filenames)
\ No newline at end of file
+    def __iter__(self):
+      for entry in self._subset:
+        yield entry[self._position]
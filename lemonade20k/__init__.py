@@ -1,4 +1,61 @@
-from .funcs import refresh_csv_tables, get_filename_column, \
-get_foldername_column, get_typeset_column, get_scene_column, \
-get_list_of_object_names, get_object_image_matrix, get_images, get_filepaths,\
-check_object_matches
\ No newline at end of file
+import importlib
+
+# Public names of the package, and the module each one is defined in.
+# Modules are only imported when one of their names is first used, so
+# `import lemonade20k` loads neither the index nor numpy/scipy/pandas/skimage.
+_EXPORTS = {
+  'refresh_csv_tables': 'funcs',
+  'get_index': 'funcs',
+  'update_index': 'funcs',
+  'share_index': 'funcs',
+  'attach_shared_index': 'funcs',
+  'get_filename_column': 'funcs',
+  'get_foldername_column': 'funcs',
+  'get_typeset_column': 'funcs',
+  'get_scene_column': 'funcs',
+  'get_list_of_object_names': 'funcs',
+  'get_object_image_matrix': 'funcs',
+  'get_cooccurrence_matrix': 'funcs',
+  'get_scene_object_frequencies': 'funcs',
+  'get_related_objects': 'funcs',
+  'get_images': 'funcs',
+  'close_storage': 'funcs',
+  'get_filepaths': 'funcs',
+  'get_filepaths_batch': 'funcs',
+  'match_queries': 'funcs',
+  'check_object_matches': 'funcs',
+  'materialize_whitelist': 'funcs',
+  'materialize_resized': 'funcs',
+  'convert_segmaps': 'funcs',
+  'export_shards': 'funcs',
+  'get_label_store': 'funcs',
+  'index_object_areas': 'funcs',
+  'cache_stats': 'funcs',
+  'set_cache_limit': 'funcs',
+  'set_query_cache': 'funcs',
+  'query_cache_stats': 'funcs',
+  'BatchLoader': 'loader',
+  'enable_stats': 'instrument',
+  'disable_stats': 'instrument',
+  'get_stats': 'instrument',
+  'Has': 'query',
+  'Area': 'query',
+  'Scene': 'query',
+  'Folder': 'query',
+  'Typeset': 'query',
+  'And': 'query',
+  'Or': 'query',
+  'Not': 'query',
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+  if name not in _EXPORTS:
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+  value = getattr(importlib.import_module('.' + _EXPORTS[name], __name__), name)
+  globals()[name] = value
+  return value
+
+def __dir__():
+  return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,171 @@
+import numpy as np
+import scipy.sparse as sp
+import os
+from . import batchio
+
+'''
+Dataset statistics computed on the sparse presence matrix
+
+  cooccurrence()        objects x objects: number of images containing both
+                        objects (the diagonal: images containing the object)
+  scene_frequencies()   scenes x objects: number of images of each scene
+                        containing the object (or its total instance count)
+  related()             the objects that appear most often with an object
+
+Every product is a sparse matrix product accumulated over chunks of image
+rows, so memory stays bounded by the size of the result plus one chunk; no
+dense images x objects table is ever built.
+
+Results are cached in indexCache/analytics/, tagged with the build id of the
+index they were computed from, and kept in memory for the current build, so
+repeated calls (e.g. from a dashboard) return at once.
+'''
+
+ANALYTICS_DIRNAME = 'analytics'
+
+# chunk of image rows multiplied at a time
+DEFAULT_CHUNK_ROWS = 4096
+
+# (build id, name) -> result of the current build
+_memo = {}
+
+'''
+@return CSR images x objects int32 matrix with 1 where the object is present
+'''
+def _binary_presence(ade_index):
+  presence = ade_index.object_presence_csr
+  return sp.csr_matrix((np.ones(presence.nnz, dtype=np.int32), presence.indices,
+                        presence.indptr), shape=presence.shape)
+
+'''
+Sums left(start, stop) @ right[start:stop] over chunks of rows of right
+'''
+def _chunked_product(left, right, chunk_rows):
+  total = None
+  for start in range(0, right.shape[0], chunk_rows):
+    stop = min(start + chunk_rows, right.shape[0])
+    product = (left(start, stop) @ right[start:stop]).tocsr()
+    total = product if total is None else total + product
+  if total is None:
+    total = sp.csr_matrix((left(0, 0).shape[0], right.shape[1]), dtype=np.int64)
+  return total.tocsr()
+
+def _cache_path(ade_index, name):
+  return os.path.join(ade_index._cache_folderpath, ANALYTICS_DIRNAME, name + '.npz')
+
+def _load(ade_index, name):
+  try:
+    with np.load(_cache_path(ade_index, name), allow_pickle=False) as arrays:
+      if str(arrays['build_id']) != str(ade_index.build_id):
+        return None
+      return sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                           shape=tuple(int(n) for n in arrays['shape']))
+  except (OSError, ValueError, KeyError):
+    return None
+
+def _save(ade_index, name, matrix):
+  path = _cache_path(ade_index, name)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  batchio.atomic_write(path, lambda tmp_path: np.savez(
+    tmp_path, build_id=str(ade_index.build_id), shape=np.array(matrix.shape),
+    data=matrix.data, indices=matrix.indices, indptr=matrix.indptr))
+
+'''
+Returns the cached matrix called name, computing (and caching) it first if
+the cache is missing or was computed for another build of the index
+'''
+def _cached(ade_index, name, compute, refresh=False):
+  key = (ade_index.build_id, name)
+  if not refresh:
+    if key in _memo:
+      return _memo[key]
+    matrix = _load(ade_index, name)
+    if matrix is not None:
+      _memo[key] = matrix
+      return matrix
+
+  matrix = compute()
+  if ade_index.build_id is not None:
+    _save(ade_index, name, matrix)
+  # only the current build is kept in memory
+  for stale in [k for k in _memo if k[0] != ade_index.build_id]:
+    del _memo[stale]
+  _memo[key] = matrix
+  return matrix
+
+'''
+@return CSR objects x objects matrix: entry (a, b) is the number of images
+        containing both object a and object b; entry (a, a) the number of
+        images containing a
+'''
+def cooccurrence(ade_index, chunk_rows=DEFAULT_CHUNK_ROWS, refresh=False):
+  def compute():
+    presence = _binary_presence(ade_index)
+    return _chunked_product(lambda start, stop: presence[start:stop].T, presence,
+                            chunk_rows)
+  return _cached(ade_index, 'cooccurrence', compute, refresh)
+
+'''
+@param instances - count object instances instead of images
+
+@return 2-tuple: (CSR scenes x objects matrix of the number of images of each
+                  scene that contain each object (or of instances),
+                  array of scene names, the rows of the matrix)
+'''
+def scene_frequencies(ade_index, instances=False, chunk_rows=DEFAULT_CHUNK_ROWS,
+                      refresh=False):
+  scenes = ade_index.image_index['scene'].cat
+  codes = scenes.codes.to_numpy()
+  num_scenes = len(scenes.categories)
+
+  def compute():
+    # scenes x images indicator: one 1 per image, in the row of its scene
+    has_scene = codes >= 0
+    indicator = sp.csc_matrix((np.ones(np.count_nonzero(has_scene), dtype=np.int32),
+                               (codes[has_scene], np.flatnonzero(has_scene))),
+                              shape=(num_scenes, len(codes)))
+    if instances:
+      presence = ade_index.object_presence_csr.astype(np.int64)
+    else:
+      presence = _binary_presence(ade_index)
+    return _chunked_product(lambda start, stop: indicator[:, start:stop], presence,
+                            chunk_rows)
+
+  name = 'scene_instances' if instances else 'scene_images'
+  return (_cached(ade_index, name, compute, refresh),
+          scenes.categories.to_numpy(dtype=object))
+
+'''
+Objects that appear in the same images as the objects named by phrase
+
+@param phrase - object name (a single synonym), see columns_matching()
+@param k - number of objects returned
+@param by - 'count' (images shared with phrase) or 'jaccard' (images shared,
+            divided by images containing either)
+
+@return list of up to k (object column, images shared, score) tuples, best
+        first; objects named by phrase itself are left out
+'''
+def related(ade_index, phrase, k=10, by='count'):
+  if by not in ('count', 'jaccard'):
+    raise ValueError("by must be 'count' or 'jaccard', not " + repr(by))
+
+  columns = ade_index.columns_matching(phrase)
+  if columns.size == 0:
+    return []
+  presence = _binary_presence(ade_index)
+  # images containing any object named by phrase, counted once each
+  rows = np.flatnonzero(np.asarray(presence[:, columns].sum(axis=1)).ravel())
+  shared = np.asarray(presence[rows].sum(axis=0)).ravel().astype(np.int64)
+  shared[columns] = 0
+
+  if by == 'count':
+    scores = shared.astype(float)
+  else:
+    images = cooccurrence(ade_index).diagonal().astype(np.int64)
+    union = rows.size + images - shared
+    scores = np.divide(shared, union, out=np.zeros(shared.shape), where=union > 0)
+
+  candidates = np.flatnonzero(shared)
+  best = candidates[np.argsort(-scores[candidates], kind='stable')[:k]]
+  return [(int(col), int(shared[col]), float(scores[col])) for col in best]
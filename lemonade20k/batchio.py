@@ -0,0 +1,115 @@
+import os
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+Plumbing shared by the batch jobs over the files of the dataset (label store,
+object areas, whitelisted segmaps, resized datasets)
+
+  - run_chunks() spreads chunks of work over a process pool
+  - atomic_write() and replace_folder() write files and folders so readers
+    (and other processes writing them) never see them half-written
+  - imread() and imsave() import skimage, which is slow to import, only when
+    an image is actually read or written
+'''
+
+'''
+@return list of consecutive slices of tasks, of at most chunksize items each
+'''
+def chunked(tasks, chunksize):
+  return [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+'''
+Calls fn(chunk, *args) for every chunk on a process pool, yielding the results
+as the chunks finish
+
+With max_workers=1, or a single chunk, the chunks are processed in order in
+the calling process (no pool is started). The pool is shut down once the
+results are consumed, or when the caller stops early (e.g. on an error).
+
+@param fn - module-level function (it is pickled for the workers)
+@param chunks - list of chunks, see chunked()
+@param args - more arguments of fn, the same for every chunk
+@param max_workers - size of the process pool (None uses every CPU)
+
+@return generator of 2-tuples: (index of the chunk in chunks, fn's result)
+'''
+def run_chunks(fn, chunks, args=(), max_workers=None):
+  if max_workers == 1 or len(chunks) <= 1:
+    for i, chunk in enumerate(chunks):
+      yield i, fn(chunk, *args)
+    return
+
+  executor = ProcessPoolExecutor(max_workers=max_workers)
+  try:
+    futures = {executor.submit(fn, chunk, *args): i for i, chunk in enumerate(chunks)}
+    for future in as_completed(futures):
+      yield futures[future], future.result()
+  finally:
+    executor.shutdown()
+
+'''
+Calls write_fn(tmp_path) for a temporary file next to path (same extension,
+hidden name starting with .tmp-), then renames it over path
+
+The temporary name is unique per call, so threads and processes writing the
+same path never write to the same temporary file.
+'''
+def atomic_write(path, write_fn):
+  tmp_path = os.path.join(os.path.dirname(path),
+                          '.tmp-' + uuid.uuid4().hex + '-' + os.path.basename(path))
+  try:
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+'''
+@return path of a new, empty temporary folder next to folder, to be moved in
+        with replace_folder()
+'''
+def make_tmp_folder(folder):
+  tmp_folder = folder + '.tmp-' + str(os.getpid())
+  shutil.rmtree(tmp_folder, ignore_errors=True)
+  os.makedirs(tmp_folder)
+  return tmp_folder
+
+'''
+Moves tmp_folder to folder, replacing the folder that is there
+
+The old folder is renamed aside before the new one is renamed in, and only
+then deleted, so folder is never missing its files for long, and another
+process saving at the same time cannot make the rename fail (a directory
+can only be renamed onto a missing or empty one): if its folder lands first,
+it is moved aside in turn and the last folder saved wins.
+'''
+def replace_folder(tmp_folder, folder, attempts=5):
+  old_folders = []
+  try:
+    for attempt in range(attempts):
+      old_folder = folder + '.old-' + uuid.uuid4().hex
+      try:
+        os.rename(folder, old_folder)
+        old_folders.append(old_folder)
+      except FileNotFoundError:
+        pass
+      try:
+        os.replace(tmp_folder, folder)
+        return
+      except OSError:
+        # another process renamed its folder in after ours was moved aside
+        if attempt == attempts - 1:
+          raise
+  finally:
+    for old_folder in old_folders:
+      shutil.rmtree(old_folder, ignore_errors=True)
+
+def imread(path):
+  from skimage.io import imread
+  return imread(path)
+
+def imsave(path, array):
+  from skimage.io import imsave
+  imsave(path, array, check_contrast=False)
@@ -0,0 +1,267 @@
+import numpy as np
+import scipy.sparse as sp
+from . import batchio
+from . import instrument
+from . import query as q
+
+'''
+Evaluation of many queries in one pass over the index
+
+Evaluating queries one by one sums the presence matrix columns of every Has()
+separately, so a batch of hundreds of queries reads the presence matrix
+hundreds of times. Instead, evaluate() collects the predicates ("leaves") of
+every query in the batch, deduplicated by their canonical key, and:
+
+  - resolves each distinct phrase to its object columns once
+  - builds a sparse indicator matrix with one column per distinct phrase
+    group, so a single sparse product (presence @ groups) gives the instance
+    totals of every group for every image (object_areas @ groups for Area())
+  - compares those totals against the thresholds of every predicate at once,
+    as one broadcast comparison over an images x predicates array
+  - combines the predicates of AND queries (which get_filepaths() phrases
+    compile to) with one more sparse product, counting for each image the
+    satisfied predicates of each query; other queries are combined following
+    their expression tree
+
+The work is split in chunks of image rows, which bounds the size of the dense
+images x predicates arrays and lets a process pool evaluate chunks in
+parallel.
+'''
+
+# image rows evaluated at a time
+DEFAULT_CHUNK_ROWS = 8192
+
+# Leaves of a query tree, by canonical key (in order of first appearance)
+def _collect_leaves(query, leaves):
+  if isinstance(query, (q.And, q.Or)):
+    for subquery in query.queries:
+      _collect_leaves(subquery, leaves)
+  elif isinstance(query, q.Not):
+    _collect_leaves(query.query, leaves)
+  else:
+    leaves.setdefault(query.key(), query)
+
+# The leaf keys of a query that is a leaf or an AND of leaves, else None
+def _conjunction(query):
+  if isinstance(query, q.And):
+    if any(isinstance(sub, (q.And, q.Or, q.Not)) for sub in query.queries):
+      return None
+    return set(sub.key() for sub in query.queries)
+  if isinstance(query, (q.Or, q.Not)):
+    return None
+  return {query.key()}
+
+'''
+Per-predicate thresholds over the totals of phrase groups
+
+@param leaves - list of (leaf column, Has or Area predicate)
+@param columns_of - dict of phrase -> object columns
+@param num_objects - number of object columns of the matrix the totals sum
+'''
+class _Thresholds:
+  def __init__(self, leaves, columns_of, num_objects):
+    groups = {}
+    self.leaf_columns = np.array([column for column, leaf in leaves], dtype=np.int64)
+    self.groups = []
+    self.mins = []
+    self.maxs = []
+    for column, leaf in leaves:
+      group = tuple(sorted(set(leaf.phrases)))
+      self.groups.append(groups.setdefault(group, len(groups)))
+      if isinstance(leaf, q.Area):
+        self.mins.append(leaf.min_fraction)
+        self.maxs.append(np.inf if leaf.max_fraction is None else leaf.max_fraction)
+      else:
+        self.mins.append(leaf.min_count)
+        self.maxs.append(np.inf if leaf.max_count is None else leaf.max_count)
+    self.groups = np.array(self.groups, dtype=np.int64)
+    self.mins = np.array(self.mins, dtype=float)
+    self.maxs = np.array(self.maxs, dtype=float)
+
+    # objects x groups indicator, 1 where the object is named by the group
+    rows, cols = [], []
+    for group, g in groups.items():
+      group_columns = np.unique(np.concatenate(
+        [columns_of[phrase] for phrase in group] + [np.array([], dtype=np.int64)]))
+      rows.append(group_columns)
+      cols.append(np.full(group_columns.size, g, dtype=np.int64))
+    rows = np.concatenate(rows + [np.array([], dtype=np.int64)])
+    cols = np.concatenate(cols + [np.array([], dtype=np.int64)])
+    self.indicator = sp.csc_matrix((np.ones(rows.size), (rows, cols)),
+                                   shape=(num_objects, len(groups)))
+
+  '''
+  @param matrix - CSR chunk of image rows x objects
+  @param pixels - pixel totals of the rows, to compare area fractions, or None
+                  to compare instance counts
+
+  @return boolean rows x predicates array
+  '''
+  def compare(self, matrix, pixels=None):
+    totals = (matrix @ self.indicator)
+    totals = totals.toarray() if sp.issparse(totals) else np.asarray(totals)
+    totals = totals[:, self.groups]
+    if pixels is not None:
+      pixels = pixels[:, None]
+      totals = np.divide(totals, pixels, out=np.zeros(totals.shape), where=pixels > 0)
+    mask = (totals >= self.mins) & (totals <= self.maxs)
+    if pixels is not None:
+      # images without a measured segmap never match (see Area.mask())
+      mask &= pixels > 0
+    return mask
+
+'''
+Everything a chunk needs to evaluate the batch, built once per batch
+'''
+class _Plan:
+  def __init__(self, queries, ade_index):
+    leaves = {}
+    for query in queries:
+      _collect_leaves(query, leaves)
+    self.leaf_keys = list(leaves)
+    leaf_column = {key: column for column, key in enumerate(self.leaf_keys)}
+    num_leaves = len(self.leaf_keys)
+
+    # Every distinct phrase of the batch is resolved once
+    has_leaves = [(leaf_column[key], leaf) for key, leaf in leaves.items()
+                  if type(leaf) is q.Has]
+    area_leaves = [(leaf_column[key], leaf) for key, leaf in leaves.items()
+                   if type(leaf) is q.Area]
+    phrases = set(phrase for column, leaf in has_leaves + area_leaves
+                  for phrase in leaf.phrases)
+    with instrument.span('query.resolve_phrases'):
+      columns_of = {phrase: ade_index.columns_matching(phrase) for phrase in phrases}
+    instrument.count('query.matched_columns',
+                     sum(columns.size for columns in columns_of.values()))
+
+    num_objects = ade_index.object_presence.shape[1]
+    self.has = _Thresholds(has_leaves, columns_of, num_objects) if has_leaves else None
+    self.area = None
+    if area_leaves:
+      if ade_index.object_areas is None:
+        raise ValueError('Object areas have not been measured yet; '
+                         + 'run index_object_areas() once first')
+      self.area = _Thresholds(area_leaves, columns_of, ade_index.object_areas.shape[1])
+
+    # Metadata predicates (Scene(), Folder(), ...) are evaluated over the
+    # whole index, once each, with their own vectorized mask()
+    others = [(leaf_column[key], leaf) for key, leaf in leaves.items()
+              if type(leaf) not in (q.Has, q.Area)]
+    self.other_columns = np.array([column for column, leaf in others], dtype=np.int64)
+    self.other_leaves = [leaf for column, leaf in others]
+
+    # AND queries: queries x leaves indicator and number of leaves of each
+    conjunctions = [(i, _conjunction(query)) for i, query in enumerate(queries)]
+    self.conjunctive = np.array([i for i, keys in conjunctions if keys is not None],
+                                dtype=np.int64)
+    rows, cols = [], []
+    required = []
+    for row, (i, keys) in enumerate((i, keys) for i, keys in conjunctions
+                                    if keys is not None):
+      rows.extend([row] * len(keys))
+      cols.extend(leaf_column[key] for key in keys)
+      required.append(len(keys))
+    self.membership = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                    shape=(len(self.conjunctive), num_leaves))
+    self.required = np.array(required, dtype=np.int32)
+
+    self.trees = [(i, queries[i]) for i, keys in conjunctions if keys is None]
+    self.leaf_column = leaf_column
+    self.num_queries = len(queries)
+
+  '''
+  @return boolean rows x leaves array of the predicates over a chunk
+  '''
+  def leaf_masks(self, presence, areas, pixels, other_masks):
+    masks = np.zeros((presence.shape[0], len(self.leaf_keys)), dtype=bool)
+    if self.has is not None:
+      masks[:, self.has.leaf_columns] = self.has.compare(presence)
+    if self.area is not None:
+      masks[:, self.area.leaf_columns] = self.area.compare(areas, pixels)
+    masks[:, self.other_columns] = other_masks
+    return masks
+
+  def combine(self, query, masks):
+    if isinstance(query, q.And):
+      mask = np.ones(masks.shape[0], dtype=bool)
+      for subquery in query.queries:
+        mask &= self.combine(subquery, masks)
+      return mask
+    if isinstance(query, q.Or):
+      mask = np.zeros(masks.shape[0], dtype=bool)
+      for subquery in query.queries:
+        mask |= self.combine(subquery, masks)
+      return mask
+    if isinstance(query, q.Not):
+      return ~self.combine(query.query, masks)
+    return masks[:, self.leaf_column[query.key()]]
+
+'''
+Evaluates a chunk of image rows
+
+@return list with the matching rows of each query, local to the chunk
+'''
+def _evaluate_chunk(plan, presence, areas, pixels, other_masks):
+  masks = plan.leaf_masks(presence, areas, pixels, other_masks)
+  rows = [None] * plan.num_queries
+
+  # queries x rows: number of satisfied predicates of each AND query
+  satisfied = plan.membership @ masks.T.astype(np.int32)
+  matched = satisfied == plan.required[:, None]
+  for i, query_matched in zip(plan.conjunctive, matched):
+    rows[i] = np.flatnonzero(query_matched)
+
+  for i, query in plan.trees:
+    rows[i] = np.flatnonzero(plan.combine(query, masks))
+  return rows
+
+def _evaluate_chunk_task(args):
+  return _evaluate_chunk(*args)
+
+'''
+@param queries - list of Query objects (see query.py)
+@param ade_index - ADEIndex
+@param max_workers - size of the process pool chunks are evaluated on (None
+                     uses every CPU); with max_workers=1 (default), or when
+                     the index fits in one chunk, the batch is evaluated in
+                     this process
+@param chunk_rows - number of image rows evaluated at a time
+
+@return list with a sorted integer array of the matching image_index rows
+        for each query, in order
+'''
+def evaluate(queries, ade_index, max_workers=1, chunk_rows=DEFAULT_CHUNK_ROWS):
+  queries = list(queries)
+  if not queries:
+    return []
+  plan = _Plan(queries, ade_index)
+
+  num_rows = ade_index.num_images_total
+  other_masks = np.zeros((num_rows, len(plan.other_leaves)), dtype=bool)
+  for j, leaf in enumerate(plan.other_leaves):
+    other_masks[:, j] = leaf.mask(ade_index)
+
+  areas = None
+  if plan.area is not None:
+    areas = ade_index.object_areas.tocsr()
+
+  starts = list(range(0, num_rows, max(1, chunk_rows))) or [0]
+  tasks = []
+  for start in starts:
+    stop = min(start + chunk_rows, num_rows)
+    tasks.append((plan, ade_index.object_presence_csr[start:stop],
+                  None if areas is None else areas[start:stop],
+                  None if areas is None else ade_index.pixel_totals[start:stop],
+                  other_masks[start:stop]))
+
+  chunk_rows_list = [None] * len(tasks)
+  with instrument.span('query.batch'):
+    for i, rows in batchio.run_chunks(_evaluate_chunk_task, tasks, max_workers=max_workers):
+      chunk_rows_list[i] = rows
+
+  results = []
+  for i in range(len(queries)):
+    results.append(np.concatenate(
+      [rows[i] + start for start, rows in zip(starts, chunk_rows_list)]
+      + [np.array([], dtype=np.int64)]).astype(np.int64))
+  return results
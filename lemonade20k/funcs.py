@@ -1,20 +1,132 @@
-import numpy as np
-import pandas as pd
-import glob
+import functools
+import logging
+import os
 from os.path import join
 import sys
-from skimage.io import imsave, imread_collection, imread
-from . import ADEIndex as ind_class
+import threading
+import numpy as np
 from . import ADESubset
+from . import segcodes
+from . import labelstore
+from . import whitelisting
+from . import resizing
+from . import query
+from . import querycache
+from . import instrument
 from .exceptions import QueryPhrasesFormatError
 
-index = ind_class.ADEIndex()
+_logger = logging.getLogger(__name__)
+
+_DATASET_DIRNAME = 'ADE20K_2016_07_26'
+
+# The index is only built (or loaded from its cache) on first use, so importing
+# the package stays cheap; see get_index()
+_index = None
+_index_lock = threading.Lock()
+
+# Rows matched by recent queries, keyed by (index build, canonical query)
+_query_cache = querycache.QueryCache()
+
+# Fetchers of the storage backends used by get_images(), keyed by
+# (storage, concurrency); see _fetcher()
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+# Label store opened by get_label_store() (False until it has been looked for)
+_label_store = False
+
+# Whitelisted segmaps, keyed by (source segmap, whitelist hash)
+_segmap_cache = whitelisting.SegmapCache(join(sys.path[0], _DATASET_DIRNAME, 'whitelisted'))
+
+'''
+Returns the ADEIndex shared by every function of the package, loading it on
+the first call (thread-safe: concurrent first calls load it only once)
+
+scipy and pandas are only imported at that point.
+'''
+def get_index():
+  global _index
+  if _index is None:
+    with _index_lock:
+      if _index is None:
+        from . import ADEIndex as ind_class
+        with instrument.span('index.load'):
+          _index = ind_class.ADEIndex()
+  return _index
+
+# Keeps `funcs.index` working for code written before the index became lazy
+def __getattr__(name):
+  if name == 'index':
+    return get_index()
+  raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 '''
-Delete and remake CSV indexes for the dataset
+Publishes the index in shared memory, so worker processes can use it without
+each loading (or unpickling) their own copy
+
+@param directory - where the shared file is written (default: /dev/shm)
+
+@return picklable handle to pass to attach_shared_index() in the workers;
+        release it with sharing.release(handle) once they are done
+'''
+def share_index(directory=None):
+  from . import sharing
+  return sharing.publish(get_index(), directory)
+
+'''
+Makes the index published by share_index() the index of this process (call it
+once in each worker, e.g. from a pool initializer). Its arrays are read-only
+views of the shared memory.
+
+@param handle - handle returned by share_index(), or its name
+'''
+def attach_shared_index(handle, directory=None):
+  global _index
+  from . import sharing
+  with _index_lock:
+    _index = sharing.attach(handle, directory)
+    _query_cache.clear()
+    _whitelist_lut.cache_clear()
+    _whitelist_key.cache_clear()
+
+'''
+Rebuild the binary index cache from index_ade20k.mat, then delete and remake
+the (opt-in) CSV indexes for the dataset
 '''
 def refresh_csv_tables():
-  index = ind_class.ADEIndex(True)
+  global _index
+  from . import ADEIndex as ind_class
+  with _index_lock:
+    _index = ind_class.ADEIndex(True)
+    # Results derived from the previous index are stale
+    _query_cache.clear()
+    _whitelist_lut.cache_clear()
+    _whitelist_key.cache_clear()
+
+'''
+Adds newly annotated images to the index without rebuilding it: folders are
+scanned for images with an *_atr.txt file, whose object counts are appended
+to the image index and presence matrix (new object names become new columns).
+The existing index cache is left as it is; the new rows are saved next to it.
+
+@param folders - list of folders relative to the dataset root (e.g.
+                 'ADE20K_2016_07_26/images/training/m/my_scenes'), or None to
+                 look through every folder below ADE20K_2016_07_26/images
+
+@return number of images added
+'''
+def update_index(folders=None):
+  ade_index = get_index()
+  with _index_lock:
+    build_id = ade_index.build_id
+    added = ade_index.add_folders(folders)
+    # rows were added, by this call or by another process (the index is then
+    # loaded again): results derived from the previous rows are stale
+    if ade_index.build_id != build_id:
+      _query_cache.clear()
+      _whitelist_lut.cache_clear()
+      _whitelist_key.cache_clear()
+  return added
 
 '''
 # Getting Metadata Tables
@@ -26,16 +138,16 @@ def _get_column(df, name):
   return df.loc[:,[name]]
 
 def get_filename_column():
-  return _get_column(index.image_index, 'filename')
+  return _get_column(get_index().image_index, 'filename')
 
 def get_foldername_column():
-  return _get_column(index.image_index, 'folder')
+  return _get_column(get_index().image_index, 'folder')
 
 def get_typeset_column():
-  return _get_column(index.image_index, 'typeset')
+  return _get_column(get_index().image_index, 'typeset')
 
 def get_scene_column():
-  return _get_column(index.image_index, 'scene')
+  return _get_column(get_index().image_index, 'scene')
 
 '''
 List distinct objects included in the ADE20K dataset (in entries with multiple
@@ -43,91 +155,329 @@ words, all words in the entry are treated as the same object, and all share the
 same encoding in the segmentation maps), returned as Pandas column
 '''
 def get_list_of_object_names():
-  return index.object_name_list
+  return get_index().object_name_list
 
 '''
 Return Pandas DataFrame containing counts of how frequently each object occurs 
 in each image. Each (row, column) entry corresponds to an (image, object) pair.
-Rows are labeled by image filename.
+Rows line up with the rows of the image index (see get_filename_column()).
 '''
 def get_object_image_matrix():
-  return index.object_image_matrix
+  return get_index().object_image_matrix
+
+'''
+# Dataset Statistics
+
+Computed on the sparse presence matrix and cached next to the index (see
+analytics.py), so repeated calls return at once
+'''
+
+'''
+Return Pandas DataFrame (sparse columns) with one row and one column per object
+name: entry (a, b) is the number of images that contain both a and b, and the
+diagonal the number of images that contain each object
+'''
+def get_cooccurrence_matrix():
+  import pandas as pd
+  from . import analytics
+  ade_index = get_index()
+  names = ade_index.object_name_list['objectnames']
+  return pd.DataFrame.sparse.from_spmatrix(analytics.cooccurrence(ade_index),
+                                           index=names.to_numpy(), columns=names)
+
+'''
+Return Pandas DataFrame (sparse columns) with one row per scene and one column
+per object name, counting the images of each scene that contain the object
+(or, with instances=True, the instances of the object in those images)
+'''
+def get_scene_object_frequencies(instances=False):
+  import pandas as pd
+  from . import analytics
+  ade_index = get_index()
+  frequencies, scenes = analytics.scene_frequencies(ade_index, instances)
+  return pd.DataFrame.sparse.from_spmatrix(
+    frequencies, index=scenes, columns=ade_index.object_name_list['objectnames'])
+
+'''
+Lists the objects that appear most often in the same images as the objects
+matching object_lookup_string (see check_object_matches())
+
+@param k - number of objects listed
+@param by - 'count' ranks by number of shared images, 'jaccard' by shared
+            images over images containing either object (which favours
+            objects specific to the same images over ubiquitous ones)
+
+@return list of up to k (object name, number of shared images, score) tuples
+'''
+def get_related_objects(object_lookup_string, k=10, by='count'):
+  from . import analytics
+  ade_index = get_index()
+  object_names = ade_index.object_names()
+  return [(object_names[col], shared, score) for col, shared, score
+          in analytics.related(ade_index, object_lookup_string, k, by)]
+
+'''
+Builds (once per whitelist) the lookup table used by _knockout_segmap: the ith
+whitelist word gets label i + 1, every other object code maps to 0
+'''
+@functools.lru_cache(maxsize=32)
+def _whitelist_lut(ade_index, whitelist):
+  return segcodes.build_label_lut([ade_index.columns_matching(word)
+                                  for word in whitelist])
+
+'''
+Hash naming the folder of the segmaps whitelisted with whitelist: it covers
+the words and the lookup table they resolve to in ade_index (see
+whitelisting.whitelist_hash()), so a rebuilt or updated index that maps the
+words to other objects gets a new folder
+'''
+@functools.lru_cache(maxsize=32)
+def _whitelist_key(ade_index, whitelist):
+  return whitelisting.whitelist_hash(whitelist, _whitelist_lut(ade_index, whitelist))
+
+'''
+Path of the folder within ADE20K_2016_07_26/whitelisted/<whitelist hash>/ that
+mirrors folder_path (a folder path as recorded in the index, relative to the
+dataset root)
+'''
+def _whitelisted_folder(folder_path, whitelist):
+  return _derived_folder(_whitelist_root(whitelist), folder_path)
+
+# Folder of an image, as recorded in the index, moved below root
+def _derived_folder(root, folder_path):
+  parts = os.path.normpath(folder_path).split(os.sep)
+  if parts[0] == _DATASET_DIRNAME:
+    parts = parts[1:]
+  return join(root, *parts)
+
+def _whitelist_root(whitelist):
+  return join(_DATASET_DIRNAME, 'whitelisted', _whitelist_key(get_index(), tuple(whitelist)))
 
 '''
 Sets all semantic regions of a segmap that are NOT listed on objects whitelist
 to 0 (the value that indicates "unknown" content)
 
 Renumbers remaining semantic content with pixel codes from 1 to n, where n 
-is the number of distinct objects in the whitelist
+is the number of distinct objects in the whitelist (the ith whitelist word
+always gets code i, so codes are consistent across segmaps)
 
-Saves segmaps to ADE20K_2016_07_26/whitlelisted/folder_path/segmap
+Saves segmaps to ADE20K_2016_07_26/whitelisted/<whitelist hash>/folder_path/segmap
+(skipped if that segmap is already up to date)
+
+@param segmap_path - complete path to a *_seg.png file
+@param folder_path - folder of the image, as returned by get_filepaths()
+@param whitelist - list of strings
 
 @return - 2-tuple: (path to the new segmap, path to folder containing new segmap)
 '''
-def _knockout_segmap(initial_segmap, folder_path, whitelist):
-    
-    r = initial_segmap[:,:,0]
-    g = initial_segmap[:,:,1]
-
-    r = r.astype(np.uint16)
-    g = g.astype(np.uint16)
-
-    object_map =  np.floor((r / 10)) * 256 + g
-    whether_values_are_zero = object_map == 0
-    # to fix MATLAB indexing
-    object_map[whether_values_are_zero] = 1
-
-    # get unique image labels in the decoded segmap (list of contained objects)
-    unique_obj_codes = np.unique(object_map)
-    # if object is not in our list of approved objects, then set all pixels of this object to 0
-    num_approved_words_in_img = 0
-    for code in unique_obj_codes:
-        # the MATLAB indexing fix described above /should/ prevent this from being a key error
-        img_object_name = index.object_name_list['objectnames'].loc[code - 1]
-
-        approved_code = False
-        # Checking if current object is on our list of approved words
-        for word_index, word in enumerate(whitelist):
-            # This "in" is checking list containment (img_object_name.split(", ")) is a list of strings
-            if word in img_object_name.split(", "):
-                # This objectname matches the current whitelist word
-                num_approved_words_in_img += 1
-                parts_of_object_map_with_this_object = object_map == code
-                object_map[parts_of_object_map_with_this_object] = num_approved_words_in_img
-                approved_code = True
-                break
-
-        if approved_code:
-            # print(img_object_name + " is approved")
-            pass
-        else:
-            # Current code is not on the whitelist
-            parts_of_object_map_with_this_object = object_map == code
-            object_map[parts_of_object_map_with_this_object] = 0
+def _knockout_segmap(segmap_path, folder_path, whitelist):
+  new_segmap_paths, whitelisted_folder_paths = \
+    _materialize_whitelist([segmap_path], [folder_path], whitelist, max_workers=1,
+                           progress=None)
+  return new_segmap_paths[0], whitelisted_folder_paths[0]
+
+def _materialize_whitelist(segmap_paths, folder_paths, whitelist, max_workers=None,
+                           chunksize=64, progress=whitelisting._log_progress):
+  whitelist = tuple(whitelist)
+  # One gather per segmap replaces a full-image mask per object in the segmap
+  lut = _whitelist_lut(get_index(), whitelist)
+
+  whitelisted_folder_paths = [_whitelisted_folder(folder, whitelist)
+                              for folder in folder_paths]
+  new_segmap_paths = [join(sys.path[0], whitelisted_folder, os.path.basename(path))
+                      for path, whitelisted_folder
+                      in zip(segmap_paths, whitelisted_folder_paths)]
+
+  whitelisting.write_whitelist_record(join(sys.path[0], _whitelist_root(whitelist)),
+                                      whitelist)
+  with instrument.span('whitelist.knockout'):
+    written, skipped = whitelisting.materialize(zip(segmap_paths, new_segmap_paths), lut,
+                                                max_workers=max_workers,
+                                                chunksize=chunksize, progress=progress,
+                                                cache=_segmap_cache)
+  instrument.count('whitelist.segmaps_written', written)
+  instrument.count('whitelist.segmaps_skipped', skipped)
+
+  return new_segmap_paths, whitelisted_folder_paths
 
-    # Now, object_map has nonzero pixel values only for objects that we care about
-    object_map = object_map.astype(np.float64)
+'''
+Statistics of the whitelisted segmap cache (ADE20K_2016_07_26/whitelisted/)
 
-    npy_segmap = np.array(object_map)
+@return dict with the number of cache hits and misses (segmaps that had to be
+        produced) since import, the current size of the cache in bytes, the
+        size limit (None if unbounded), and the number of evicted segmaps
+'''
+def cache_stats():
+  return _segmap_cache.stats()
 
-    # Normalize segmap values from 0 to 255
+'''
+Bounds the size of the whitelisted segmap cache. Once it grows past max_bytes,
+the least recently used segmaps are deleted (and produced again on their next
+use).
 
-    npy_segmap *= 255.0/npy_segmap.max()
+@param max_bytes - int, or None to let the cache grow without bound (default)
+'''
+def set_cache_limit(max_bytes):
+  _segmap_cache.max_bytes = max_bytes
+  _segmap_cache.enforce_limit()
 
-    generic_filename, ext = os.path.splitext(filename)
+'''
+Writes the whitelisted segmaps of every image that matches phrases, spreading
+the work over a pool of processes
+
+Segmaps that were already produced with the same whitelist, and whose source
+segmap has not changed since, are skipped, so interrupted or repeated runs only
+do the remaining work.
+
+@param phrases - see get_images()
+@param whitelist - list of strings, see get_images()
+@param max_workers - number of worker processes (None uses every CPU)
+@param chunksize - number of segmaps handed to a worker at a time
+@param progress - callable(done, total, written, skipped) called as chunks
+                  finish, or None to stay quiet
+
+@return 2-tuple: (list of paths to the whitelisted segmaps,
+                  list of whitelisted folder paths), in the order of
+                  get_filepaths(phrases), leaving out images without a segmap
+'''
+def materialize_whitelist(phrases, whitelist, max_workers=None, chunksize=64,
+                          progress=whitelisting._log_progress):
+  image_paths, segmap_paths, folder_paths = _segmapped_filepaths(phrases)
+  return _materialize_whitelist([paths[0] for paths in segmap_paths], folder_paths,
+                                whitelist, max_workers, chunksize, progress)
 
-    if whether_training:
-        f = os.path.join(train_dir, filename)
-        npy_path = os.path.join(train_dir,generic_filename)
-        #print("Resized segmap is ", resized_segmap)
-        #print("Shape is ", resized_segmap.shape)
-        imsave(f, resized_segmap)
-        #print("Saving training segmap " + f)
-    else:
-        f = os.path.join(test_dir, filename)
-        npy_path = os.path.join(test_dir,generic_filename)
-        imsave(f, resized_segmap)
-        #print("Saving testing segmap " + f)
+'''
+Writes a resized (and optionally tiled) copy of every image that matches
+phrases, with its label map, to
+ADE20K_2016_07_26/resized/<spec hash>/<folder of the image>/, spreading the
+work over a pool of processes (see resizing.py)
+
+Label maps are resized by nearest neighbour, so they only hold labels of the
+source segmap; with a whitelist, the whitelisted segmaps are resized. Images
+whose outputs are newer than their sources are skipped, so later runs (and
+every training epoch) reuse the derived dataset.
+
+@param phrases - see get_images()
+@param size - (height, width) images and label maps are resized to, or None
+@param tile - (height, width) of the tiles cut after resizing, or None; edge
+              tiles are padded with 0 ("unknown") when an image is smaller
+@param stride - (vertical, horizontal) step between tiles (default: tile)
+@param whitelist - list of strings, see get_images()
+@param max_workers - number of worker processes (None uses every CPU)
+@param chunksize - number of images handed to a worker at a time
+@param progress - callable(done, total, written, skipped) called as chunks
+                  finish, or None to stay quiet
+
+@return 3-tuple like get_filepaths(): (image paths, segmap paths (a 1-element
+        list per sample), folder paths), with one entry per tile, ready to be
+        passed to ADESubset.ADESubset(), BatchLoader or export_shards();
+        images without a segmap are left out
+'''
+def materialize_resized(phrases, size=None, tile=None, stride=None, whitelist=None,
+                        max_workers=None, chunksize=16, progress=resizing._log_progress):
+  # the same key as the folder of the whitelisted segmaps, so a rebuilt index
+  # that maps the words to other objects gets new outputs
+  source = None if whitelist is None else _whitelist_key(get_index(), tuple(whitelist))
+  spec = resizing.make_spec(size, tile, stride, source)
+
+  image_paths, segmap_paths, folder_paths = _segmapped_filepaths(phrases)
+  source_paths = [paths[0] for paths in segmap_paths]
+  label_paths = source_paths
+  if whitelist is not None:
+    # Outputs are up to date against the original segmaps: the whitelisted
+    # ones are touched on every cache hit
+    label_paths = _materialize_whitelist(source_paths, folder_paths, whitelist)[0]
+
+  root = join(_DATASET_DIRNAME, 'resized', resizing.spec_hash(spec))
+  resizing.write_spec_record(join(sys.path[0], root), spec)
+  resized_folders = [_derived_folder(root, folder) for folder in folder_paths]
+  tasks = [(image_path, label_path,
+            join(sys.path[0], folder, os.path.splitext(os.path.basename(image_path))[0]),
+            source_path)
+           for image_path, label_path, source_path, folder
+           in zip(image_paths, label_paths, source_paths, resized_folders)]
+
+  with instrument.span('resize.materialize'):
+    names, written, skipped = resizing.materialize(tasks, spec, max_workers=max_workers,
+                                                   chunksize=chunksize, progress=progress)
+  instrument.count('resize.images_written', written)
+  instrument.count('resize.images_skipped', skipped)
+
+  new_image_paths, new_segmap_paths, new_folder_paths = [], [], []
+  for task_names, folder in zip(names, resized_folders):
+    for name in task_names:
+      new_image_paths.append(name + '.png')
+      new_segmap_paths.append([name + '_seg.png'])
+      new_folder_paths.append(folder)
+  return new_image_paths, new_segmap_paths, new_folder_paths
+
+'''
+Folder of the label store written by convert_segmaps()
+'''
+def _label_store_folder():
+  return join(sys.path[0], _DATASET_DIRNAME, 'labels')
+
+'''
+Decodes the segmaps of every image in the index once into a label store (see
+labelstore.py), so get_images(..., use_label_store=True) and BatchLoader read
+uint16 object codes from a memory-mapped file instead of decoding PNGs every
+epoch. Run it again after the segmaps change.
+
+@param withParts - also convert the parts segmaps
+@param compress - zlib level (1-9), or 0 to keep records memory-mappable
+@param max_workers - number of worker processes (None uses every CPU)
+@param chunksize - number of segmaps handed to a worker at a time
+@param progress - callable(done, total) called as chunks finish, or None
+
+@return the new LabelStore
+'''
+def convert_segmaps(withParts=True, compress=0, max_workers=None, chunksize=64,
+                    progress=labelstore._log_progress):
+  global _label_store
+  ade_index = get_index()
+  segmap_paths = [path for paths in
+                  ade_index.path_manifest.segmap_paths(range(ade_index.num_images_total),
+                                                       withParts)
+                  for path in paths]
+  _label_store = labelstore.build(_label_store_folder(), segmap_paths, sys.path[0],
+                                  compress, max_workers, chunksize, progress)
+  return _label_store
+
+'''
+@return the LabelStore written by convert_segmaps(), or None if the segmaps
+        were never converted
+'''
+def get_label_store():
+  global _label_store
+  if _label_store is False:
+    _label_store = labelstore.load(_label_store_folder(), sys.path[0])
+  return _label_store
+
+def _log_area_progress(done, total):
+  from . import pixelstats
+  pixelstats._log_progress(done, total)
+
+'''
+Measures, once, the pixel area of every object in every image (from the
+primary segmaps, or the label store when convert_segmaps() was run), so that
+Area() queries select images by coverage without reading any image. The areas
+are saved with the index cache; run it again after the segmaps change.
+
+@param max_workers - number of worker processes (None uses every CPU)
+@param chunksize - number of segmaps handed to a worker at a time
+@param progress - callable(done, total) called as chunks finish, or None
+'''
+def index_object_areas(max_workers=None, chunksize=64, progress=_log_area_progress):
+  # pixelstats imports scipy.sparse, so it is only imported to measure areas
+  from . import pixelstats
+  ade_index = get_index()
+  segmap_paths = [paths[0] if paths else '' for paths in
+                  ade_index.path_manifest.segmap_paths(range(ade_index.num_images_total))]
+  areas, pixels = pixelstats.build(segmap_paths, ade_index.object_presence.shape[1],
+                                   get_label_store(), max_workers, chunksize, progress)
+  ade_index.set_object_areas(areas, pixels)
+  # Memoized Area() results may come from previous measurements
+  _query_cache.clear()
 
 '''
 # Getting Images
@@ -171,6 +521,20 @@ imported as Numpy arrays.
                 --> concatenating these two results gives images with:
   (at least 6 (boots OR telephone) AND at least 1 couch) OR (at least 11 limes)
 
+                phrases can also be a query built from the predicates in
+                query.py, which also supports OR across groups, NOT, count
+                ranges, and scene/folder/typeset conditions:
+
+                get_images((Has(['boots', 'telephone'], 6) & Has('couch'))
+                           | Has('lime', 11))
+                    --> the same subset as the two calls above, in one call
+
+                get_images(Has('car') & ~Has('person') & Scene('street'))
+
+                get_images(Area('wall', 0.3) & Has('bed'))
+                    --> walls cover at least 30% of each image, which has
+                        a bed (needs index_object_areas() to have run once)
+
 
 @param whitelist - list of strings or None (default)
                     
@@ -184,6 +548,30 @@ imported as Numpy arrays.
                   and imported into a list of segmaps for the corresponding
                   image
 
+@param cache_size - number of decoded (image, segmap) entries the returned
+                    ADESubset keeps in memory (images are decoded on access)
+
+@param prefetch - number of entries decoded ahead, on a thread pool, while
+                  iterating over the returned ADESubset (0 disables prefetch)
+
+@param use_label_store - read segmaps from the label store written by
+                         convert_segmaps(), as uint16 object codes, instead of
+                         decoding their PNGs (whitelisted segmaps are still
+                         read from their PNGs)
+
+@param storage - where images and segmaps are read from, for datasets on
+                 NFS or behind an HTTP server / object-store gateway: a
+                 backend from storage.py, the base URL of an HTTP server
+                 serving the dataset root, or a local directory; None
+                 (default) reads the local dataset root directly
+
+@param concurrency - number of files fetched at once through storage; when
+                     iterating, prefetch entries (or concurrency entries, if
+                     prefetch is 0) are fetched together, ahead of decoding.
+                     Segmaps of folders that do not exist locally are named
+                     <image name>_seg.png; parts segmaps cannot be listed
+                     there. close_storage() closes the connections
+
 get_images returns an ADESubset object that contains images that:
   
   # Include objects specified by phrase
@@ -199,32 +587,134 @@ get_images returns an ADESubset object that contains images that:
     indicates "unknown" semantic content
 
 '''
-def get_images(phrases, whitelist=None, withParts=False):
+def get_images(phrases, whitelist=None, withParts=False, cache_size=64, prefetch=0,
+               use_label_store=False, storage=None, concurrency=16):
+  label_store = get_label_store() if use_label_store else None
+  fetcher = None if storage is None else _fetcher(storage, concurrency)
 
-  # TODO:
-  # get list of filenames that match
-  # iterate over filenames, import images, construct ADESubset object
-    # REMEMBER TO USE ADEImage classmethod to construct objects from filepaths
-    # ^^ NO don't do that because imread_collection handles caching across many images better
+  # With a storage backend, the dataset folders may not exist locally, so
+  # segmap names are derived rather than listed (see PathManifest)
+  ade_index = get_index()
+  matched_rows = _query_cache.rows(_compile_phrases(phrases), ade_index)
+  filepaths = _filepaths(ade_index, matched_rows, whitelist, withParts,
+                         remote=storage is not None)
 
-  if whitelist is None:
-    img_paths, segmap_paths, folder_paths = get_filepaths(phrases, whitelist, withParts)
-    imgs = imread_collection(img_paths)
-    # This could be a problem: segmaps has sublists for images with _parts_* maps
-    # --> MAKE SURE TO TEST FOR THIS
-    segmaps = imread_collection(segmap_paths)
+  return ADESubset.ADESubset(*filepaths, cache_size=cache_size, prefetch=prefetch,
+                             label_store=label_store, fetcher=fetcher)
 
-    return ADESubset(imgs, img_paths, segmaps, segmap_paths, folder_paths)
-  else:
-    whitelisted_folder_paths = []
-    for i, folder in enumerate(folder_paths):
-      new_segmap_path, whitelisted_folder_path = _knockout_segmap(segmaps[i], folder, whitelist)
-      segmaps[i] = imread(new_segmap_path)
-      segmap_paths[i] = new_segmap_path
-      whitelisted_folder_paths.append(whitelisted_folder_path)
 
-    return ADESubset(imgs, img_paths, segmaps, segmap_paths, folder_paths, whitelisted_folder_paths)
+'''
+Writes the images that match phrases, with their segmaps, to size-bounded tar
+shards in the WebDataset layout, plus an index.json listing the shards (see
+shards.py), for training from large sequential reads
+
+Each sample's .json member records its filename, folder, scene, typeset and
+object counts (object name -> number of instances).
+
+@param phrases, whitelist, withParts - see get_images(); with a whitelist,
+                                       the whitelisted segmaps are exported
+                                       (and images without a segmap are
+                                       left out)
+@param out_dir - directory of the shards
+@param shard_kwargs - passed to shards.write_shards() (max_bytes,
+                      max_samples, shuffle, seed, max_workers, progress)
+
+@return the index written to index.json
+'''
+def export_shards(phrases, out_dir, whitelist=None, withParts=False, **shard_kwargs):
+  from . import shards
+
+  ade_index = get_index()
+  matched_rows = _query_cache.rows(_compile_phrases(phrases), ade_index)
+  if whitelist is not None:
+    # the rows _filepaths() keeps, so the metadata stays aligned with them
+    matched_rows = _rows_with_segmaps(ade_index, matched_rows)
+  filepaths = _filepaths(ade_index, matched_rows, whitelist, withParts)
+
+  object_names = ade_index.object_names()
+  scenes = ade_index.scene_index.take(matched_rows)
+  typesets = ade_index.column_values('typeset')
+  metadata = []
+  for row, scene in zip(matched_rows, scenes):
+    columns, counts = ade_index.objects_in_image(row)
+    metadata.append({'scene': scene,
+                     'typeset': typesets[row].item(),
+                     'objects': dict(zip(object_names[columns].tolist(),
+                                         counts.tolist()))})
+
+  return shards.write_shards(filepaths, out_dir, metadata=metadata, **shard_kwargs)
+
+'''
+Fetcher for storage, shared by every get_images() call with the same storage
+and concurrency, so its connections and thread pool are reused (and closed by
+close_storage())
+'''
+def _fetcher(storage, concurrency):
+  from . import storage as backends
+  with _fetchers_lock:
+    key = (storage, concurrency)
+    if key not in _fetchers:
+      backend = storage
+      if isinstance(storage, str):
+        if storage.startswith(('http://', 'https://')):
+          backend = backends.HTTPStorage(storage)
+        else:
+          backend = backends.LocalStorage(storage)
+      _fetchers[key] = backends.AsyncFetcher(backend, concurrency)
+    return _fetchers[key]
+
+'''
+Closes the connections and threads used to read files through storage
+backends by get_images() (ADESubsets returned before can no longer fetch)
+'''
+def close_storage():
+  with _fetchers_lock:
+    fetchers = list(_fetchers.values())
+    _fetchers.clear()
+  for fetcher in fetchers:
+    fetcher.close()
+
+'''
+Configures the memoization of query results used by get_filepaths() and
+get_images(). Repeated queries (including the same phrases in another order)
+are answered without scanning the presence matrix again.
+
+@param max_entries - number of query results kept in memory (0 disables it)
+@param on_disk - also save query results next to the index cache, so they
+                 are reused by later processes
+
+Rebuilding the index (refresh_csv_tables()) invalidates every result.
+'''
+def set_query_cache(max_entries=128, on_disk=False):
+  _query_cache.configure(max_entries, on_disk)
+
+'''
+@return dict with the hits, misses and size of the query result cache
+'''
+def query_cache_stats():
+  return _query_cache.stats()
+
+'''
+Turns the phrases argument of get_filepaths()/get_images() into a query
+'''
+def _compile_phrases(phrases):
+  if isinstance(phrases, query.Query):
+    return phrases
 
+  # Allow for a single tuple as input, when the tuple is not enclosed in a list
+  if isinstance(phrases, tuple):
+    _logger.debug('Converting input tuple to 1-elem list of a single tuple')
+    phrases = [phrases]
+
+  if not isinstance(phrases, list):
+    message = "Query phrases must be lists of tuples of the form " +\
+              "described in the documentation. Instead, the input phrases had" +\
+              " type " + str(type(phrases))
+    raise QueryPhrasesFormatError(message)
+
+  # Across groups, conditions are joined with AND; within a group, counts
+  # are joined with OR (sparse column sums)
+  return query.from_phrases(phrases)
 
 '''
 Same inputs as get_images(), see above for description
@@ -246,173 +736,109 @@ a list of those segmap filepaths for the entry corresponding to that image
 other graph-based data processing routine with unique image import statements)
 
 If whitelist is defined:
-  Creates ADE20K_2016_07_26/whitlelisted/folder_path/segmap within 
-  ADE20K_2016_07_26/, which contains images in with semantic content is removed
-  according to whitelist 
+  Creates ADE20K_2016_07_26/whitelisted/<whitelist hash>/folder_path/segmap
+  within ADE20K_2016_07_26/, which contains images in with semantic content is
+  removed according to whitelist (see materialize_whitelist(), which this
+  uses with its default process pool); images without a segmap are left out
+  (with a warning)
 
   Returns an additional (fourth) parameter: whitelisted_folder_paths
 
   The ith entry of whitelisted_folder_paths is the path to the folder within
-  ADE20K_2016_07_26/whitlelisted/ that contains the ith entry of image_paths
+  ADE20K_2016_07_26/whitelisted/<whitelist hash>/ that contains the segmap
+  of the ith entry of image_paths
 '''
 def get_filepaths(phrases, whitelist=None, withParts=False):
-  image_paths = []
-  segmap_paths = []
-  folder_paths = []
+  # The matched rows only depend on the query (not on whitelist or withParts),
+  # so they are memoized by its canonical form
+  ade_index = get_index()
+  matched_rows = _query_cache.rows(_compile_phrases(phrases), ade_index)
+  return _filepaths(ade_index, matched_rows, whitelist, withParts)
 
-  # Allow for a single tuple as input, when the tuple is not enclosed in a list
-  if isinstance(phrases, tuple):
-    print('Converting input tuple to 1-elem list of a single tuple')
-    phrases = [phrases]
+'''
+Batch form of get_filepaths(), for jobs that select many subsets at once: the
+queries are evaluated together in one pass over the index (see
+batchquery.py), instead of once per call
 
-  if not isinstance(phrases, list):
-    print('Input to get_filepaths is not a valid list of tuples.')
-    message = "Query phrases must be lists of tuples of the form " +\
-              "described in the documentation. Instead, the input phrases had" +\
-              " type " + str(type(phrases))
-    raise QueryPhrasesFormatError(message)
+@param queries - list whose entries are each a phrases argument of
+                 get_filepaths() (a list of (phrases, count) tuples or a query)
+@param max_workers - size of the process pool the batch is evaluated on (None
+                     uses every CPU); the default evaluates it in this process,
+                     which is fastest unless the batch is very large
+
+@return list with the return value of get_filepaths() for each query, in order
+'''
+def get_filepaths_batch(queries, whitelist=None, withParts=False, max_workers=1):
+  ade_index = get_index()
+  return [_filepaths(ade_index, matched_rows, whitelist, withParts)
+          for matched_rows in match_queries(queries, max_workers)]
+
+'''
+Rows of the image index (see get_index().image_index) selected by each query,
+evaluated together in one pass over the index (memoized results are reused)
 
-  print('Phrases is: ', phrases)
-  # phrase_group is a single string or a list of strings, group_freq is an int
-  for (phrase_group, group_freq) in phrases:
-    if not isinstance(group_freq, int):
-      print('Now skipping the condition specified by' +\
-             str((phrase_group, group_freq)) + ' because the frequency\
-             of the phrase or phrase group was not an int.')
-      continue
-
-    # convert phrase_group to a list (this does NOT handle cases that will cause errors later)
-    if isinstance(phrase_group, str):
-      phrase_group = [phrase_group]
-
-    object_cols_that_match = pd.DataFrame()
-    for p in phrase_group:
-      # get all columns that match to any phrases in the current phrase_group
-      cols_to_add = index.object_image_matrix.loc[:,\
-                    [string for string in index.object_image_matrix.columns\
-                      if p in string.split(", ")]]
-      print('cols to add is: ', cols_to_add)
-      print('p is: ', p)
-
-      object_cols_that_match = pd.concat([object_cols_that_match, cols_to_add], axis=1)
-
-    print('obj cols that match is: ', object_cols_that_match)
-    group_totals = object_cols_that_match.sum(axis=1)
-    print('group totals is: ', group_totals)
-
-    image_rows_for_this_group = group_totals.loc[group_totals >= group_freq]
-
-    image_paths_for_this_group = []
-    folder_paths_for_this_group = []
-    for ind, item in image_rows_for_this_group.iteritems():
-      imagepath = index.image_index.loc[ind, 'filename']
-      folderpath = index.image_index.loc[ind, 'folder']
-      # if imagepath == 'ADE_train_00002222.jpg':
-      #   print(folderpath)
-      #   return
-      
-      image_paths_for_this_group.append(imagepath)
-      folder_paths_for_this_group.append(folderpath)
-
-    # print('img paths for this group: ', image_paths_for_this_group, type(image_paths_for_this_group))
-
-    # Empty sets/lists are false
-    # if not bool(folder_paths):
-    #   folder_paths = set(image_paths_for_this_group)
-    # else:
-    #   # Across groups, conditions are joined with AND --> set intersection
-    #   folder_paths = folder_paths.intersection(set(image_paths_for_this_group))
-    if not bool(image_paths):
-      image_paths = image_paths_for_this_group
-      image_paths_check = set(image_paths_for_this_group)
-      folder_paths = folder_paths_for_this_group
-    else:
-      # Across groups, conditions are joined with AND --> set intersection
-      # This is an array of booleans:
-      indices_of_matched_imgs = np.isin(image_paths, image_paths_for_this_group)
-      # with open("result.txt", "w") as output:
-      #   output.write('Existing paths:\n')
-      #   for i in image_paths_check:
-      #     output.write(i + '\n')
-
-      #   output.write('New group:\n')
-      #   for i in image_paths_for_this_group:
-      #     output.write(i + '\n')
-
-      #   output.write('Matching indices:\n')
-      #   for i in indices_of_matched_imgs:
-      #     output.write(str(i) + '\n')
-      num_matches = np.sum(indices_of_matched_imgs)
-      print('num matches is ', num_matches)
-                                                # must cast image_paths to a list for isin to work right
-      # Logical indexing:
-      print('image paths length is: ', len(image_paths))
-      r = input('paused for input (1/4)')
-      image_paths = list(np.array(image_paths)[indices_of_matched_imgs])
-      print('image paths length is: ', len(image_paths))
-      r = input('paused for input (2/4)')
-
-      image_paths_check = image_paths_check.intersection(set(image_paths_for_this_group))
-      print(len(image_paths))
-      print(len(image_paths_check))
-      print(image_paths_check)
-      # assert(image_paths == image_paths_check)
-
-      print('folder_paths length is: ', len(folder_paths))
-      r = input('paused for input (3/4)')
-      folder_paths_arr = np.array(folder_paths)
-      print(folder_paths_arr)
-      print(folder_paths_arr.shape)
-      print(indices_of_matched_imgs.shape)
-      for ind, elem in enumerate(indices_of_matched_imgs):
-        if elem:
-          print(ind)
-      folder_paths_matches = folder_paths_arr[indices_of_matched_imgs]
-      print(folder_paths_matches)
-      folder_paths = list(folder_paths_matches)
-      print(folder_paths)
-
-      # folder_paths = list(np.array(list(folder_paths))[indices_of_matched_imgs])
-      print('folder_paths length is: ', len(folder_paths), folder_paths)
-
-      r = input('paused for input (4/4)')
-
-      assert(image_paths != folder_paths)
-      assert(len(image_paths) == len(folder_paths))
-
-  # Get segmap paths by RegEx-ing on image paths
-  for i, path in enumerate(image_paths):
-    # Remove .jpg suffix
-    image_name = path[:-4]
-
-    seg_matches = glob.glob(join(sys.path[0], folder_paths[i], image_name + '_seg.png'))
-
-    if withParts:
-      # Sorting makes _parts_1 occur before _parts_2 in each image list
-      parts_matches = sorted(glob.glob(join(sys.path[0], folder_paths[i], image_name + '_parts_*.png')))
-      # Extending in this way assures primary segmap is always at index 0 for the given image
-      seg_matches.extend(parts_matches)
-
-    segmap_paths.append(seg_matches)
+@param queries, max_workers - see get_filepaths_batch()
+
+@return list with a read-only sorted integer array of rows for each query
+'''
+def match_queries(queries, max_workers=1):
+  from . import batchquery
+  ade_index = get_index()
+  compiled = [_compile_phrases(phrases) for phrases in queries]
+  return _query_cache.rows_many(
+    compiled, ade_index,
+    lambda batch: batchquery.evaluate(batch, ade_index, max_workers))
+
+'''
+Leaves out the rows whose image has no primary segmap (no *_seg.png was found
+next to it, e.g. an image added by update_index() without one), for work that
+reads the segmaps, and logs how many were left out
+
+@return sorted integer array of the remaining rows
+'''
+def _rows_with_segmaps(ade_index, rows):
+  rows = np.asarray(rows, dtype=np.int64)
+  has_segmap = ade_index.path_manifest.has_segmap(rows)
+  if not has_segmap.all():
+    missing = rows[~has_segmap]
+    _logger.warning('Skipping %d images without a segmap (e.g. %s)', missing.size,
+                    ade_index.column_values('filename')[missing[0]])
+  return rows[has_segmap]
+
+# get_filepaths(phrases) of the images that have a segmap
+def _segmapped_filepaths(phrases):
+  ade_index = get_index()
+  matched_rows = _query_cache.rows(_compile_phrases(phrases), ade_index)
+  return _filepaths(ade_index, _rows_with_segmaps(ade_index, matched_rows), None, False)
+
+def _filepaths(ade_index, matched_rows, whitelist, withParts, remote=False):
+  if whitelist is not None:
+    # only images with a segmap can be whitelisted
+    matched_rows = _rows_with_segmaps(ade_index, matched_rows)
+  instrument.count('query.matched_rows', len(matched_rows))
+
+  with instrument.span('paths.resolve'):
+    image_filenames = ade_index.column_values('filename')[matched_rows].tolist()
+    folder_paths = ade_index.folder_index.take(matched_rows).tolist()
+    image_paths = [join(sys.path[0], folder, filename)
+                   for folder, filename in zip(folder_paths, image_filenames)]
+
+    # Segmap paths come from the manifest built with the index (no globbing);
+    # the primary segmap is always at index 0 for the given image
+    segmap_paths = ade_index.path_manifest.segmap_paths(matched_rows, withParts, remote)
 
   if whitelist is None:
-    print('whitelist is none')
     return image_paths, segmap_paths, folder_paths
   else:
-    whitelisted_folder_paths = []
-    for i, folder in enumerate(folder_paths):
-      new_segmap_path, whitelisted_folder_path = _knockout_segmap(segmaps[i], folder, whitelist)
-      segmap_paths[i] = new_segmap_path
-      whitelisted_folder_paths.append(whitelisted_folder_path)
+    # Only the primary segmap (index 0) is whitelisted, parts maps are kept
+    new_segmap_paths, whitelisted_folder_paths = \
+      _materialize_whitelist([paths[0] for paths in segmap_paths], folder_paths,
+                             whitelist)
+    for i, new_segmap_path in enumerate(new_segmap_paths):
+      segmap_paths[i][0] = new_segmap_path
 
     return image_paths, segmap_paths, folder_paths, whitelisted_folder_paths
 
-
-  # TODO: implement this
-  # these paths will be paths to a new dataset directory 
-  #  (determine where to place this after looking closely at the default directory)
-  return image_paths, segmap_paths, folder_paths
-
 '''
 Reports which objects in the dataset will match to an input string passed
 to get_filepaths() or get_images()
@@ -435,16 +861,14 @@ NOTE: Many objects have multiple, synonymous names in the dataset. As a result,
         
 '''
 def check_object_matches(object_lookup_string):
-  matches = []
-  for ind, row in index.object_name_list.iterrows():
-      object_col_name = row['objectnames']
-      if object_lookup_string in object_col_name.split(", "):
-        matches.append(object_col_name)
+  ade_index = get_index()
+  object_names = ade_index.object_names()
+  matches = object_names[ade_index.columns_matching(object_lookup_string)].tolist()
 
   # Empty lists are false
   if not matches:
-    print(object_lookup_string + " has NO matches to object names in the dataset.")
+    _logger.info('%s has NO matches to object names in the dataset.', object_lookup_string)
   else:
-    print(object_lookup_string + " matches to THESE " + str(len(matches)) 
-          + " object names: ")
-    print(matches)
\ No newline at end of file
+    _logger.info('%s matches to THESE %d object names: %s', object_lookup_string,
+                 len(matches), matches)
+  return matches
@@ -0,0 +1,115 @@
+import numpy as np
+import os
+from collections import Counter
+
+'''
+Incremental updates of the ADEIndex
+
+New annotated folders are scanned for images (*.jpg) that have an *_atr.txt
+annotation file next to them. Each annotation line describes one object
+instance:
+
+  instance # part level # occluded # object name # raw name # "attributes"
+
+Instances with part level 0 (whole objects, not parts) are counted per object
+name, which gives the same counts as the objectPresence field of the MATLAB
+index. Names that are not in the index yet become new object columns.
+
+The result is a segment (see indexcache.py): the metadata and presence counts
+of the new rows only, appended to the index cache without rewriting it.
+
+Rows of new images get the name of their folder as scene and typeset 0 (the
+MATLAB index does not document what typeset means, so it cannot be derived).
+'''
+
+ATR_SUFFIX = '_atr.txt'
+
+'''
+@return Counter of object name -> number of whole-object instances listed in
+        an *_atr.txt file
+'''
+def parse_atr(path):
+  counts = Counter()
+  with open(path, encoding='utf-8', errors='replace') as f:
+    for line in f:
+      fields = [field.strip() for field in line.split('#')]
+      if len(fields) < 4 or not fields[3]:
+        continue
+      try:
+        part_level = int(fields[1])
+      except ValueError:
+        continue
+      if part_level == 0:
+        counts[fields[3]] += 1
+  return counts
+
+'''
+Lists every folder below images_root that directly holds .jpg images
+
+@return sorted list of folders, relative to root (the way the index records
+        them)
+'''
+def find_image_folders(root, images_root):
+  folders = []
+  for dirpath, dirnames, filenames in os.walk(images_root):
+    dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+    if any(name.endswith('.jpg') for name in filenames):
+      folders.append(os.path.relpath(dirpath, root).replace(os.sep, '/'))
+  return sorted(folders)
+
+'''
+@param root - directory folders are relative to
+@param folders - folders to scan, relative to root
+@param known - set of (folder, filename) pairs already in the index, skipped
+
+@return list of (filename, folder, Counter of object name -> count) for every
+        new annotated image, in folder then filename order
+'''
+def scan_folders(root, folders, known=frozenset()):
+  images = []
+  for folder in folders:
+    try:
+      names = sorted(os.listdir(os.path.join(root, folder)))
+    except (FileNotFoundError, NotADirectoryError):
+      continue
+    name_set = set(names)
+    for name in names:
+      if not name.endswith('.jpg') or (folder, name) in known:
+        continue
+      atr_name = name[:-len('.jpg')] + ATR_SUFFIX
+      if atr_name in name_set:
+        images.append((name, folder, parse_atr(os.path.join(root, folder, atr_name))))
+  return images
+
+'''
+Builds the arrays of a segment
+
+@param images - list returned by scan_folders()
+@param object_names - object names of the index (its existing columns)
+
+@return dict of name -> ndarray: the metadata columns of the new rows,
+        'objectnames' with the names of the new columns, and the presence
+        counts of the new rows in coordinate form ('presence_rows' local to the
+        segment, 'presence_columns' global)
+'''
+def build_segment(images, object_names):
+  columns = {name: col for col, name in enumerate(object_names)}
+  new_names = []
+  rows, cols, counts = [], [], []
+  for row, (filename, folder, object_counts) in enumerate(images):
+    for name, count in object_counts.items():
+      if name not in columns:
+        columns[name] = len(columns)
+        new_names.append(name)
+      rows.append(row)
+      cols.append(columns[name])
+      counts.append(count)
+
+  return {'filename': np.array([image[0] for image in images], dtype=str),
+          'folder': np.array([image[1] for image in images], dtype=str),
+          'typeset': np.zeros(len(images)),
+          'scene': np.array([os.path.basename(image[1]) for image in images], dtype=str),
+          'objectnames': np.array(new_names, dtype=str),
+          'presence_rows': np.array(rows, dtype=np.int64),
+          'presence_columns': np.array(cols, dtype=np.int64),
+          'presence_counts': np.array(counts, dtype=np.int64)}
@@ -0,0 +1,238 @@
+import numpy as np
+import contextlib
+import hashlib
+import json
+import os
+import time
+import uuid
+from . import batchio
+
+'''
+Binary on-disk format for ADEIndex
+
+Every array of the index is stored as its own .npy file so that it can be
+memory-mapped on load (no parsing, no copy). A manifest.json file next to the
+arrays records the format version and a fingerprint of the MATLAB index the
+arrays were built from, and a random build id that changes every time the
+cache is written (derived data, such as memoized query results, is keyed by
+it). A cache whose version or fingerprint does not match is treated as missing
+and gets rebuilt.
+
+Rows added to the index after it was built (see incremental.py) are stored as
+segments: one subdirectory of .npy files per update, listed in the manifest in
+the order they were added. Appending a segment leaves the existing arrays
+untouched, only the manifest (and its build id) is rewritten. The manifest is
+read, changed and written back while holding a lock file (see
+manifest_lock()), so processes appending at the same time never drop each
+other's segments.
+'''
+
+CACHE_FORMAT_VERSION = 6
+MANIFEST_FILENAME = 'manifest.json'
+SEGMENTS_DIRNAME = 'segments'
+LOCK_SUFFIX = '.lock'
+
+def _file_sha1(path, block_size=1 << 20):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def _source_fingerprint(source_path):
+  st = os.stat(source_path)
+  return {'mtime_ns': st.st_mtime_ns,
+          'size': st.st_size,
+          'sha1': _file_sha1(source_path)}
+
+def read_manifest(folder):
+  try:
+    with open(os.path.join(folder, MANIFEST_FILENAME)) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def _write_manifest(folder, manifest):
+  def write_manifest(tmp_path):
+    with open(tmp_path, 'w') as f:
+      json.dump(manifest, f, indent=1, sort_keys=True)
+  batchio.atomic_write(os.path.join(folder, MANIFEST_FILENAME), write_manifest)
+
+'''
+Holds the lock of the manifest of the cache in folder, for a read-modify-write
+of the manifest
+
+The lock is a file created exclusively next to folder (not inside it, so it
+outlives save() replacing the folder). A lock file older than stale_seconds
+was left behind by a process that died, and is broken.
+
+@param timeout - seconds to wait for the lock (0 tries once)
+
+@raise TimeoutError if the lock is still held after timeout seconds
+'''
+@contextlib.contextmanager
+def manifest_lock(folder, timeout=60, stale_seconds=600):
+  lock_path = folder + LOCK_SUFFIX
+  deadline = time.monotonic() + timeout
+  while True:
+    try:
+      os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+      break
+    except FileExistsError:
+      pass
+    try:
+      if time.time() - os.stat(lock_path).st_mtime > stale_seconds:
+        os.remove(lock_path)
+        continue
+    except FileNotFoundError:
+      continue
+    if time.monotonic() >= deadline:
+      raise TimeoutError('The index cache lock ' + lock_path + ' is held by another process')
+    time.sleep(0.01)
+
+  try:
+    yield
+  finally:
+    try:
+      os.remove(lock_path)
+    except FileNotFoundError:
+      pass
+
+'''
+Checks the manifest's source fingerprint against the MATLAB index on disk.
+
+The cheap checks (size, then mtime) run first; the file is only hashed when
+its size matches but its mtime changed (e.g. after a copy or a touch). In that
+case a matching hash refreshes the recorded mtime so later loads stay cheap.
+
+If the MATLAB index has been deleted, the cache is the only copy of the index
+and is accepted as is.
+'''
+def _source_matches(folder, manifest, source_path):
+  if not os.path.exists(source_path):
+    return True
+
+  recorded = manifest.get('source') or {}
+  st = os.stat(source_path)
+  if st.st_size != recorded.get('size'):
+    return False
+  if st.st_mtime_ns == recorded.get('mtime_ns'):
+    return True
+  if _file_sha1(source_path) != recorded.get('sha1'):
+    return False
+
+  # Best effort: skipped when the manifest is being changed right now, and
+  # only written if it is still the manifest that was checked
+  try:
+    with manifest_lock(folder, timeout=0):
+      current = read_manifest(folder)
+      if current is not None and current.get('build_id') == manifest.get('build_id'):
+        current['source']['mtime_ns'] = st.st_mtime_ns
+        _write_manifest(folder, current)
+  except OSError:
+    pass
+  return True
+
+'''
+@param folder - cache directory written by save()
+@param source_path - path to the index_ade20k.mat the cache must match
+@param mmap_mode - passed to np.load; 'r' gives read-only, zero-copy arrays
+
+@return dict of array name -> ndarray, or None if the cache is missing, was
+        written by another format version, or is stale
+'''
+def load(folder, source_path, mmap_mode='r'):
+  manifest = read_manifest(folder)
+  if manifest is None or manifest.get('version') != CACHE_FORMAT_VERSION:
+    return None
+  if not _source_matches(folder, manifest, source_path):
+    return None
+
+  arrays = {}
+  for name in manifest.get('arrays', []):
+    try:
+      arrays[name] = np.load(os.path.join(folder, name + '.npy'),
+                             mmap_mode=mmap_mode, allow_pickle=False)
+    except (OSError, ValueError):
+      return None
+  return arrays
+
+'''
+Writes arrays (dict of name -> ndarray) and a manifest to folder.
+
+Everything is first written to a sibling temporary directory, which then
+replaces folder (see batchio.replace_folder()), so readers never see a
+half-written cache.
+
+@return the build id of the new cache
+'''
+def save(folder, arrays, source_path):
+  tmp_folder = batchio.make_tmp_folder(folder)
+
+  for name, arr in arrays.items():
+    np.save(os.path.join(tmp_folder, name + '.npy'), arr, allow_pickle=False)
+
+  manifest = {'version': CACHE_FORMAT_VERSION,
+              'build_id': uuid.uuid4().hex,
+              'arrays': sorted(arrays),
+              'source': _source_fingerprint(source_path)\
+                        if os.path.exists(source_path) else None}
+  _write_manifest(tmp_folder, manifest)
+  batchio.replace_folder(tmp_folder, folder)
+  return manifest['build_id']
+
+'''
+@param manifest - manifest of the cache, as read by read_manifest() (default:
+                  read it now); pass the manifest the build id was taken from,
+                  so both describe the same segments
+
+@return list with the arrays (dict of name -> ndarray) of every segment
+        appended to the cache in folder, oldest first
+'''
+def load_segments(folder, mmap_mode='r', manifest=None):
+  if manifest is None:
+    manifest = read_manifest(folder) or {}
+  segments = []
+  for segment in manifest.get('segments', []):
+    segment_folder = os.path.join(folder, SEGMENTS_DIRNAME, segment['name'])
+    segments.append({name: np.load(os.path.join(segment_folder, name + '.npy'),
+                                   mmap_mode=mmap_mode, allow_pickle=False)
+                     for name in segment['arrays']})
+  return segments
+
+'''
+@return True if the cache in folder is readable, of this format version, and
+        has build id build_id (i.e. nothing was appended or rebuilt since)
+'''
+def is_current(folder, build_id):
+  manifest = read_manifest(folder)
+  return manifest is not None and manifest.get('version') == CACHE_FORMAT_VERSION\
+         and manifest.get('build_id') == build_id
+
+'''
+Adds arrays (dict of name -> ndarray) as a new segment of the cache in folder
+
+Call it while holding manifest_lock(folder), after checking with is_current()
+that the segment was built against the current cache: segments refer to the
+object columns of the index they were built against.
+
+@return the new build id of the cache
+'''
+def append_segment(folder, arrays):
+  manifest = read_manifest(folder)
+  if manifest is None:
+    raise FileNotFoundError('The index cache in ' + folder + ' has no readable '
+                            + MANIFEST_FILENAME)
+
+  name = uuid.uuid4().hex
+  segments_folder = os.path.join(folder, SEGMENTS_DIRNAME)
+  tmp_folder = os.path.join(segments_folder, '.tmp-' + name)
+  os.makedirs(tmp_folder)
+  for array_name, arr in arrays.items():
+    np.save(os.path.join(tmp_folder, array_name + '.npy'), arr, allow_pickle=False)
+  os.replace(tmp_folder, os.path.join(segments_folder, name))
+
+  manifest.setdefault('segments', []).append({'name': name, 'arrays': sorted(arrays)})
+  manifest['build_id'] = uuid.uuid4().hex
+  _write_manifest(folder, manifest)
+  return manifest['build_id']
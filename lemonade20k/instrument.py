@@ -0,0 +1,120 @@
+import contextlib
+import logging
+import threading
+import time
+
+'''
+Timing spans and counters for the query pipeline
+
+The package reports what it does through the standard logging module (loggers
+below 'lemonade20k'): progress messages at INFO, and every span and counter
+at DEBUG on the 'lemonade20k.instrument' logger. Nothing is printed and
+nothing waits for input, so batch jobs stay quiet unless logging is configured,
+e.g.
+
+  logging.basicConfig(level=logging.INFO)
+
+For numbers rather than log lines, enable_stats() installs a StatsCollector
+that aggregates every span (count, total, min and max seconds) and counter;
+get_stats() returns a snapshot that can be scraped at any time.
+
+Spans recorded by the package:
+
+  index.load                loading or building the ADEIndex
+  query.resolve_phrases     phrases -> object columns (synonym lookup)
+  query.reduce              sparse column sums over the presence/area matrix
+  query.intersect           AND/OR of the masks of subqueries
+  paths.resolve             rows -> image and segmap paths
+  whitelist.knockout        producing whitelisted segmaps
+
+Counters: query.matched_columns, query.matched_rows,
+whitelist.segmaps_written, whitelist.segmaps_skipped.
+'''
+
+_logger = logging.getLogger(__name__)
+
+'''
+Thread-safe aggregate of spans and counters
+'''
+class StatsCollector:
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._spans = {}
+    self._counters = {}
+
+  def record_span(self, name, seconds):
+    with self._lock:
+      span = self._spans.get(name)
+      if span is None:
+        self._spans[name] = {'count': 1, 'total_s': seconds,
+                             'min_s': seconds, 'max_s': seconds}
+      else:
+        span['count'] += 1
+        span['total_s'] += seconds
+        span['min_s'] = min(span['min_s'], seconds)
+        span['max_s'] = max(span['max_s'], seconds)
+
+  def increment(self, name, n=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + n
+
+  def reset(self):
+    with self._lock:
+      self._spans.clear()
+      self._counters.clear()
+
+  '''
+  @return dict {'spans': {name: {count, total_s, min_s, max_s}},
+                'counters': {name: value}}, a copy
+  '''
+  def snapshot(self):
+    with self._lock:
+      return {'spans': {name: dict(span) for name, span in self._spans.items()},
+              'counters': dict(self._counters)}
+
+_collector = None
+
+'''
+Starts aggregating spans and counters
+
+@param collector - StatsCollector to record into (default: a new one)
+
+@return the collector
+'''
+def enable_stats(collector=None):
+  global _collector
+  _collector = collector if collector is not None else StatsCollector()
+  return _collector
+
+def disable_stats():
+  global _collector
+  _collector = None
+
+'''
+@return snapshot of the collector installed by enable_stats(), or None when
+        stats are disabled
+'''
+def get_stats():
+  collector = _collector
+  return None if collector is None else collector.snapshot()
+
+'''
+Times the enclosed block as span name
+'''
+@contextlib.contextmanager
+def span(name):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    seconds = time.perf_counter() - start
+    collector = _collector
+    if collector is not None:
+      collector.record_span(name, seconds)
+    _logger.debug('%s took %.6fs', name, seconds)
+
+def count(name, n=1):
+  collector = _collector
+  if collector is not None:
+    collector.increment(name, n)
+  _logger.debug('%s += %d', name, n)
@@ -0,0 +1,160 @@
+import numpy as np
+import logging
+import os
+import zlib
+from . import batchio
+from . import segcodes
+
+'''
+Precomputed label arrays for the segmaps of the dataset
+
+build() decodes every *_seg.png (and parts map) once, with the R/10*256 + G
+formula of segcodes.decode_object_codes(), and stores the uint16 codes in a
+single data file, one record per segmap. An index file next to it records the
+offset, size and shape of every record, keyed by the segmap path relative to
+the dataset root.
+
+Records start on 64-byte boundaries, so LabelStore.get() can return them as
+read-only views of the memory-mapped data file: no PNG decoding, and no copy.
+With compression, each record is zlib-compressed on its own (smaller on disk,
+but get() then has to decompress it).
+'''
+
+_logger = logging.getLogger(__name__)
+
+LABEL_STORE_VERSION = 1
+DATA_FILENAME = 'labels.bin'
+INDEX_FILENAME = 'labels_index.npz'
+
+_ALIGNMENT = 64
+
+def _decode_chunk(paths, compress_level):
+  records = []
+  for path in paths:
+    labels = np.ascontiguousarray(segcodes.decode_object_codes(batchio.imread(path)),
+                                  dtype=np.uint16)
+    payload = labels.tobytes()
+    if compress_level:
+      payload = zlib.compress(payload, compress_level)
+    records.append((path, labels.shape, payload))
+  return records
+
+def _log_progress(done, total):
+  _logger.info('Converted %d/%d segmaps to label arrays', done, total)
+
+'''
+Decodes segmaps into a new label store in folder (replacing any store there)
+
+@param folder - directory of the store
+@param segmap_paths - complete paths of the *_seg.png / *_parts_*.png files
+@param root - directory that store keys are relative to (the dataset root)
+@param compress - zlib level (1-9) applied to every record, or 0 to store them
+                  uncompressed and memory-mappable
+@param max_workers - size of the process pool decoding the PNGs (None uses
+                     every CPU; 1 decodes in the calling process)
+@param chunksize - number of segmaps handed to a worker at a time
+@param progress - callable(done, total) called after each chunk, or None
+
+@return LabelStore over the new store
+'''
+def build(folder, segmap_paths, root, compress=0, max_workers=None, chunksize=64,
+          progress=_log_progress):
+  segmap_paths = list(dict.fromkeys(segmap_paths))
+  chunks = batchio.chunked(segmap_paths, chunksize)
+  tmp_folder = batchio.make_tmp_folder(folder)
+
+  keys, offsets, nbytes, shapes = [], [], [], []
+  offset = done = 0
+  with open(os.path.join(tmp_folder, DATA_FILENAME), 'wb') as f:
+    # Records are written in the order chunks finish; the index keeps track
+    for i, records in batchio.run_chunks(_decode_chunk, chunks, (compress,), max_workers):
+      for path, shape, payload in records:
+        offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+        f.seek(offset)
+        f.write(payload)
+        keys.append(os.path.relpath(path, root))
+        offsets.append(offset)
+        nbytes.append(len(payload))
+        shapes.append(shape)
+        offset += len(payload)
+      done += len(records)
+      if progress is not None:
+        progress(done, len(segmap_paths))
+
+  np.savez(os.path.join(tmp_folder, INDEX_FILENAME),
+           version=LABEL_STORE_VERSION,
+           compression=compress,
+           keys=np.array(keys, dtype=str),
+           offsets=np.array(offsets, dtype=np.int64),
+           nbytes=np.array(nbytes, dtype=np.int64),
+           shapes=np.array(shapes, dtype=np.int64).reshape(-1, 2))
+
+  batchio.replace_folder(tmp_folder, folder)
+  return LabelStore(folder, root)
+
+'''
+@return LabelStore over the store in folder, or None if there is none (or it
+        was written by another version of this module)
+'''
+def load(folder, root):
+  try:
+    return LabelStore(folder, root)
+  except (OSError, ValueError, KeyError):
+    return None
+
+'''
+Read-only access to a store written by build()
+
+@param folder - directory of the store
+@param root - directory the store keys are relative to
+'''
+class LabelStore:
+  def __init__(self, folder, root):
+    self.folder = folder
+    self.root = root
+    with np.load(os.path.join(folder, INDEX_FILENAME), allow_pickle=False) as index:
+      if int(index['version']) != LABEL_STORE_VERSION:
+        raise ValueError('Label store ' + folder + ' has version '
+                         + str(int(index['version'])))
+      self.compression = int(index['compression'])
+      self._offsets = index['offsets']
+      self._nbytes = index['nbytes']
+      self._shapes = index['shapes']
+      self._rows = {key: row for row, key in enumerate(index['keys'].tolist())}
+    self._data = None
+
+  # The memory map is reopened in each process instead of being pickled
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['_data'] = None
+    return state
+
+  def _key(self, segmap_path):
+    return os.path.relpath(segmap_path, self.root)
+
+  def __len__(self):
+    return len(self._rows)
+
+  def __contains__(self, segmap_path):
+    return self._key(segmap_path) in self._rows
+
+  '''
+  @param segmap_path - complete path of a segmap PNG that was converted
+
+  @return H x W uint16 array of object codes (see segcodes); a read-only view
+          of the store unless it is compressed
+
+  Raises KeyError for segmaps that are not in the store.
+  '''
+  def get(self, segmap_path):
+    row = self._rows[self._key(segmap_path)]
+    if self._data is None:
+      self._data = np.memmap(os.path.join(self.folder, DATA_FILENAME),
+                             dtype=np.uint8, mode='r')
+
+    start = self._offsets[row]
+    raw = self._data[start:start + self._nbytes[row]]
+    shape = tuple(self._shapes[row])
+    if self.compression:
+      return np.frombuffer(zlib.decompress(raw), dtype=np.uint16).reshape(shape)
+    return raw.view(np.uint16).reshape(shape)
@@ -0,0 +1,156 @@
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import batchio
+from . import segcodes
+
+'''
+Framework-agnostic batched loader
+
+BatchLoader turns an ADESubset (or the lists returned by get_filepaths()) into
+fixed-size NumPy batches of (images, label maps), ready to be handed to
+TF/Torch. Decoding, resizing and cropping happen on a pool of worker threads,
+and a fixed number of batches is kept in flight ahead of the consumer.
+
+Label maps are the decoded object codes of the primary segmap (see segcodes),
+or the labels themselves for whitelisted segmaps (single channel PNGs). Segmaps
+found in a label store (see labelstore.py) are read from it, already decoded.
+'''
+
+'''
+@param source - an ADESubset, or the tuple returned by get_filepaths()
+                (image_paths, segmap_paths, ...)
+@param batch_size - number of images per batch
+@param shuffle - visit images in a random order, reshuffled every epoch
+@param seed - seed of the shuffling and random crops; with the same seed and
+              epoch (see set_epoch()), batches are identical across runs
+@param num_workers - number of decoding threads
+@param prefetch_batches - number of batches decoded ahead of the consumer: at
+                          most this many (and at least one) are in flight
+@param size - (height, width) every image and label map is resized to
+              (bilinear for images, nearest neighbour for labels), or None
+@param crop - (height, width) crop taken after resizing, or None
+@param random_crop - take crops at random positions instead of the center
+@param drop_last - drop the last batch if it has fewer than batch_size images
+@param label_store - LabelStore to read label maps from (default: the label
+                     store of source, if it is an ADESubset that has one)
+
+Without size or crop, all images of a batch must already share a shape.
+'''
+class BatchLoader:
+  def __init__(self, source, batch_size, shuffle=False, seed=0, num_workers=4,
+               prefetch_batches=2, size=None, crop=None, random_crop=False,
+               drop_last=False, label_store=None):
+    if label_store is None:
+      label_store = getattr(source, 'label_store', None)
+    self.label_store = label_store
+
+    if hasattr(source, 'img_paths'):
+      image_paths, segmap_paths = source.img_paths, source.segmap_paths
+    else:
+      image_paths, segmap_paths = source[0], source[1]
+
+    self.image_paths = list(image_paths)
+    # only the primary segmap of each image is used
+    self.segmap_paths = [paths if isinstance(paths, str) else paths[0]
+                         for paths in segmap_paths]
+
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.seed = seed
+    self.num_workers = num_workers
+    self.prefetch_batches = prefetch_batches
+    self.size = size
+    self.crop = crop
+    self.random_crop = random_crop
+    self.drop_last = drop_last
+    self.epoch = 0
+
+  '''
+  Selects the shuffling order (and crop positions) of the next iterations
+  '''
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def __len__(self):
+    if self.drop_last:
+      return len(self.image_paths) // self.batch_size
+    return -(-len(self.image_paths) // self.batch_size)
+
+  def _batch_indices(self):
+    order = np.arange(len(self.image_paths))
+    if self.shuffle:
+      order = np.random.default_rng([self.seed, self.epoch]).permutation(order)
+    return [order[start:start + self.batch_size]
+            for start in range(0, len(self) * self.batch_size, self.batch_size)]
+
+  def _load_sample(self, i):
+    # skimage is slow to import (see batchio.py)
+    from skimage.transform import resize
+
+    image = batchio.imread(self.image_paths[i])
+    if image.ndim == 2:
+      image = np.stack([image] * 3, axis=-1)
+    image = image[:, :, :3]
+
+    segmap_path = self.segmap_paths[i]
+    if self.label_store is not None and segmap_path in self.label_store:
+      labels = self.label_store.get(segmap_path)
+    else:
+      segmap = batchio.imread(segmap_path)
+      labels = segcodes.decode_object_codes(segmap) if segmap.ndim == 3 else segmap
+
+    if self.size is not None:
+      image = resize(image, self.size, order=1, preserve_range=True,
+                     anti_aliasing=True).astype(np.uint8)
+      labels = resize(labels, self.size, order=0, preserve_range=True,
+                      anti_aliasing=False).astype(labels.dtype)
+
+    if self.crop is not None:
+      crop_h, crop_w = self.crop
+      h, w = labels.shape
+      if crop_h > h or crop_w > w:
+        raise ValueError('Crop ' + str(self.crop) + ' is larger than image '
+                         + self.image_paths[i] + ' ' + str((h, w)))
+      if self.random_crop:
+        rng = np.random.default_rng([self.seed, self.epoch, i])
+        top, left = rng.integers(h - crop_h + 1), rng.integers(w - crop_w + 1)
+      else:
+        top, left = (h - crop_h) // 2, (w - crop_w) // 2
+      image = image[top:top + crop_h, left:left + crop_w]
+      labels = labels[top:top + crop_h, left:left + crop_w]
+
+    return image, labels
+
+  def _collate(self, samples, indices):
+    shapes = set(labels.shape for image, labels in samples)
+    if len(shapes) > 1:
+      raise ValueError('Images ' + str(list(indices)) + ' have different shapes '
+                       + str(sorted(shapes)) + '; pass size and/or crop to '
+                       + 'BatchLoader to batch them')
+    return (np.stack([image for image, labels in samples]),
+            np.stack([labels for image, labels in samples]))
+
+  '''
+  Yields (images, labels) batches: images is B x H x W x 3 uint8, labels is
+  B x H x W
+  '''
+  def __iter__(self):
+    batches = self._batch_indices()
+    executor = ThreadPoolExecutor(max_workers=max(1, self.num_workers))
+    try:
+      pending = deque()
+      next_batch = 0
+      while True:
+        while next_batch < len(batches) and len(pending) < max(1, self.prefetch_batches):
+          indices = batches[next_batch]
+          pending.append((indices, [executor.submit(self._load_sample, i)
+                                    for i in indices]))
+          next_batch += 1
+        if not pending:
+          break
+
+        indices, futures = pending.popleft()
+        yield self._collate([future.result() for future in futures], indices)
+    finally:
+      executor.shutdown(wait=True)
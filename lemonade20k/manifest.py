@@ -0,0 +1,209 @@
+import numpy as np
+import os
+from . import batchio
+
+'''
+Manifest of the segmap files of every image in the index
+
+The folders of the index are listed once (one os.scandir per folder) when the
+index is built, and the name of each image's *_seg.png and *_parts_*.png files
+is recorded. Resolving the segmaps of a query is then a lookup, with no
+filesystem access at query time.
+
+The manifest is saved next to the index cache, along with the mtime of every
+folder. When it is loaded, folders whose mtime changed (files were added,
+removed or renamed) are listed again.
+'''
+
+MANIFEST_FILENAME = 'segmap_manifest.npz'
+
+'''
+Lists one folder of the dataset
+
+@return 2-tuple: (mtime of the folder in ns, or -1 if it does not exist,
+                  dict of image name without extension -> [seg filename or '',
+                  sorted list of parts filenames])
+'''
+def _scan_folder(root, folder):
+  path = os.path.join(root, folder)
+  try:
+    mtime_ns = os.stat(path).st_mtime_ns
+    with os.scandir(path) as entries:
+      names = [entry.name for entry in entries]
+  except (FileNotFoundError, NotADirectoryError):
+    return -1, {}
+
+  segmaps = {}
+  for name in names:
+    if name.endswith('_seg.png'):
+      segmaps.setdefault(name[:-len('_seg.png')], ['', []])[0] = name
+    elif name.endswith('.png') and '_parts_' in name:
+      segmaps.setdefault(name[:name.rindex('_parts_')], ['', []])[1].append(name)
+
+  # Sorting makes _parts_1 occur before _parts_2 in each image list
+  for seg_and_parts in segmaps.values():
+    seg_and_parts[1].sort()
+  return mtime_ns, segmaps
+
+'''
+@param root - directory the folders of the index are relative to
+@param filenames - image filename of every row of the index
+@param folders - folder of every row of the index
+
+Both are only indexed by row (arrays, or metaindex.CategoryIndex for the
+folders), and the segmap names are kept in flat arrays, so a manifest loaded
+from arrays (e.g. shared memory) creates no Python object per row.
+'''
+class PathManifest:
+  def __init__(self, root, filenames, folders, folder_mtimes, seg_names, parts_indptr,
+               parts_names):
+    self.root = root
+    self._filenames = filenames
+    self._folders = folders
+    # folder -> mtime in ns when it was listed (-1 if it was missing)
+    self.folder_mtimes = folder_mtimes
+    # per row of the index: seg filename ('' if none); parts filenames of row
+    # i are parts_names[parts_indptr[i]:parts_indptr[i + 1]]
+    self._seg_names = seg_names
+    self._parts_indptr = parts_indptr
+    self._parts_names = parts_names
+
+  @classmethod
+  def build(cls, root, filenames, folders):
+    manifest = cls(root, filenames, folders, {}, np.full(len(filenames), '', dtype=str),
+                   np.zeros(len(filenames) + 1, dtype=np.int64), np.array([], dtype=str))
+    manifest._rescan(set(folders))
+    return manifest
+
+  '''
+  @return the manifest saved at path, or None if there is none or it does not
+          match the rows of the index
+  '''
+  @classmethod
+  def load(cls, path, root, filenames, folders):
+    try:
+      with np.load(path, allow_pickle=False) as arrays:
+        arrays = dict(arrays)
+    except (OSError, ValueError):
+      return None
+    return cls.from_arrays(arrays, root, filenames, folders)
+
+  '''
+  Inverse of to_arrays(), or None if the arrays do not match the rows of the
+  index
+
+  Arrays saved before rows were appended to the index (see incremental.py)
+  still match: the folders of the appended rows are marked as never listed,
+  so the next refresh() lists them.
+  '''
+  @classmethod
+  def from_arrays(cls, arrays, root, filenames, folders):
+    num_saved = arrays['seg'].size
+    num_rows = len(filenames)
+    if num_saved > num_rows:
+      return None
+
+    seg_names, parts_indptr = arrays['seg'], arrays['parts_indptr']
+    folder_mtimes = dict(zip(arrays['folders'].tolist(), arrays['folder_mtimes'].tolist()))
+    if num_saved < num_rows:
+      seg_names = np.concatenate([seg_names, np.full(num_rows - num_saved, '', dtype=str)])
+      parts_indptr = np.concatenate(
+        [parts_indptr, np.full(num_rows - num_saved, parts_indptr[-1])])
+      for folder in set(folders[num_saved:]):
+        folder_mtimes.pop(folder, None)
+    return cls(root, filenames, folders, folder_mtimes, seg_names, parts_indptr,
+               arrays['parts'])
+
+  '''
+  @return dict of name -> array holding the whole manifest (filenames and
+          folders of the images excepted, they come from the index)
+  '''
+  def to_arrays(self):
+    return {'folders': np.array(list(self.folder_mtimes), dtype=str),
+            'folder_mtimes': np.array(list(self.folder_mtimes.values()), dtype=np.int64),
+            'seg': np.asarray(self._seg_names, dtype=str),
+            'parts_indptr': np.asarray(self._parts_indptr, dtype=np.int64),
+            'parts': np.asarray(self._parts_names, dtype=str)}
+
+  def save(self, path):
+    batchio.atomic_write(path, lambda tmp_path: np.savez(tmp_path, **self.to_arrays()))
+
+  def _parts(self, row):
+    return self._parts_names[self._parts_indptr[row]:self._parts_indptr[row + 1]].tolist()
+
+  def _rescan(self, folders):
+    rows_by_folder = {}
+    for row, folder in enumerate(self._folders):
+      if folder in folders:
+        rows_by_folder.setdefault(folder, []).append(row)
+    if not rows_by_folder:
+      return
+
+    seg_names = self._seg_names.tolist()
+    parts_names = [self._parts(row) for row in range(len(seg_names))]
+    for folder, rows in rows_by_folder.items():
+      mtime_ns, segmaps = _scan_folder(self.root, folder)
+      self.folder_mtimes[folder] = mtime_ns
+      for row in rows:
+        seg_name, parts = segmaps.get(self._filenames[row][:-4], ('', []))
+        seg_names[row] = seg_name
+        parts_names[row] = list(parts)
+
+    lengths = [len(parts) for parts in parts_names]
+    self._seg_names = np.array(seg_names, dtype=str)
+    self._parts_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    self._parts_names = np.array([name for parts in parts_names for name in parts],
+                                 dtype=str)
+
+  '''
+  Lists again every folder whose mtime changed since it was last listed
+
+  @return list of the folders that were listed again
+  '''
+  def refresh(self):
+    changed = []
+    for folder in set(self._folders):
+      try:
+        mtime_ns = os.stat(os.path.join(self.root, folder)).st_mtime_ns
+      except (FileNotFoundError, NotADirectoryError):
+        mtime_ns = -1
+      if mtime_ns != self.folder_mtimes.get(folder):
+        changed.append(folder)
+
+    if changed:
+      self._rescan(set(changed))
+    return changed
+
+  '''
+  @return boolean array, True for the rows whose image has a primary segmap
+  '''
+  def has_segmap(self, rows):
+    return self._seg_names[np.asarray(rows, dtype=np.intp)] != ''
+
+  '''
+  @param rows - rows of the index
+  @param withParts - also list each image's parts segmaps
+  @param remote - the files are read through a storage backend (see
+                  storage.py): for images whose folder does not exist
+                  locally, the primary segmap is named by the dataset
+                  convention (<image name>_seg.png) instead of being listed
+
+  @return list with, for each row, the list of complete paths to its segmaps
+          (primary segmap first, then the parts segmaps if withParts)
+  '''
+  def segmap_paths(self, rows, withParts=False, remote=False):
+    paths = []
+    for row in rows:
+      folder = os.path.join(self.root, self._folders[row])
+      seg_name = str(self._seg_names[row])
+      names = [seg_name] if seg_name else []
+      if remote and self.folder_mtimes.get(self._folders[row]) == -1:
+        if withParts:
+          raise ValueError('The parts segmaps of ' + self._filenames[row] + ' cannot '
+                           + 'be listed: its folder ' + self._folders[row] + ' only '
+                           + 'exists behind the storage backend (pass withParts=False)')
+        names = [self._filenames[row][:-4] + '_seg.png']
+      elif withParts:
+        names = names + self._parts(row)
+      paths.append([os.path.join(folder, name) for name in names])
+    return paths
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+'''
+Secondary indexes over the categorical metadata columns of the image index
+
+The folder and scene columns of ADEIndex.image_index are pandas categoricals:
+each row holds a small integer code into the sorted list of distinct values.
+A CategoryIndex groups the rows by code once, so the rows of a scene (or of
+every folder below a prefix) are found by looking at the few hundred distinct
+values instead of comparing a string per image.
+'''
+
+'''
+@param column - categorical pandas Series (a column of the image index)
+
+Also a read-only sequence of the value of every row (index.folder_index[row]).
+'''
+class CategoryIndex:
+  def __init__(self, column):
+    self._init(column.cat.codes.to_numpy(), column.cat.categories)
+
+  '''
+  Index over the codes and categories of a categorical column, as stored in
+  the index cache (the codes array is used as is, e.g. memory-mapped)
+  '''
+  @classmethod
+  def from_codes(cls, codes, categories):
+    index = cls.__new__(cls)
+    index._init(codes, pd.Index(categories.astype(object)))
+    return index
+
+  def _init(self, codes, categories):
+    self.categories = categories
+    self._codes = codes
+    self._values = np.append(categories.to_numpy(dtype=object), None)
+    # rows grouped by code, built on the first lookup
+    self._rows = None
+    self._indptr = None
+
+  def _group_rows(self):
+    codes = self._codes
+    # rows sorted by code (stable, so rows stay in order within a code);
+    # rows without a value (code -1) come first and are left out
+    rows = np.argsort(codes, kind='stable')
+    self._indptr = np.concatenate(
+      [[0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(self.categories)))])
+    self._rows = rows[np.count_nonzero(codes < 0):]
+
+  def _rows_for_codes(self, codes):
+    if self._rows is None:
+      self._group_rows()
+    groups = [self._rows[self._indptr[code]:self._indptr[code + 1]] for code in codes]
+    return np.sort(np.concatenate(groups + [np.array([], dtype=self._rows.dtype)]))
+
+  def __len__(self):
+    return len(self._codes)
+
+  def __getitem__(self, row):
+    if isinstance(row, slice):
+      return self.take(np.arange(len(self))[row])
+    return self._values[self._codes[row]]
+
+  def __iter__(self):
+    return iter(self.take(np.arange(len(self))))
+
+  '''
+  @return sorted integer array of the rows whose value is one of values
+  '''
+  def rows_for_values(self, values):
+    codes = self.categories.get_indexer(pd.Index(list(values), dtype=object))
+    return self._rows_for_codes(codes[codes >= 0])
+
+  '''
+  @return sorted integer array of the rows whose value starts with prefix
+  '''
+  def rows_with_prefix(self, prefix):
+    codes = np.flatnonzero(self.categories.str.startswith(prefix))
+    return self._rows_for_codes(codes)
+
+  '''
+  Values of the given rows, gathered through their codes (no per-row lookup)
+
+  @return object array of values (None for rows without one)
+  '''
+  def take(self, rows):
+    return self._values[self._codes[rows]]
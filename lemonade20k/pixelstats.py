@@ -0,0 +1,115 @@
+import numpy as np
+import scipy.sparse as sp
+import logging
+import uuid
+from . import batchio
+from . import segcodes
+
+'''
+Per-image pixel area of every object
+
+build() decodes the primary segmap of every image once (or reads it from a
+label store, see labelstore.py) and counts the pixels of each object code with
+a single np.bincount. The result is a sparse images x objects matrix aligned
+with the presence matrix of the ADEIndex, plus the pixel count of every image,
+so area conditions (e.g. "wall covers at least 30% of the image") are column
+sums at query time, with no image I/O.
+
+The areas are saved with the index cache and tagged with its build id, so they
+are dropped whenever the index is rebuilt.
+'''
+
+_logger = logging.getLogger(__name__)
+
+AREAS_FILENAME = 'object_areas.npz'
+
+def _areas_chunk(tasks, num_objects, label_store):
+  rows, cols, counts = [], [], []
+  pixels = []
+  for row, segmap_path in tasks:
+    if label_store is not None and segmap_path in label_store:
+      codes = label_store.get(segmap_path)
+    else:
+      codes = segcodes.decode_object_codes(batchio.imread(segmap_path))
+
+    # code c is object column c - 1; code 0 ("unknown") has no column
+    code_counts = np.bincount(codes.ravel(), minlength=num_objects + 1)[1:num_objects + 1]
+    present = np.flatnonzero(code_counts)
+    rows.append(np.full(present.size, row, dtype=np.int64))
+    cols.append(present)
+    counts.append(code_counts[present])
+    pixels.append((row, codes.size))
+  return rows, cols, counts, pixels
+
+def _log_progress(done, total):
+  _logger.info('Measured object areas in %d/%d segmaps', done, total)
+
+'''
+@param segmap_paths - primary segmap path of every row of the index ('' or
+                      None for images without one, which get no areas)
+@param num_objects - number of object columns of the index
+@param label_store - LabelStore to read predecoded segmaps from, or None
+@param max_workers - size of the process pool (None uses every CPU; 1 works in
+                     the calling process)
+@param chunksize - number of segmaps handed to a worker at a time
+@param progress - callable(done, total) called after each chunk, or None
+
+@return 2-tuple: (CSC images x objects matrix of pixel areas,
+                  int64 array of the pixel count of every image, 0 without a
+                  segmap)
+'''
+def build(segmap_paths, num_objects, label_store=None, max_workers=None, chunksize=64,
+          progress=_log_progress):
+  tasks = [(row, path) for row, path in enumerate(segmap_paths) if path]
+  chunks = batchio.chunked(tasks, chunksize)
+
+  rows, cols, counts = [], [], []
+  pixels = np.zeros(len(segmap_paths), dtype=np.int64)
+  done = 0
+  results = batchio.run_chunks(_areas_chunk, chunks, (num_objects, label_store), max_workers)
+  for i, (chunk_rows, chunk_cols, chunk_counts, chunk_pixels) in results:
+    rows += chunk_rows
+    cols += chunk_cols
+    counts += chunk_counts
+    for row, size in chunk_pixels:
+      pixels[row] = size
+    done += len(chunk_pixels)
+    if progress is not None:
+      progress(done, len(tasks))
+
+  empty = [np.array([], dtype=np.int64)]
+  counts = np.concatenate(counts + empty)
+  areas = sp.csc_matrix((counts.astype(np.min_scalar_type(int(counts.max(initial=0)))),
+                         (np.concatenate(rows + empty), np.concatenate(cols + empty))),
+                        shape=(len(segmap_paths), num_objects))
+  areas.sort_indices()
+  return areas, pixels
+
+'''
+Saves the areas with the build id of the index they were measured for, and a
+new id of their own (which memoized Area() results are keyed by)
+
+@return the id of the areas
+'''
+def save(path, areas, pixels, build_id):
+  areas_id = uuid.uuid4().hex
+  batchio.atomic_write(path, lambda tmp_path: np.savez(
+    tmp_path, build_id=str(build_id), areas_id=areas_id, shape=np.array(areas.shape),
+    data=areas.data, indices=areas.indices, indptr=areas.indptr, pixels=pixels))
+  return areas_id
+
+'''
+@return 3-tuple (areas, pixels, areas id) saved at path, or None if there is
+        none or it was computed for another build of the index
+'''
+def load(path, build_id):
+  try:
+    with np.load(path, allow_pickle=False) as arrays:
+      if str(arrays['build_id']) != str(build_id):
+        return None
+      areas = sp.csc_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                            shape=tuple(int(n) for n in arrays['shape']))
+      areas_id = str(arrays['areas_id']) if 'areas_id' in arrays.files else None
+      return areas, arrays['pixels'], areas_id
+  except (OSError, ValueError, KeyError):
+    return None
@@ -0,0 +1,292 @@
+import numpy as np
+import logging
+from . import instrument
+
+'''
+Boolean query expressions over the ADEIndex
+
+Queries are built from predicates and combined with & (AND), | (OR) and
+~ (NOT), e.g.
+
+  (Has(['car', 'truck'], 2) | Has('bus')) & ~Has('person') & Scene('street')
+
+Evaluating a query against an index gives one boolean entry per row of the
+image index (mask()) or the matching row numbers (rows()). Every predicate is
+a vectorized operation over a whole column (sparse column sums for object
+counts, array comparisons or the secondary indexes of metaindex.py for
+metadata), so nested queries cost one pass per predicate, not one per image.
+
+Queries can be passed to get_filepaths() and get_images() in place of the list
+of (phrases, count) tuples.
+'''
+
+_logger = logging.getLogger(__name__)
+
+class Query:
+  def __and__(self, other):
+    return And(self, other)
+
+  def __or__(self, other):
+    return Or(self, other)
+
+  def __invert__(self):
+    return Not(self)
+
+  '''
+  @return boolean array with one entry per row of ade_index.image_index
+  '''
+  def mask(self, ade_index):
+    raise NotImplementedError
+
+  '''
+  @return sorted integer array of the image_index rows that match
+  '''
+  def rows(self, ade_index):
+    return np.flatnonzero(self.mask(ade_index))
+
+  '''
+  Canonical, hashable form of the query: queries that always select the same
+  rows (e.g. the same phrases in another order, or AND/OR operands swapped)
+  have the same key
+  '''
+  def key(self):
+    raise NotImplementedError
+
+  '''
+  @return True if the query reads the object areas (see Area), so its rows
+          change when the areas are measured again
+  '''
+  def uses_areas(self):
+    return False
+
+'''
+Images with between min_count and max_count (inclusive) instances of the
+objects named by phrases, counted together (OR within the phrase group)
+
+@param phrases - an object name or list of object names (single synonyms)
+@param min_count - int, at least this many instances (default 1)
+@param max_count - int or None, at most this many instances
+'''
+class Has(Query):
+  def __init__(self, phrases, min_count=1, max_count=None):
+    self.phrases = [phrases] if isinstance(phrases, str) else list(phrases)
+    self.min_count = min_count
+    self.max_count = max_count
+
+  def columns(self, ade_index):
+    return _columns(ade_index, self.phrases)
+
+  def totals(self, ade_index):
+    columns = self.columns(ade_index)
+    with instrument.span('query.reduce'):
+      return np.asarray(ade_index.object_presence[:, columns].sum(axis=1)).ravel()
+
+  def mask(self, ade_index):
+    totals = self.totals(ade_index)
+    mask = totals >= self.min_count
+    if self.max_count is not None:
+      mask &= totals <= self.max_count
+    return mask
+
+  def key(self):
+    return ('has', tuple(sorted(set(self.phrases))), self.min_count, self.max_count)
+
+  def __repr__(self):
+    return 'Has(' + repr(self.phrases) + ', ' + repr(self.min_count)\
+           + ', ' + repr(self.max_count) + ')'
+
+'''
+Images where the objects named by phrases, together, cover between
+min_fraction and max_fraction (inclusive) of the pixels
+
+Areas come from the object area index (see pixelstats.py), measured once with
+index_object_areas(); evaluating the query reads no image.
+
+@param phrases - an object name or list of object names (single synonyms)
+@param min_fraction - float in [0, 1], e.g. 0.3 for at least 30% of the pixels
+@param max_fraction - float in [0, 1] or None
+'''
+class Area(Query):
+  def __init__(self, phrases, min_fraction=0.0, max_fraction=None):
+    self.phrases = [phrases] if isinstance(phrases, str) else list(phrases)
+    self.min_fraction = min_fraction
+    self.max_fraction = max_fraction
+
+  def fractions(self, ade_index):
+    if ade_index.object_areas is None:
+      raise ValueError('Object areas have not been measured yet; '
+                       + 'run index_object_areas() once first')
+    columns = _columns(ade_index, self.phrases)
+    with instrument.span('query.reduce'):
+      covered = np.asarray(ade_index.object_areas[:, columns].sum(axis=1)).ravel()
+    pixels = ade_index.pixel_totals
+    return np.divide(covered, pixels, out=np.zeros(covered.shape), where=pixels > 0)
+
+  def mask(self, ade_index):
+    fractions = self.fractions(ade_index)
+    # images without a measured segmap never match
+    mask = (ade_index.pixel_totals > 0) & (fractions >= self.min_fraction)
+    if self.max_fraction is not None:
+      mask &= fractions <= self.max_fraction
+    return mask
+
+  def key(self):
+    return ('area', tuple(sorted(set(self.phrases))), self.min_fraction, self.max_fraction)
+
+  def uses_areas(self):
+    return True
+
+  def __repr__(self):
+    return 'Area(' + repr(self.phrases) + ', ' + repr(self.min_fraction)\
+           + ', ' + repr(self.max_fraction) + ')'
+
+'''
+Images whose scene is one of scenes
+'''
+class Scene(Query):
+  def __init__(self, *scenes):
+    self.scenes = list(scenes)
+
+  def mask(self, ade_index):
+    return _rows_mask(ade_index, ade_index.scene_index.rows_for_values(self.scenes))
+
+  def key(self):
+    return ('scene', tuple(sorted(set(self.scenes))))
+
+  def __repr__(self):
+    return 'Scene(' + ', '.join(repr(s) for s in self.scenes) + ')'
+
+'''
+Images whose folder (as recorded in the index, e.g.
+'ADE20K_2016_07_26/images/training/a/abbey') starts with prefix
+'''
+class Folder(Query):
+  def __init__(self, prefix):
+    self.prefix = prefix
+
+  def mask(self, ade_index):
+    return _rows_mask(ade_index, ade_index.folder_index.rows_with_prefix(self.prefix))
+
+  def key(self):
+    return ('folder', self.prefix)
+
+  def __repr__(self):
+    return 'Folder(' + repr(self.prefix) + ')'
+
+'''
+Images whose typeset is one of values
+'''
+class Typeset(Query):
+  def __init__(self, *values):
+    self.values = list(values)
+
+  def mask(self, ade_index):
+    return np.isin(ade_index.column_values('typeset'), self.values)
+
+  def key(self):
+    return ('typeset', tuple(sorted(set(self.values))))
+
+  def __repr__(self):
+    return 'Typeset(' + ', '.join(repr(v) for v in self.values) + ')'
+
+'''
+Images matching every subquery (And() with no subqueries matches everything)
+'''
+class And(Query):
+  def __init__(self, *queries):
+    self.queries = list(queries)
+
+  def mask(self, ade_index):
+    masks = [q.mask(ade_index) for q in self.queries]
+    with instrument.span('query.intersect'):
+      mask = np.ones(ade_index.num_images_total, dtype=bool)
+      for m in masks:
+        mask &= m
+    return mask
+
+  def key(self):
+    return ('and', _sorted_keys(self.queries))
+
+  def uses_areas(self):
+    return any(q.uses_areas() for q in self.queries)
+
+  def __repr__(self):
+    return 'And(' + ', '.join(repr(q) for q in self.queries) + ')'
+
+'''
+Images matching at least one subquery (Or() with no subqueries matches nothing)
+'''
+class Or(Query):
+  def __init__(self, *queries):
+    self.queries = list(queries)
+
+  def mask(self, ade_index):
+    masks = [q.mask(ade_index) for q in self.queries]
+    with instrument.span('query.intersect'):
+      mask = np.zeros(ade_index.num_images_total, dtype=bool)
+      for m in masks:
+        mask |= m
+    return mask
+
+  def key(self):
+    return ('or', _sorted_keys(self.queries))
+
+  def uses_areas(self):
+    return any(q.uses_areas() for q in self.queries)
+
+  def __repr__(self):
+    return 'Or(' + ', '.join(repr(q) for q in self.queries) + ')'
+
+class Not(Query):
+  def __init__(self, query):
+    self.query = query
+
+  def mask(self, ade_index):
+    return ~self.query.mask(ade_index)
+
+  def key(self):
+    return ('not', self.query.key())
+
+  def uses_areas(self):
+    return self.query.uses_areas()
+
+  def __repr__(self):
+    return 'Not(' + repr(self.query) + ')'
+
+def _rows_mask(ade_index, rows):
+  mask = np.zeros(ade_index.num_images_total, dtype=bool)
+  mask[rows] = True
+  return mask
+
+def _columns(ade_index, phrases):
+  with instrument.span('query.resolve_phrases'):
+    columns = np.unique(np.concatenate(
+      [ade_index.columns_matching(p) for p in phrases]
+      + [np.array([], dtype=np.int32)]))
+  instrument.count('query.matched_columns', columns.size)
+  return columns
+
+def _sorted_keys(queries):
+  return tuple(sorted(set(q.key() for q in queries), key=repr))
+
+'''
+Compiles the list of (phrase group, minimum count) tuples accepted by
+get_filepaths() into a query: AND across groups, OR within a group.
+
+Groups whose count is not an int are skipped (with a logged warning), and a
+list without any usable group compiles to a query that matches nothing.
+'''
+def from_phrases(phrases):
+  groups = []
+  # phrase_group is a single string or a list of strings, group_freq is an int
+  for (phrase_group, group_freq) in phrases:
+    if not isinstance(group_freq, int):
+      _logger.warning('Now skipping the condition specified by %r because the '
+                      'frequency of the phrase or phrase group was not an int.',
+                      (phrase_group, group_freq))
+      continue
+    groups.append(Has(phrase_group, group_freq))
+
+  if not groups:
+    return Or()
+  return And(*groups)
@@ -0,0 +1,148 @@
+import numpy as np
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from . import batchio
+
+'''
+Memoized query results
+
+Maps the canonical key of a query (see Query.key()) to the rows of the index it
+selects. Results are kept in memory with LRU eviction, and optionally saved as
+.npy files in a queries/ folder inside the index cache, so they survive
+restarts. Keys include the build id of the index, and the on-disk results live
+inside the index cache folder, so rebuilding the index invalidates both. Keys
+of queries that read the object areas also include the id of the areas, so
+measuring them again (index_object_areas()) invalidates those results.
+'''
+
+QUERIES_DIRNAME = 'queries'
+
+'''
+@param max_entries - number of results kept in memory (0 disables the cache)
+@param on_disk - also save results next to the index cache
+'''
+class QueryCache:
+  def __init__(self, max_entries=128, on_disk=False):
+    self.max_entries = max_entries
+    self.on_disk = on_disk
+    self.hits = 0
+    self.misses = 0
+    self._results = OrderedDict()
+    self._lock = threading.Lock()
+
+  def configure(self, max_entries, on_disk):
+    with self._lock:
+      self.max_entries = max_entries
+      self.on_disk = on_disk
+      while len(self._results) > max(max_entries, 0):
+        self._results.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._results.clear()
+
+  def _key(self, query, ade_index):
+    if query.uses_areas():
+      return (ade_index.build_id, ade_index.areas_id, query.key())
+    return (ade_index.build_id, query.key())
+
+  def _disk_path(self, key, ade_index):
+    if not self.on_disk or ade_index.build_id is None:
+      return None
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(ade_index._cache_folderpath, QUERIES_DIRNAME, digest + '.npy')
+
+  def _remember(self, key, rows):
+    with self._lock:
+      self._results[key] = rows
+      self._results.move_to_end(key)
+      while len(self._results) > self.max_entries:
+        self._results.popitem(last=False)
+
+  # Memoized rows for key (None when not cached), counting the hit
+  def _lookup(self, key, ade_index):
+    with self._lock:
+      if key in self._results:
+        self._results.move_to_end(key)
+        self.hits += 1
+        return self._results[key]
+
+    disk_path = self._disk_path(key, ade_index)
+    if disk_path is not None and os.path.exists(disk_path):
+      try:
+        rows = np.load(disk_path, allow_pickle=False)
+      except (OSError, ValueError):
+        rows = None
+      if rows is not None:
+        rows.setflags(write=False)
+        self.hits += 1
+        self._remember(key, rows)
+        return rows
+    return None
+
+  def _store(self, key, rows, ade_index):
+    rows.setflags(write=False)
+    self._remember(key, rows)
+
+    disk_path = self._disk_path(key, ade_index)
+    if disk_path is not None:
+      os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+      batchio.atomic_write(disk_path,
+                           lambda tmp_path: np.save(tmp_path, rows, allow_pickle=False))
+    return rows
+
+  '''
+  @return read-only sorted array of the rows of ade_index that match query
+  '''
+  def rows(self, query, ade_index):
+    if self.max_entries <= 0 and not self.on_disk:
+      return query.rows(ade_index)
+
+    key = self._key(query, ade_index)
+    rows = self._lookup(key, ade_index)
+    if rows is not None:
+      return rows
+
+    self.misses += 1
+    return self._store(key, query.rows(ade_index), ade_index)
+
+  '''
+  rows() for many queries: memoized results are reused, and the others (each
+  distinct query once) are computed together
+
+  @param evaluate - callable(list of queries) -> list of their rows, e.g.
+                    evaluating the whole list in one pass (see batchquery.py)
+
+  @return list with the rows of each query, in order
+  '''
+  def rows_many(self, queries, ade_index, evaluate):
+    if self.max_entries <= 0 and not self.on_disk:
+      return evaluate(queries)
+
+    results = [None] * len(queries)
+    missing = {}
+    for i, query in enumerate(queries):
+      key = self._key(query, ade_index)
+      if key in missing:
+        missing[key][1].append(i)
+        continue
+      results[i] = self._lookup(key, ade_index)
+      if results[i] is None:
+        missing[key] = (query, [i])
+
+    self.misses += len(missing)
+    computed = evaluate([query for query, positions in missing.values()])
+    for (key, (query, positions)), rows in zip(missing.items(), computed):
+      rows = self._store(key, rows, ade_index)
+      for i in positions:
+        results[i] = rows
+    return results
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._results),
+            'max_entries': self.max_entries,
+            'on_disk': self.on_disk}
@@ -0,0 +1,241 @@
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from . import batchio
+from . import segcodes
+from .whitelisting import is_up_to_date
+
+'''
+Resized and tiled derived datasets
+
+Images are resized together with their label maps (the decoded object codes of
+the primary segmap, or the labels of a whitelisted segmap), then optionally
+cut into fixed-size tiles, and written once below
+ADE20K_2016_07_26/resized/<spec hash>/<folder of the image>/, so training at a
+fixed resolution reads ready-made samples instead of resizing every epoch.
+
+Images are resampled bilinearly with anti-aliasing (as BatchLoader does). Label
+maps are resampled by nearest neighbour as a pure gather of source pixels, so
+every output label is a label of the source map: classes are never blended or
+invented at region boundaries. Tiles that reach past the edge of a (small)
+image are padded with 0, the "unknown" label.
+
+Per image, outputs are
+
+  <name>.png, <name>_seg.png                 without tiling
+  <name>_t<i>.png, <name>_t<i>_seg.png       for the ith tile
+  <name>_tiles.json                          the outputs and tile boxes
+
+Label maps are single channel PNGs (uint16 object codes, or the labels of the
+whitelist), which ADESubset and BatchLoader read as labels. The .json file is
+written last: an image whose .json file is newer than its source image and
+source segmap is up to date, and is skipped without decoding anything. For
+whitelisted label maps the source segmap is the original one: the whitelisted
+copy is touched on every cache hit (see whitelisting.py), and the whitelist is
+already part of the spec (through the hash of its words and lookup table, see
+whitelisting.whitelist_hash()).
+'''
+
+_logger = logging.getLogger(__name__)
+
+SPEC_RECORD_FILENAME = 'spec.json'
+
+'''
+Parameters of a derived dataset
+
+@param size - (height, width) images are resized to, or None to keep them
+@param tile - (height, width) of the tiles cut after resizing, or None
+@param stride - (vertical, horizontal) step between tiles (default: tile,
+                i.e. no overlap); the last tile of a row or column is aligned
+                with the edge, so tiles always cover the whole image
+@param source - identifies the segmaps, e.g. the hash of their whitelist
+'''
+def make_spec(size=None, tile=None, stride=None, source=None):
+  if size is None and tile is None:
+    raise ValueError('Either size or tile is required')
+  if tile is None and stride is not None:
+    raise ValueError('stride needs tile')
+  if tile is not None and stride is None:
+    stride = tile
+  return {'size': None if size is None else [int(n) for n in size],
+          'tile': None if tile is None else [int(n) for n in tile],
+          'stride': None if stride is None else [int(n) for n in stride],
+          'source': source}
+
+def spec_hash(spec):
+  canonical = json.dumps(spec, sort_keys=True)
+  return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+'''
+Records the spec of the dataset below spec_folder, so the hashed folder names
+can be traced back to their parameters
+'''
+def write_spec_record(spec_folder, spec):
+  record_path = os.path.join(spec_folder, SPEC_RECORD_FILENAME)
+  if os.path.exists(record_path):
+    return
+  os.makedirs(spec_folder, exist_ok=True)
+  def write_record(tmp_path):
+    with open(tmp_path, 'w') as f:
+      json.dump(spec, f, sort_keys=True)
+  batchio.atomic_write(record_path, write_record)
+
+'''
+Source pixel of every output pixel along one axis, for nearest neighbour
+resampling (output pixel centers mapped onto the source grid)
+'''
+def _nearest_indices(source_length, output_length):
+  indices = ((np.arange(output_length) + 0.5) * (source_length / output_length))
+  return np.minimum(indices.astype(np.intp), source_length - 1)
+
+'''
+Resizes a label map by nearest neighbour: a gather of source pixels, so the
+output only holds labels of the source map (and keeps its dtype)
+'''
+def resize_labels(labels, size):
+  rows = _nearest_indices(labels.shape[0], size[0])
+  cols = _nearest_indices(labels.shape[1], size[1])
+  return labels[rows[:, None], cols[None, :]]
+
+def resize_image(image, size):
+  # skimage is slow to import (see batchio.py)
+  from skimage.transform import resize
+  return resize(image, size, order=1, preserve_range=True,
+                anti_aliasing=True).astype(np.uint8)
+
+def _tile_starts(length, tile, stride):
+  if length <= tile:
+    return [0]
+  starts = list(range(0, length - tile + 1, stride))
+  if starts[-1] + tile < length:
+    starts.append(length - tile)
+  return starts
+
+'''
+@return list of (top, left) corners of the tiles of an image of the given
+        shape (height, width)
+'''
+def tile_boxes(shape, tile, stride):
+  return [(top, left) for top in _tile_starts(shape[0], tile[0], stride[0])
+                      for left in _tile_starts(shape[1], tile[1], stride[1])]
+
+# Crop of array at (top, left), padded with 0 up to the tile shape
+def _crop(array, top, left, tile):
+  crop = array[top:top + tile[0], left:left + tile[1]]
+  if crop.shape[:2] == tuple(tile):
+    return crop
+  padding = [(0, tile[0] - crop.shape[0]), (0, tile[1] - crop.shape[1])]
+  return np.pad(crop, padding + [(0, 0)] * (crop.ndim - 2))
+
+def _read_sidecar(prefix):
+  with open(prefix + '_tiles.json') as f:
+    return json.load(f)
+
+'''
+Resizes and tiles a single image and its segmap, writing every output
+atomically
+
+@param prefix - output path without extension, e.g.
+                .../resized/<hash>/images/training/a/abbey/ADE_train_00000001
+@param source_path - segmap the label map derives from, whose mtime decides
+                     whether the outputs are up to date (default: segmap_path)
+
+@return 2-tuple: (the sidecar dict, with 'names': output file names without
+        extension, one per tile, 'boxes': their (top, left) corners, and
+        'shape': the resized shape; True if the outputs were written, False
+        if they were up to date)
+'''
+def resize_one(image_path, segmap_path, prefix, spec, force=False, source_path=None):
+  sidecar_path = prefix + '_tiles.json'
+  if source_path is None:
+    source_path = segmap_path
+  if not force and is_up_to_date(image_path, sidecar_path)\
+     and is_up_to_date(source_path, sidecar_path):
+    try:
+      return _read_sidecar(prefix), False
+    except (OSError, ValueError):
+      pass
+
+  image = batchio.imread(image_path)
+  if image.ndim == 2:
+    image = np.stack([image] * 3, axis=-1)
+  image = image[:, :, :3]
+  segmap = batchio.imread(segmap_path)
+  labels = segcodes.decode_object_codes(segmap) if segmap.ndim == 3 else segmap
+
+  if spec['size'] is not None:
+    image = resize_image(image, spec['size'])
+    labels = resize_labels(labels, spec['size'])
+  elif image.shape[:2] != labels.shape:
+    # keep the pixels of the two aligned
+    labels = resize_labels(labels, image.shape[:2])
+
+  if spec['tile'] is None:
+    names, boxes = [prefix], [(0, 0)]
+    samples = [(image, labels)]
+  else:
+    boxes = tile_boxes(labels.shape, spec['tile'], spec['stride'])
+    names = [prefix + '_t' + str(i) for i in range(len(boxes))]
+    samples = [(_crop(image, top, left, spec['tile']),
+                _crop(labels, top, left, spec['tile'])) for top, left in boxes]
+
+  os.makedirs(os.path.dirname(prefix), exist_ok=True)
+  for name, (tile_image, tile_labels) in zip(names, samples):
+    batchio.atomic_write(name + '.png', lambda tmp_path: batchio.imsave(tmp_path, tile_image))
+    batchio.atomic_write(name + '_seg.png',
+                         lambda tmp_path: batchio.imsave(tmp_path, tile_labels))
+
+  sidecar = {'names': [os.path.basename(name) for name in names], 'boxes': [list(box) for box in boxes],
+             'shape': list(labels.shape)}
+  def write_sidecar(tmp_path):
+    with open(tmp_path, 'w') as f:
+      json.dump(sidecar, f)
+  batchio.atomic_write(sidecar_path, write_sidecar)
+  return sidecar, True
+
+def _resize_chunk(tasks, spec, force):
+  results = []
+  for image_path, segmap_path, prefix, source_path in tasks:
+    sidecar, written = resize_one(image_path, segmap_path, prefix, spec, force, source_path)
+    folder = os.path.dirname(prefix)
+    results.append(([os.path.join(folder, name) for name in sidecar['names']], written))
+  return results
+
+def _log_progress(done, total, written, skipped):
+  _logger.info('Resized %d/%d images (%d written, %d already up to date)',
+               done, total, written, skipped)
+
+'''
+@param tasks - list of (image path, segmap path, output prefix, source segmap
+               path or None) tuples, see resize_one()
+@param spec - dict from make_spec()
+@param max_workers - size of the process pool (None uses every CPU); with
+                     max_workers=1, or when everything fits in one chunk, the
+                     work runs in the calling process
+@param chunksize - number of images handed to a worker at a time
+@param progress - callable(done, total, written, skipped), called after each
+                  chunk; None disables progress reports
+@param force - rewrite outputs even if they are up to date
+
+@return 3-tuple: (list with the output paths without extension of each task,
+        in order, number of images written, number skipped as up to date)
+'''
+def materialize(tasks, spec, max_workers=None, chunksize=16,
+                progress=_log_progress, force=False):
+  tasks = list(tasks)
+  chunks = batchio.chunked(tasks, chunksize)
+  names = [None] * len(tasks)
+  done = written = 0
+
+  for i, chunk_results in batchio.run_chunks(_resize_chunk, chunks, (spec, force),
+                                             max_workers):
+    for j, (task_names, task_written) in enumerate(chunk_results):
+      names[i * chunksize + j] = task_names
+      written += task_written
+    done += len(chunk_results)
+    if progress is not None:
+      progress(done, len(tasks), written, done - written)
+
+  return names, written, len(tasks) - written
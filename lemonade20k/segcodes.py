@@ -0,0 +1,49 @@
+import numpy as np
+
+'''
+Helpers for the ADE20K segmap encoding
+
+In a segmap PNG, the object class of each pixel is encoded in its red and
+green channels as R/10*256 + G. Code c refers to row c - 1 of the object name
+list; code 0 marks "unknown" content.
+'''
+
+# Largest code the R/10*256+G encoding can express (R = 255, G = 255)
+MAX_OBJECT_CODE = (255 // 10) * 256 + 255
+
+'''
+@param segmap - H x W x 3 (or 4) array read from a *_seg.png file
+
+@return H x W uint16 array of object codes
+'''
+def decode_object_codes(segmap):
+  r = segmap[:, :, 0].astype(np.uint16)
+  g = segmap[:, :, 1].astype(np.uint16)
+  return (r // 10) * 256 + g
+
+'''
+Builds a lookup table that maps every possible object code to a label.
+
+@param columns_per_label - list whose ith entry holds the object columns
+                           (0-based rows of the object name list) that get
+                           label i + 1. A column listed for several labels
+                           keeps the first one.
+
+@return 1-D array of length MAX_OBJECT_CODE + 1, 0 for every code that is
+        not listed (uint8 when the labels fit, uint16 otherwise)
+'''
+def build_label_lut(columns_per_label):
+  dtype = np.uint8 if len(columns_per_label) <= np.iinfo(np.uint8).max\
+          else np.uint16
+  lut = np.zeros(MAX_OBJECT_CODE + 1, dtype=dtype)
+  # Walking the labels backwards lets earlier labels overwrite later ones
+  for label in range(len(columns_per_label), 0, -1):
+    codes = np.asarray(columns_per_label[label - 1], dtype=np.intp) + 1
+    lut[codes[codes <= MAX_OBJECT_CODE]] = label
+  return lut
+
+'''
+Maps a decoded segmap to labels with a single gather (no per-object passes).
+'''
+def apply_label_lut(object_codes, lut):
+  return np.take(lut, object_codes)
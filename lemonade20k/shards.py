@@ -0,0 +1,160 @@
+import io
+import json
+import logging
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from . import batchio
+
+'''
+Sharded export of subsets, in the WebDataset layout
+
+A subset is written as a sequence of plain tar files ("shards") of bounded
+size. Each sample is stored as consecutive members sharing a key:
+
+  <key>.jpg          the image file, as is
+  <key>.seg.png      the primary segmap file, as is
+  <key>.parts_<i>.png   parts segmaps, when the subset has them
+  <key>.json         metadata (filename, folder, and anything the caller adds)
+
+so a reader streams each shard with one large sequential read instead of
+opening thousands of small files. index.json lists the shards with their
+sample counts, sizes and keys; readers shuffle at shard granularity by
+shuffling that list. Shards are written in parallel by a pool of threads
+(the work is file I/O).
+'''
+
+_logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = 'index.json'
+
+def _sample_key(image_path):
+  return os.path.splitext(os.path.basename(image_path))[0]
+
+def _sample_members(image_path, segmap_paths, metadata):
+  key = _sample_key(image_path)
+  members = [(key + os.path.splitext(image_path)[1].lower(), image_path)]
+  for i, segmap_path in enumerate(segmap_paths):
+    members.append((key + ('.seg.png' if i == 0 else '.parts_' + str(i) + '.png'),
+                    segmap_path))
+  payload = json.dumps(metadata, sort_keys=True).encode('utf-8')
+  return key, members, payload
+
+def _add_bytes(tar, name, data):
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  tar.addfile(info, io.BytesIO(data))
+
+def _write_shard(path, samples):
+  def write_tar(tmp_path):
+    with tarfile.open(tmp_path, 'w') as tar:
+      for key, members, payload in samples:
+        for name, file_path in members:
+          with open(file_path, 'rb') as f:
+            _add_bytes(tar, name, f.read())
+        _add_bytes(tar, key + '.json', payload)
+  batchio.atomic_write(path, write_tar)
+  return os.path.getsize(path)
+
+def _log_progress(done, total):
+  _logger.info('Wrote %d/%d shards', done, total)
+
+'''
+@param source - an ADESubset, or the tuple returned by get_filepaths()
+                (image_paths, segmap_paths, folder_paths, ...)
+@param out_dir - directory the shards and index.json are written to
+@param max_bytes - a shard is closed before it grows past this many bytes of
+                   sample files (a single larger sample gets its own shard)
+@param max_samples - and before it holds more than this many samples
+@param metadata - list with a JSON-serializable dict per sample, merged into
+                  its .json member, or None
+@param shuffle - write samples in a random order (fixed by seed) instead of
+                 the order of source
+@param max_workers - number of shards written at a time
+@param progress - callable(done, total) called as shards finish, or None
+
+@return the index written to index.json (a dict)
+'''
+def write_shards(source, out_dir, max_bytes=256 << 20, max_samples=None, metadata=None,
+                 shuffle=False, seed=0, max_workers=4, progress=_log_progress):
+  if hasattr(source, 'img_paths'):
+    image_paths, segmap_paths, folder_paths = \
+      source.img_paths, source.segmap_paths, source.folder_paths
+  else:
+    image_paths, segmap_paths, folder_paths = source[0], source[1], source[2]
+
+  order = np.arange(len(image_paths))
+  if shuffle:
+    order = np.random.default_rng(seed).permutation(order)
+
+  # Shards are cut from file sizes alone, before anything is read
+  shards = [[]]
+  shard_bytes = 0
+  for i in order:
+    paths = segmap_paths[i]
+    paths = [paths] if isinstance(paths, str) else list(paths)
+    sample_metadata = {'filename': os.path.basename(image_paths[i]),
+                       'folder': folder_paths[i],
+                       'segmaps': [os.path.basename(path) for path in paths]}
+    if metadata is not None:
+      sample_metadata.update(metadata[i])
+    sample = _sample_members(image_paths[i], paths, sample_metadata)
+    sample_size = sum(os.path.getsize(path) for name, path in sample[1])
+
+    if shards[-1] and (shard_bytes + sample_size > max_bytes
+                       or (max_samples is not None and len(shards[-1]) >= max_samples)):
+      shards.append([])
+      shard_bytes = 0
+    shards[-1].append(sample)
+    shard_bytes += sample_size
+  if not shards[-1]:
+    shards.pop()
+
+  os.makedirs(out_dir, exist_ok=True)
+  names = ['shard-%06d.tar' % i for i in range(len(shards))]
+  sizes = [0] * len(shards)
+  with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+    futures = {executor.submit(_write_shard, os.path.join(out_dir, name), samples): i
+               for i, (name, samples) in enumerate(zip(names, shards))}
+    for done, future in enumerate(as_completed(futures), 1):
+      sizes[futures[future]] = future.result()
+      if progress is not None:
+        progress(done, len(shards))
+
+  index = {'num_samples': int(len(order)),
+           'shards': [{'name': name,
+                       'num_samples': len(samples),
+                       'bytes': size,
+                       'keys': [key for key, members, payload in samples]}
+                      for name, samples, size in zip(names, shards, sizes)]}
+  # The index is written last, so a reader never sees a shard being written
+  def write_index(tmp_path):
+    with open(tmp_path, 'w') as f:
+      json.dump(index, f, indent=1)
+  batchio.atomic_write(os.path.join(out_dir, INDEX_FILENAME), write_index)
+  return index
+
+def read_index(out_dir):
+  with open(os.path.join(out_dir, INDEX_FILENAME)) as f:
+    return json.load(f)
+
+'''
+Streams the samples of one shard, in order, with a single sequential read
+
+@return iterator of (key, dict of member suffix -> bytes, e.g. 'jpg',
+        'seg.png'); the 'json' member is decoded to a dict
+'''
+def iter_shard(path):
+  key, sample = None, {}
+  with tarfile.open(path, 'r|') as tar:
+    for member in tar:
+      member_key, suffix = member.name.split('.', 1)
+      if member_key != key:
+        if key is not None:
+          yield key, sample
+        key, sample = member_key, {}
+      data = tar.extractfile(member).read()
+      sample[suffix] = json.loads(data) if suffix == 'json' else data
+  if key is not None:
+    yield key, sample
@@ -0,0 +1,156 @@
+import numpy as np
+import scipy.sparse as sp
+import json
+import os
+import tempfile
+import uuid
+from . import batchio
+from . import manifest
+
+'''
+Sharing one ADEIndex between many processes
+
+publish() writes every array of an index (presence matrices, synonym index,
+metadata columns, segmap manifest, object areas) once into a single
+memory-mapped file, in /dev/shm (RAM-backed shared memory) where it exists. Any process can then
+attach() to it by name: the arrays are views of the shared pages, not copies,
+so adding worker processes does not multiply the memory used by the index.
+
+The publisher owns the shared file and should release() it once the workers
+are done.
+'''
+
+# every array starts at a multiple of this many bytes
+_ALIGNMENT = 64
+_PREFIX = 'lemonade20k-index-'
+_MANIFEST_PREFIX = 'manifest_'
+_AREAS_PREFIX = 'areas_'
+
+def _default_directory():
+  return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+'''
+Picklable reference to a published index: pass it (or just its name) to the
+worker processes, which call attach() with it
+'''
+class SharedIndexHandle:
+  def __init__(self, name, directory=None):
+    self.name = name
+    self.directory = directory or _default_directory()
+
+  @property
+  def data_path(self):
+    return os.path.join(self.directory, self.name + '.bin')
+
+  @property
+  def layout_path(self):
+    return os.path.join(self.directory, self.name + '.json')
+
+  def __repr__(self):
+    return 'SharedIndexHandle(' + repr(self.name) + ', ' + repr(self.directory) + ')'
+
+def _as_handle(handle_or_name, directory):
+  if isinstance(handle_or_name, SharedIndexHandle):
+    return handle_or_name
+  return SharedIndexHandle(handle_or_name, directory)
+
+'''
+@param ade_index - the ADEIndex to share
+@param directory - where the shared file goes (default: /dev/shm, or the
+                   temporary directory on systems without it)
+
+@return SharedIndexHandle
+'''
+def publish(ade_index, directory=None):
+  arrays = dict(ade_index._to_arrays())
+  if ade_index.path_manifest is not None:
+    for name, arr in ade_index.path_manifest.to_arrays().items():
+      arrays[_MANIFEST_PREFIX + name] = arr
+  if ade_index.object_areas is not None:
+    areas = ade_index.object_areas
+    arrays.update({_AREAS_PREFIX + 'shape': np.array(areas.shape),
+                   _AREAS_PREFIX + 'data': areas.data,
+                   _AREAS_PREFIX + 'indices': areas.indices,
+                   _AREAS_PREFIX + 'indptr': areas.indptr,
+                   _AREAS_PREFIX + 'pixels': ade_index.pixel_totals})
+
+  handle = SharedIndexHandle(_PREFIX + uuid.uuid4().hex, directory)
+  layout = []
+  offset = 0
+  with open(handle.data_path, 'wb') as f:
+    for name, arr in arrays.items():
+      arr = np.ascontiguousarray(arr)
+      offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+      f.seek(offset)
+      f.write(memoryview(arr.reshape(-1)).cast('B'))
+      layout.append({'name': name, 'dtype': arr.dtype.str,
+                     'shape': list(arr.shape), 'offset': offset})
+      offset += arr.nbytes
+    # the file ends at the last aligned offset, even after empty arrays
+    f.truncate(-(-offset // _ALIGNMENT) * _ALIGNMENT)
+
+  metadata = {'layout': layout,
+              'build_id': ade_index.build_id,
+              'areas_id': ade_index.areas_id,
+              'root': ade_index.path_manifest.root
+                      if ade_index.path_manifest is not None else None}
+  def write_layout(tmp_path):
+    with open(tmp_path, 'w') as f:
+      json.dump(metadata, f)
+  # the layout appears last, so attach() never sees a half-written index
+  batchio.atomic_write(handle.layout_path, write_layout)
+  return handle
+
+'''
+@param handle_or_name - SharedIndexHandle returned by publish(), or its name
+@param directory - directory given to publish(), when attaching by name
+
+@return ADEIndex whose arrays are read-only views of the shared file
+'''
+def attach(handle_or_name, directory=None):
+  from . import ADEIndex as ind_class
+
+  handle = _as_handle(handle_or_name, directory)
+  with open(handle.layout_path) as f:
+    metadata = json.load(f)
+
+  shared = np.memmap(handle.data_path, dtype=np.uint8, mode='r')
+  arrays = {}
+  for entry in metadata['layout']:
+    dtype = np.dtype(entry['dtype'])
+    count = int(np.prod(entry['shape'], dtype=np.int64))
+    if count == 0:
+      arrays[entry['name']] = np.empty(entry['shape'], dtype=dtype)
+      continue
+    arrays[entry['name']] = np.frombuffer(shared, dtype=dtype, count=count,
+                                          offset=entry['offset'])\
+                              .reshape(entry['shape'])
+
+  manifest_arrays = {name[len(_MANIFEST_PREFIX):]: arr
+                     for name, arr in arrays.items()
+                     if name.startswith(_MANIFEST_PREFIX)}
+  ade_index = ind_class.ADEIndex.from_arrays(arrays, build_id=metadata['build_id'])
+  if manifest_arrays:
+    ade_index.path_manifest = manifest.PathManifest.from_arrays(
+      manifest_arrays, metadata['root'], ade_index.column_values('filename'),
+      ade_index.folder_index)
+  if _AREAS_PREFIX + 'data' in arrays:
+    ade_index.object_areas = sp.csc_matrix(
+      (arrays[_AREAS_PREFIX + 'data'], arrays[_AREAS_PREFIX + 'indices'],
+       arrays[_AREAS_PREFIX + 'indptr']),
+      shape=tuple(int(n) for n in arrays[_AREAS_PREFIX + 'shape']), copy=False)
+    ade_index.pixel_totals = arrays[_AREAS_PREFIX + 'pixels']
+    ade_index.areas_id = metadata.get('areas_id')
+  return ade_index
+
+'''
+Deletes the shared file. Processes still attached keep their mapping until
+they drop the index.
+'''
+def release(handle_or_name, directory=None):
+  handle = _as_handle(handle_or_name, directory)
+  for path in (handle.layout_path, handle.data_path):
+    try:
+      os.remove(path)
+    except FileNotFoundError:
+      pass
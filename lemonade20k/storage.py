@@ -0,0 +1,208 @@
+import asyncio
+import http.client
+import http.server
+import logging
+import os
+import queue
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+'''
+Pluggable storage backends for the files of the dataset
+
+Paths handed around by the package (get_filepaths(), ADESubset) are local
+paths below the dataset root (sys.path[0]). A backend maps such a path to
+where the file actually lives and returns its bytes:
+
+  LocalStorage    a local or network-mounted (NFS, ...) directory
+  HTTPStorage     an HTTP server or object-store gateway serving the same
+                  tree, over kept-alive connections
+
+AsyncFetcher pulls many files at once through a backend with asyncio:
+bounded concurrency, retries with exponential backoff on transient errors,
+and the backend's connections reused across requests. serve() starts a local
+HTTP server over a directory, which stands in for a remote server (tests,
+benchmarks).
+'''
+
+_logger = logging.getLogger(__name__)
+
+'''
+Raised for transient failures (connection errors, 5xx responses), which
+AsyncFetcher retries. Missing files raise FileNotFoundError, never retried.
+'''
+class StorageError(OSError):
+  pass
+
+'''
+@param root - directory that paths are resolved against; paths below the
+              dataset root are re-rooted here (default: the dataset root
+              itself)
+@param dataset_root - directory the paths of the package are below
+                      (default: sys.path[0])
+'''
+class LocalStorage:
+  def __init__(self, root=None, dataset_root=None):
+    self.dataset_root = dataset_root or _dataset_root()
+    self.root = root or self.dataset_root
+
+  def read(self, path):
+    with open(os.path.join(self.root, _key(path, self.dataset_root)), 'rb') as f:
+      return f.read()
+
+  def close(self):
+    pass
+
+'''
+@param base_url - URL the dataset root is served at, e.g.
+                  'http://gateway:8080/ade20k/'
+@param dataset_root - directory the paths of the package are below
+@param timeout - seconds before a request is abandoned (and retried)
+@param max_idle - number of idle connections kept open for reuse
+'''
+class HTTPStorage:
+  def __init__(self, base_url, dataset_root=None, timeout=30, max_idle=16):
+    url = urllib.parse.urlsplit(base_url)
+    if url.scheme not in ('http', 'https'):
+      raise ValueError('Unsupported URL scheme: ' + base_url)
+    self.base_url = base_url
+    self.dataset_root = dataset_root or _dataset_root()
+    self.timeout = timeout
+    self._https = url.scheme == 'https'
+    self._netloc = url.netloc
+    self._base_path = url.path.rstrip('/')
+    self._idle = queue.LifoQueue(maxsize=max_idle)
+
+  def _new_connection(self):
+    connection_class = http.client.HTTPSConnection if self._https\
+                       else http.client.HTTPConnection
+    return connection_class(self._netloc, timeout=self.timeout)
+
+  def read(self, path):
+    try:
+      connection = self._idle.get_nowait()
+    except queue.Empty:
+      connection = self._new_connection()
+
+    url_path = self._base_path + '/' + urllib.parse.quote(_key(path, self.dataset_root))
+    try:
+      connection.request('GET', url_path)
+      response = connection.getresponse()
+      body = response.read()
+    except (OSError, http.client.HTTPException) as e:
+      connection.close()
+      raise StorageError('GET ' + url_path + ' failed: ' + repr(e)) from e
+
+    if response.will_close:
+      connection.close()
+    else:
+      # keep-alive: the next request reuses the connection
+      try:
+        self._idle.put_nowait(connection)
+      except queue.Full:
+        connection.close()
+
+    if response.status == 404:
+      raise FileNotFoundError('GET ' + url_path + ': 404 Not Found')
+    if response.status >= 500 or response.status == 429:
+      raise StorageError('GET ' + url_path + ': ' + str(response.status))
+    if response.status != 200:
+      raise OSError('GET ' + url_path + ': ' + str(response.status))
+    return body
+
+  def close(self):
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        return
+
+def _dataset_root():
+  return sys.path[0]
+
+# Path of a file relative to the dataset root, with / separators
+def _key(path, dataset_root):
+  if os.path.isabs(path):
+    path = os.path.relpath(path, dataset_root)
+  return path.replace(os.sep, '/')
+
+'''
+Fetches files through a storage backend, many at a time
+
+@param backend - LocalStorage, HTTPStorage, or any object with a
+                 read(path) -> bytes method
+@param concurrency - maximum number of files read at once
+@param retries - number of times a transient failure (StorageError, or any
+                 OSError other than FileNotFoundError) is retried
+@param backoff - seconds before the first retry, doubled at every retry
+'''
+class AsyncFetcher:
+  def __init__(self, backend, concurrency=16, retries=3, backoff=0.1):
+    self.backend = backend
+    self.concurrency = concurrency
+    self.retries = retries
+    self.backoff = backoff
+    # Backends do blocking I/O; the pool runs it off the event loop
+    self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+  async def fetch(self, path, semaphore=None):
+    loop = asyncio.get_running_loop()
+    for attempt in range(self.retries + 1):
+      try:
+        if semaphore is None:
+          return await loop.run_in_executor(self._executor, self.backend.read, path)
+        async with semaphore:
+          return await loop.run_in_executor(self._executor, self.backend.read, path)
+      except FileNotFoundError:
+        raise
+      except OSError as e:
+        if attempt == self.retries:
+          raise
+        _logger.warning('Retrying %s after %r', path, e)
+        await asyncio.sleep(self.backoff * 2 ** attempt)
+
+  '''
+  @return list with the bytes of every path, in order
+  '''
+  async def fetch_many(self, paths):
+    semaphore = asyncio.Semaphore(self.concurrency)
+    return await asyncio.gather(*[self.fetch(path, semaphore) for path in paths])
+
+  '''
+  Synchronous fetch_many(), for code that is not running in an event loop
+  (a private loop is used from a helper thread when the caller is)
+  '''
+  def fetch_all(self, paths):
+    paths = list(paths)
+    try:
+      asyncio.get_running_loop()
+    except RuntimeError:
+      return asyncio.run(self.fetch_many(paths))
+    with ThreadPoolExecutor(max_workers=1) as helper:
+      return helper.submit(asyncio.run, self.fetch_many(paths)).result()
+
+  def close(self):
+    self._executor.shutdown(wait=True)
+    self.backend.close()
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    _logger.debug(format, *args)
+
+'''
+Serves directory over HTTP (with keep-alive) from a daemon thread, as a local
+stand-in for a remote dataset server
+
+@return 2-tuple: (the server, whose shutdown() stops it, base URL)
+'''
+def serve(directory, host='127.0.0.1', port=0):
+  server = http.server.ThreadingHTTPServer(
+    (host, port), partial(_QuietHandler, directory=directory))
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, 'http://' + host + ':' + str(server.server_address[1]) + '/'
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from . import batchio
+from . import segcodes
+
+'''
+Batch materialization of whitelisted segmaps
+
+Knocked-out segmaps are written under
+ADE20K_2016_07_26/whitelisted/<whitelist hash>/<folder of the image>/, so
+segmaps produced with different whitelists (or with the same words resolved to
+other object columns by a rebuilt index) never overwrite each other, and a
+segmap only has to be produced again when its source segmap changes.
+
+That folder doubles as a persistent cache keyed by (source segmap, whitelist
+hash): a hit is answered from file metadata alone, and SegmapCache can bound
+its size by evicting the least recently used segmaps.
+
+Nothing in this module needs the ADEIndex: the caller resolves the whitelist
+to a lookup table (see segcodes.build_label_lut()), which is all the worker
+processes receive.
+'''
+
+_logger = logging.getLogger(__name__)
+
+WHITELIST_RECORD_FILENAME = 'whitelist.json'
+
+'''
+Canonical hash of a whitelist. Order matters (the ith word gets label i + 1),
+so the words are hashed in the order given.
+
+The lookup table the words resolve to is hashed with them: the object columns
+a word matches change when the index is rebuilt or updated, and segmaps
+knocked out with the old table must not be served for the new one.
+
+@param lut - lookup table of the whitelist, see segcodes.build_label_lut()
+'''
+def whitelist_hash(whitelist, lut):
+  digest = hashlib.sha1(json.dumps([str(word) for word in whitelist]).encode('utf-8'))
+  digest.update(lut.dtype.str.encode('ascii'))
+  digest.update(lut.tobytes())
+  return digest.hexdigest()[:16]
+
+'''
+Records which whitelist produced the segmaps below whitelist_folder, so the
+hashed folder names can be traced back to their words
+'''
+def write_whitelist_record(whitelist_folder, whitelist):
+  record_path = os.path.join(whitelist_folder, WHITELIST_RECORD_FILENAME)
+  if os.path.exists(record_path):
+    return
+  os.makedirs(whitelist_folder, exist_ok=True)
+  def write_record(tmp_path):
+    with open(tmp_path, 'w') as f:
+      json.dump(list(whitelist), f)
+  batchio.atomic_write(record_path, write_record)
+
+'''
+An output is up to date when it was written after its source segmap last
+changed (the whitelist and its lookup table are part of the output path)
+'''
+def is_up_to_date(source_path, output_path):
+  try:
+    return os.stat(output_path).st_mtime_ns >= os.stat(source_path).st_mtime_ns
+  except FileNotFoundError:
+    return False
+
+'''
+Knocks out a single segmap and writes it atomically (to a temporary file in
+the output folder, then renamed), so readers never see a partial PNG
+
+An up-to-date output is a cache hit: its mtime is bumped (the recency used for
+LRU eviction) and the PNG is not decoded.
+
+@return size in bytes of the output when it was written, or None if it was
+        already up to date
+'''
+def knockout_one(source_path, output_path, lut, force=False):
+  if not force and is_up_to_date(source_path, output_path):
+    os.utime(output_path)
+    return None
+
+  labels = segcodes.apply_label_lut(segcodes.decode_object_codes(batchio.imread(source_path)),
+                                    lut)
+
+  os.makedirs(os.path.dirname(output_path), exist_ok=True)
+  batchio.atomic_write(output_path, lambda tmp_path: batchio.imsave(tmp_path, labels))
+  return os.path.getsize(output_path)
+
+# Sizes of the written outputs of tasks (None for hits), in task order
+def _knockout_chunk(tasks, lut, force):
+  return [knockout_one(source_path, output_path, lut, force)
+          for source_path, output_path in tasks]
+
+def _log_progress(done, total, written, skipped):
+  _logger.info('Whitelisted %d/%d segmaps (%d written, %d already up to date)',
+               done, total, written, skipped)
+
+'''
+@param tasks - list of (source segmap path, output segmap path) pairs
+@param lut - lookup table from segcodes.build_label_lut()
+@param max_workers - size of the process pool (None uses every CPU); with
+                     max_workers=1, or when everything fits in one chunk, the
+                     work runs in the calling process
+@param chunksize - number of segmaps handed to a worker at a time
+@param progress - callable(done, total, written, skipped), called after each
+                  chunk; None disables progress reports
+@param force - rewrite outputs even if they are up to date
+@param cache - SegmapCache that the outputs belong to; it is told which outputs
+               were used and which were written (with their sizes), and
+               enforces its size limit once all chunks are done (never
+               evicting the outputs of this call)
+
+@return 2-tuple: (number of segmaps written, number skipped as up to date)
+'''
+def materialize(tasks, lut, max_workers=None, chunksize=64,
+                progress=_log_progress, force=False, cache=None):
+  tasks = list(tasks)
+  chunks = batchio.chunked(tasks, chunksize)
+  sizes = [None] * len(tasks)
+  done = written = 0
+
+  results = batchio.run_chunks(_knockout_chunk, chunks, (lut, force), max_workers)
+  for i, chunk_sizes in results:
+    start = i * chunksize
+    sizes[start:start + len(chunk_sizes)] = chunk_sizes
+    done += len(chunk_sizes)
+    written += sum(1 for size in chunk_sizes if size is not None)
+    if progress is not None:
+      progress(done, len(tasks), written, done - written)
+
+  if cache is not None:
+    cache.record([output_path for source_path, output_path in tasks], sizes)
+  return written, len(tasks) - written
+
+'''
+Size-bounded LRU cache over the segmaps stored below root
+
+The segmaps are listed once, on first use, by walking root: file mtimes (bumped
+by knockout_one() on every hit) give the initial LRU order, so it survives
+restarts. From then on, the running size and the LRU order are kept up to date
+from the outputs every materialize() call reports, and eviction pops the least
+recently used segmaps without listing root again. Segmaps that other processes
+write below root are picked up on their first use here, or at the next start.
+
+@param root - folder holding the cached segmaps (ADE20K_2016_07_26/whitelisted)
+@param max_bytes - size limit, or None for an unbounded cache
+'''
+class SegmapCache:
+  def __init__(self, root, max_bytes=None):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._bytes = 0
+    # absolute path -> size of every cached segmap, least recently used
+    # first; None until root is listed
+    self._sizes = None
+    self._lock = threading.Lock()
+
+  def _entries(self):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      for filename in filenames:
+        if filename == WHITELIST_RECORD_FILENAME or filename.startswith('.tmp-'):
+          continue
+        path = os.path.abspath(os.path.join(dirpath, filename))
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          continue
+        entries.append((st.st_mtime_ns, st.st_size, path))
+    return entries
+
+  # Lists root (once), under self._lock
+  def _load(self):
+    if self._sizes is None:
+      self._sizes = OrderedDict((path, size) for mtime, size, path in sorted(self._entries()))
+      self._bytes = sum(self._sizes.values())
+    return self._sizes
+
+  @property
+  def bytes(self):
+    with self._lock:
+      self._load()
+      return self._bytes
+
+  '''
+  Records the outputs of a materialize() call as the most recently used
+  segmaps, then enforces the size limit (never evicting them)
+
+  @param paths - output paths
+  @param sizes - size of each output if it was written, None if it was a hit
+  '''
+  def record(self, paths, sizes):
+    with self._lock:
+      for path, size in zip(paths, sizes):
+        if size is None:
+          self.hits += 1
+        else:
+          self.misses += 1
+        if self._sizes is None:
+          # sizes are only tracked once root was listed (see _load())
+          continue
+        path = os.path.abspath(path)
+        if size is None and path not in self._sizes:
+          # written by another process
+          try:
+            size = os.path.getsize(path)
+          except FileNotFoundError:
+            continue
+        if size is not None:
+          self._bytes += size - self._sizes.get(path, 0)
+          self._sizes[path] = size
+        self._sizes.move_to_end(path)
+    self.enforce_limit(paths)
+
+  '''
+  Deletes least recently used segmaps until the cache fits in max_bytes
+
+  @param pinned - paths that are never evicted (the segmaps the current call
+                  returns); if they alone exceed max_bytes, they are all kept
+                  and a warning is logged
+  '''
+  def enforce_limit(self, pinned=()):
+    if self.max_bytes is None:
+      return
+
+    with self._lock:
+      sizes = self._load()
+      if self._bytes <= self.max_bytes:
+        return
+
+      pinned = set(os.path.abspath(path) for path in pinned)
+      evicted = []
+      for path, size in sizes.items():
+        if self._bytes <= self.max_bytes:
+          break
+        if path in pinned:
+          continue
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        evicted.append(path)
+        self._bytes -= size
+      for path in evicted:
+        del sizes[path]
+      self.evictions += len(evicted)
+
+      if self._bytes > self.max_bytes:
+        _logger.warning('The whitelisted segmaps in use take %d bytes, more than the '
+                        'cache limit of %d bytes; they are kept until a later call',
+                        self._bytes, self.max_bytes)
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions}
@@ -0,0 +1,45 @@
+import os
+import pytest
+from benchmarks import synthetic
+
+'''
+A tiny synthetic dataset (see benchmarks/synthetic.py): the MATLAB index, and
+an image with its segmap for the first NUM_FILES images of the index
+'''
+
+NUM_IMAGES = 60
+NUM_OBJECTS = 40
+OBJECTS_PER_IMAGE = 6
+NUM_FILES = 20
+SIZE = (24, 32)
+
+_INDEX_KWARGS = {'num_images': NUM_IMAGES, 'num_objects': NUM_OBJECTS,
+                 'objects_per_image': OBJECTS_PER_IMAGE}
+
+'''
+Fields of the MATLAB index of the dataset, for brute-force checks
+'''
+@pytest.fixture(scope='session')
+def fields():
+  return synthetic.index_fields(**_INDEX_KWARGS)
+
+'''
+Root of a fresh copy of the dataset, which the package is pointed at (it finds
+the dataset at sys.path[0]); the module-level state of funcs is reset, so every
+test builds its own index
+'''
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+  from lemonade20k import funcs, querycache, whitelisting
+
+  root = str(tmp_path)
+  synthetic.write_dataset(root, files_for_images=NUM_FILES, size=SIZE, **_INDEX_KWARGS)
+  monkeypatch.syspath_prepend(root)
+  monkeypatch.setattr(funcs, '_index', None)
+  monkeypatch.setattr(funcs, '_query_cache', querycache.QueryCache())
+  monkeypatch.setattr(funcs, '_label_store', False)
+  monkeypatch.setattr(funcs, '_segmap_cache', whitelisting.SegmapCache(
+    os.path.join(root, 'ADE20K_2016_07_26', 'whitelisted')))
+  funcs._whitelist_lut.cache_clear()
+  funcs._whitelist_key.cache_clear()
+  return root
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+from benchmarks import synthetic
+from lemonade20k import analytics, funcs
+
+'''
+Statistics of the presence matrix, checked against dense products of the
+fields of the MATLAB index
+'''
+
+def _binary(fields):
+  return (fields['objectPresence'].T > 0).astype(np.int64)
+
+def _brute_cooccurrence(fields):
+  presence = _binary(fields)
+  return presence.T @ presence
+
+def _names(fields):
+  return [str(name) for name in fields['objectnames'][0]]
+
+def test_cooccurrence(dataset, fields):
+  ade_index = funcs.get_index()
+  expected = _brute_cooccurrence(fields)
+  assert np.array_equal(analytics.cooccurrence(ade_index).toarray(), expected)
+  # chunks of rows add up to the same matrix
+  assert np.array_equal(analytics.cooccurrence(ade_index, chunk_rows=7, refresh=True).toarray(),
+                        expected)
+
+  frame = funcs.get_cooccurrence_matrix()
+  assert frame.index.tolist() == frame.columns.tolist() == _names(fields)
+  assert np.array_equal(frame.sparse.to_dense().to_numpy(), expected)
+
+@pytest.mark.parametrize('instances', [False, True])
+def test_scene_frequencies(dataset, fields, instances):
+  ade_index = funcs.get_index()
+  frequencies, scenes = analytics.scene_frequencies(ade_index, instances, chunk_rows=11)
+  image_scenes = np.array([str(scene) for scene in fields['scene'][0]])
+  counts = fields['objectPresence'].T.astype(np.int64) if instances else _binary(fields)
+  expected = np.stack([counts[image_scenes == scene].sum(axis=0) for scene in scenes])
+  assert sorted(scenes) == sorted(set(image_scenes))
+  assert np.array_equal(frequencies.toarray(), expected)
+
+  frame = funcs.get_scene_object_frequencies(instances)
+  assert frame.index.tolist() == scenes.tolist()
+  assert np.array_equal(frame.sparse.to_dense().to_numpy(), expected)
+
+@pytest.mark.parametrize('by', ['count', 'jaccard'])
+def test_related_objects(dataset, fields, by):
+  presence = _binary(fields)
+  names = _names(fields)
+  images = presence.sum(axis=0)
+  for phrase, column in (('object0', 0), ('object5', 5)):
+    rows = presence[:, column] > 0
+    shared = presence[rows].sum(axis=0)
+    shared[column] = 0
+    scores = shared / (rows.sum() + images - shared) if by == 'jaccard' else shared
+    ranked = sorted(np.flatnonzero(shared), key=lambda col: (-scores[col], col))[:4]
+
+    related = funcs.get_related_objects(phrase, k=4, by=by)
+    assert [name for name, count, score in related] == [names[col] for col in ranked]
+    assert [count for name, count, score in related] == [shared[col] for col in ranked]
+    assert np.allclose([score for name, count, score in related],
+                       [scores[col] for col in ranked])
+  assert funcs.get_related_objects('no such object') == []
+  with pytest.raises(ValueError):
+    funcs.get_related_objects('object0', by='lift')
+
+def test_results_are_cached_per_build(dataset, fields):
+  ade_index = funcs.get_index()
+  analytics.cooccurrence(ade_index)
+  path = analytics._cache_path(ade_index, 'cooccurrence')
+  assert os.path.exists(path)
+  analytics._memo.clear()
+  assert np.array_equal(analytics.cooccurrence(ade_index).toarray(), _brute_cooccurrence(fields))
+
+  # the rebuilt index has no objects in its first images
+  changed = dict(fields)
+  changed['objectPresence'] = fields['objectPresence'].copy()
+  changed['objectPresence'][:, :20] = 0
+  assert not np.array_equal(_brute_cooccurrence(changed), _brute_cooccurrence(fields))
+  synthetic._write_fields(dataset, changed)
+  funcs.refresh_csv_tables()
+  assert np.array_equal(analytics.cooccurrence(funcs.get_index()).toarray(),
+                        _brute_cooccurrence(changed))
@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+from skimage.io import imread
+from benchmarks import synthetic
+from lemonade20k import segcodes
+from .conftest import NUM_FILES, NUM_IMAGES, OBJECTS_PER_IMAGE, SIZE
+
+'''
+The synthetic dataset the benchmarks run on, and the JSON results of a tiny
+run of the benchmark suite
+'''
+
+_SUITE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'benchmarks', 'bench_suite.py')
+
+def test_synthetic_dataset(dataset, fields):
+  presence = fields['objectPresence']
+  assert presence.shape[1] == NUM_IMAGES
+  assert np.all(np.count_nonzero(presence, axis=0) == OBJECTS_PER_IMAGE)
+  # a few objects are in most images, the rest are rare
+  frequencies = np.count_nonzero(presence, axis=1)
+  assert frequencies[0] > NUM_IMAGES // 3 > frequencies[-1]
+
+  for i in range(NUM_IMAGES):
+    path = os.path.join(dataset, str(fields['folder'][0, i]), str(fields['filename'][0, i]))
+    seg_path = path[:-len('.jpg')] + '_seg.png'
+    assert os.path.exists(seg_path) == os.path.exists(path) == (i < NUM_FILES)
+    if i < NUM_FILES:
+      assert imread(path).shape == SIZE + (3,)
+      # segmaps only show the objects the index says are in the image
+      codes = np.unique(segcodes.decode_object_codes(imread(seg_path)))
+      assert set(codes[codes > 0] - 1) <= set(np.flatnonzero(presence[:, i]))
+
+def _run(tmp_path, *args):
+  output = subprocess.run([sys.executable, _SUITE, '--images', '60', '--objects', '40',
+                           '--files-for-images', '6', '--repeats', '2'] + list(args),
+                          cwd=str(tmp_path), check=True, stdout=subprocess.PIPE)
+  return output.stdout.decode()
+
+def test_suite_results(tmp_path):
+  _run(tmp_path, '--output', 'baseline.json')
+  with open(str(tmp_path / 'baseline.json')) as f:
+    report = json.load(f)
+  assert report['parameters']['repeats'] == 2
+  results = report['results']
+  assert set(results) >= {'index_load_cold', 'index_load_warm', 'query_single_group',
+                          'query_multi_group', 'query_memoized', 'check_object_matches',
+                          'knockout_cold', 'knockout_warm', 'materialize_parallel'}
+  for result in results.values():
+    assert len(result['times']) == 2
+    assert result['min'] <= result['median'] <= max(result['times'])
+  assert results['knockout_cold']['items'] == 6
+
+  # without --output, the JSON goes to stdout, followed by the comparison
+  output = _run(tmp_path, '--compare', 'baseline.json')
+  lines = output.splitlines()
+  comparison = [line for line in lines if '->' in line]
+  assert len(comparison) == len(results)
+  assert json.loads('\n'.join(lines[:-len(comparison)]))['results'].keys() == results.keys()
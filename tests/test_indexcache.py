@@ -0,0 +1,203 @@
+import json
+import os
+import numpy as np
+import pytest
+from skimage.io import imsave
+from benchmarks import synthetic
+from lemonade20k import ADEIndex as ind_class
+from lemonade20k import funcs, indexcache, manifest
+from lemonade20k.query import Has
+from .conftest import NUM_IMAGES, SIZE
+
+'''
+Round trips through the binary index cache, its segments (rows added by
+update_index()) and the segmap manifest
+'''
+
+def _all_rows(ade_index):
+  return np.arange(ade_index.num_images_total)
+
+def _assert_same_index(a, b):
+  rows = _all_rows(a)
+  assert a.num_images_total == b.num_images_total
+  for name in ('filename', 'typeset'):
+    assert np.array_equal(a.column_values(name), b.column_values(name))
+  assert a.folder_index.take(rows).tolist() == b.folder_index.take(rows).tolist()
+  assert a.scene_index.take(rows).tolist() == b.scene_index.take(rows).tolist()
+  assert a.object_names().tolist() == b.object_names().tolist()
+  assert np.array_equal(a.object_presence.toarray(), b.object_presence.toarray())
+  assert a.image_index.equals(b.image_index)
+  assert a.path_manifest.segmap_paths(rows, withParts=True)\
+         == b.path_manifest.segmap_paths(rows, withParts=True)
+
+def test_cache_round_trip(dataset, fields):
+  cold = ind_class.ADEIndex()
+  assert indexcache.load(cold._cache_folderpath, cold._mat_filename) is not None
+  warm = ind_class.ADEIndex()
+
+  _assert_same_index(cold, warm)
+  assert warm.build_id == cold.build_id
+  assert np.array_equal(warm.object_presence.toarray(), fields['objectPresence'].T)
+  assert warm.column_values('filename').tolist() == [str(name) for name in fields['filename'][0]]
+
+def test_cache_is_rebuilt_when_the_source_changes(dataset, fields):
+  old = ind_class.ADEIndex()
+  synthetic.write_index_mat(dataset, num_images=NUM_IMAGES, num_objects=50, seed=1)
+  assert indexcache.load(old._cache_folderpath, old._mat_filename) is None
+
+  new = ind_class.ADEIndex()
+  assert new.build_id != old.build_id
+  assert len(new.object_names()) == 50
+
+def test_save_and_load_arrays(tmp_path):
+  folder = str(tmp_path / 'cache')
+  source = str(tmp_path / 'source.mat')
+  with open(source, 'wb') as f:
+    f.write(b'index')
+  arrays = {'a': np.arange(10), 'b': np.array(['x', 'yz'])}
+
+  build_id = indexcache.save(folder, arrays, source)
+  loaded = indexcache.load(folder, source)
+  assert set(loaded) == set(arrays)
+  for name in arrays:
+    assert np.array_equal(loaded[name], arrays[name])
+
+  # saving again replaces the folder, leaving nothing next to it
+  assert indexcache.save(folder, {'a': np.arange(3)}, source) != build_id
+  assert np.array_equal(indexcache.load(folder, source)['a'], np.arange(3))
+  assert sorted(os.listdir(str(tmp_path))) == ['cache', 'source.mat']
+
+  # another format version is treated as missing
+  manifest_path = os.path.join(folder, indexcache.MANIFEST_FILENAME)
+  with open(manifest_path) as f:
+    recorded = json.load(f)
+  recorded['version'] = indexcache.CACHE_FORMAT_VERSION - 1
+  with open(manifest_path, 'w') as f:
+    json.dump(recorded, f)
+  assert indexcache.load(folder, source) is None
+
+def _add_annotated_images(root, folder, objects_per_image):
+  os.makedirs(os.path.join(root, folder))
+  for i, objects in enumerate(objects_per_image):
+    name = 'ADE_new_%08d' % (i + 1)
+    imsave(os.path.join(root, folder, name + '.jpg'),
+           np.zeros(SIZE + (3,), dtype=np.uint8), check_contrast=False)
+    with open(os.path.join(root, folder, name + '_atr.txt'), 'w') as f:
+      for instance, object_name in enumerate(objects, 1):
+        f.write('%03d # 0 # 0 # %s # %s # ""\n' % (instance, object_name, object_name))
+        # parts are not counted
+        f.write('%03d # 1 # 0 # %s # %s # ""\n' % (instance, object_name, object_name))
+  # only the first new image has a segmap
+  imsave(os.path.join(root, folder, 'ADE_new_00000001_seg.png'),
+         np.zeros(SIZE + (3,), dtype=np.uint8), check_contrast=False)
+
+def test_segments_round_trip(dataset):
+  # annotations name objects the way the index does, synonyms included
+  names = funcs.get_index().object_names().tolist()
+  folder = 'ADE20K_2016_07_26/images/training/m/my_scenes'
+  _add_annotated_images(dataset, folder, [[names[0], names[0], 'brand new thing'],
+                                          [names[1]]])
+  assert funcs.update_index([folder]) == 2
+  assert funcs.update_index([folder]) == 0
+  updated = funcs.get_index()
+  assert updated.num_images_total == NUM_IMAGES + 2
+  assert updated.object_names().tolist() == names + ['brand new thing']
+
+  rows = NUM_IMAGES + np.arange(2)
+  assert np.array_equal(Has('brand new thing').rows(updated), rows[:1])
+  assert updated.object_presence[rows[0], updated.columns_matching('object0')[0]] == 2
+  assert Has('object1').mask(updated)[rows[1]]
+  assert updated.scene_index.take(rows).tolist() == ['my_scenes', 'my_scenes']
+  paths = updated.path_manifest.segmap_paths(rows)
+  assert paths == [[os.path.join(dataset, folder, 'ADE_new_00000001_seg.png')], []]
+
+  # the segment is loaded back with the cache
+  reloaded = ind_class.ADEIndex()
+  _assert_same_index(updated, reloaded)
+  assert reloaded.build_id == updated.build_id
+
+def test_segments_after_a_missing_or_corrupt_manifest(dataset):
+  names = funcs.get_index().object_names().tolist()
+  folders = ['ADE20K_2016_07_26/images/training/m/my_scenes',
+             'ADE20K_2016_07_26/images/training/m/more_scenes']
+  cache_folder = funcs.get_index()._cache_folderpath
+  manifest_path = os.path.join(cache_folder, indexcache.MANIFEST_FILENAME)
+
+  # a deleted manifest, then a truncated one: the cache is rebuilt first
+  _add_annotated_images(dataset, folders[0], [[names[0]]])
+  os.remove(manifest_path)
+  assert funcs.update_index([folders[0]]) == 1
+  with open(manifest_path, 'w') as f:
+    f.write('{"version": ')
+  _add_annotated_images(dataset, folders[1], [[names[1]], [names[2]]])
+  assert funcs.update_index([folders[1]]) == 2
+
+  # the rebuilt cache only holds the folder added after the rebuild
+  reloaded = ind_class.ADEIndex()
+  assert reloaded.build_id == funcs.get_index().build_id
+  assert reloaded.num_images_total == NUM_IMAGES + 2
+  assert reloaded.scene_index.take(NUM_IMAGES + np.arange(2)).tolist()\
+         == ['more_scenes', 'more_scenes']
+
+def test_concurrent_updates_keep_every_segment(dataset):
+  # two indexes loaded before either update, like two worker processes
+  first, second = ind_class.ADEIndex(), ind_class.ADEIndex()
+  folders = ['ADE20K_2016_07_26/images/training/m/my_scenes',
+             'ADE20K_2016_07_26/images/training/o/other_scenes']
+  _add_annotated_images(dataset, folders[0], [['first new thing'], ['shared new thing']])
+  _add_annotated_images(dataset, folders[1], [['shared new thing', 'second new thing']])
+
+  assert first.add_folders([folders[0]]) == 2
+  # second's columns are outdated: it loads the first segment before its own
+  assert second.add_folders([folders[1]]) == 1
+  assert second.num_images_total == NUM_IMAGES + 3
+
+  reloaded = ind_class.ADEIndex()
+  _assert_same_index(second, reloaded)
+  assert reloaded.object_names().tolist()[-3:] == ['first new thing', 'shared new thing',
+                                                   'second new thing']
+  assert np.array_equal(Has('shared new thing').rows(reloaded), NUM_IMAGES + np.array([1, 2]))
+  assert np.array_equal(Has('second new thing').rows(reloaded), [NUM_IMAGES + 2])
+
+def test_manifest_lock(tmp_path):
+  folder = str(tmp_path / 'cache')
+  with indexcache.manifest_lock(folder):
+    with pytest.raises(TimeoutError):
+      with indexcache.manifest_lock(folder, timeout=0):
+        pass
+  assert os.listdir(str(tmp_path)) == []
+
+  # a lock left behind by a process that died is broken
+  lock_path = folder + indexcache.LOCK_SUFFIX
+  open(lock_path, 'w').close()
+  os.utime(lock_path, (0, 0))
+  with indexcache.manifest_lock(folder, timeout=0):
+    assert os.path.exists(lock_path)
+  assert not os.path.exists(lock_path)
+
+def test_manifest_round_trip_and_refresh(dataset):
+  ade_index = ind_class.ADEIndex()
+  rows = _all_rows(ade_index)
+  paths = ade_index.path_manifest.segmap_paths(rows)
+  assert sum(1 for image_paths in paths if image_paths) > 0
+  assert all(os.path.exists(path) for image_paths in paths for path in image_paths)
+
+  filenames = ade_index.column_values('filename')
+  arrays = ade_index.path_manifest.to_arrays()
+  copy = manifest.PathManifest.from_arrays(arrays, dataset, filenames, ade_index.folder_index)
+  assert copy.segmap_paths(rows, withParts=True)\
+         == ade_index.path_manifest.segmap_paths(rows, withParts=True)
+
+  # a parts map added and a segmap removed are picked up by the next load
+  row = next(row for row, image_paths in enumerate(paths) if image_paths)
+  seg_path = paths[row][0]
+  parts_path = seg_path[:-len('_seg.png')] + '_parts_1.png'
+  imsave(parts_path, np.zeros(SIZE + (3,), dtype=np.uint8), check_contrast=False)
+  other = next(r for r, image_paths in enumerate(paths)
+               if image_paths and os.path.dirname(image_paths[0]) != os.path.dirname(seg_path))
+  os.remove(paths[other][0])
+
+  refreshed = ind_class.ADEIndex().path_manifest
+  assert refreshed.segmap_paths([row], withParts=True) == [[seg_path, parts_path]]
+  assert refreshed.segmap_paths([other]) == [[]]
+  assert not refreshed.has_segmap([other])[0]
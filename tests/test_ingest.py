@@ -0,0 +1,53 @@
+import numpy as np
+import scipy.io as sio
+from benchmarks import bench_ingest, synthetic
+from lemonade20k import ADEIndex as ind_class
+from lemonade20k import indexcache
+from .conftest import NUM_IMAGES, NUM_OBJECTS
+
+'''
+Ingestion of index_ade20k.mat: the tables built from the MATLAB cell arrays
+against the fields they were written from, and against the row-by-row
+ingestion the index used to do
+'''
+
+def _strings(cells):
+  return [str(cell) for cell in cells[0]]
+
+def test_ingestion_from_the_mat_file(dataset, fields):
+  ade_index = ind_class.ADEIndex()
+  # nothing was cached before, so the index was read from the MATLAB file
+  assert indexcache.load(ade_index._cache_folderpath, ade_index._mat_filename) is not None
+  assert ade_index.num_images_total == NUM_IMAGES
+
+  image_index = ade_index.image_index
+  assert image_index['filename'].tolist() == _strings(fields['filename'])
+  assert image_index['folder'].tolist() == _strings(fields['folder'])
+  assert image_index['scene'].tolist() == _strings(fields['scene'])
+  assert np.array_equal(image_index['typeset'].to_numpy(), fields['typeset'].ravel())
+  assert ade_index.object_names().tolist() == _strings(fields['objectnames'])
+  assert len(ade_index.object_names()) == NUM_OBJECTS
+  assert np.array_equal(ade_index.object_presence.toarray(), fields['objectPresence'].T)
+  assert ade_index.folder_index.take(np.arange(NUM_IMAGES)).tolist() == _strings(fields['folder'])
+
+def test_ingestion_matches_the_row_by_row_tables(tmp_path):
+  mat_path = synthetic.write_index_mat(str(tmp_path), num_images=NUM_IMAGES,
+                                       num_objects=NUM_OBJECTS)
+  _matindex = sio.loadmat(mat_path)['index'][0, 0]
+  image_index, object_name_list, object_image_matrix = bench_ingest._legacy_ingest(_matindex)
+  ade_index = bench_ingest._vectorized_ingest(_matindex)
+
+  for name in ('filename', 'folder', 'scene'):
+    assert ade_index.image_index[name].tolist() == image_index[name].tolist()
+  assert ade_index.image_index['typeset'].tolist() == image_index['typeset'].tolist()
+  assert ade_index.object_names().tolist() == object_name_list['objectnames'].tolist()
+  assert np.array_equal(ade_index.object_presence.toarray(), object_image_matrix.to_numpy())
+
+def test_empty_strings_keep_their_rows(tmp_path):
+  path = str(tmp_path / 'cells.mat')
+  cells = np.empty((1, 4), dtype=object)
+  cells[0, :] = ['a', '', 'bc', '']
+  sio.savemat(path, {'cells': cells})
+  loaded = sio.loadmat(path)['cells']
+  assert ind_class._unpack_cellstr(loaded).tolist() == ['a', '', 'bc', '']
+  assert ind_class._unpack_cellstr(loaded[:, :0]).tolist() == []
@@ -0,0 +1,59 @@
+import builtins
+import logging
+import pytest
+from lemonade20k import funcs, instrument
+
+'''
+Spans and counters recorded through the query pipeline, and the log lines
+they produce instead of printed progress
+'''
+
+@pytest.fixture
+def stats(monkeypatch):
+  # nothing may wait for input
+  monkeypatch.setattr(builtins, 'input', lambda *args: pytest.fail('input() was called'))
+  collector = instrument.enable_stats()
+  yield collector
+  instrument.disable_stats()
+
+def test_query_spans_and_counters(dataset, stats, capsys, caplog):
+  phrases = [('object0', 1), (['object1', 'object2'], 2)]
+  with caplog.at_level(logging.DEBUG, logger='lemonade20k.instrument'):
+    image_paths = funcs.get_filepaths(phrases)[0]
+  ade_index = funcs.get_index()
+  columns = sum(len(ade_index.columns_matching(phrase))
+                for phrase in ('object0', 'object1', 'object2'))
+
+  snapshot = instrument.get_stats()
+  spans = snapshot['spans']
+  assert {name: span['count'] for name, span in spans.items()} == {
+    'index.load': 1, 'query.resolve_phrases': 2, 'query.reduce': 2,
+    'query.intersect': 1, 'paths.resolve': 1}
+  for span in spans.values():
+    assert 0 <= span['min_s'] <= span['max_s'] <= span['total_s']
+  assert snapshot['counters'] == {'query.matched_columns': columns,
+                                  'query.matched_rows': len(image_paths)}
+  assert 'paths.resolve took' in caplog.text
+  assert 'query.matched_rows += %d' % len(image_paths) in caplog.text
+  assert capsys.readouterr().out == ''
+
+  # a memoized result is not reduced again
+  funcs.get_filepaths(phrases)
+  spans = instrument.get_stats()['spans']
+  assert spans['query.reduce']['count'] == 2 and spans['paths.resolve']['count'] == 2
+
+  stats.reset()
+  assert instrument.get_stats() == {'spans': {}, 'counters': {}}
+  instrument.disable_stats()
+  funcs.get_filepaths([('object3', 1)])
+  assert instrument.get_stats() is None
+
+def test_knockout_counters(dataset, stats, capsys):
+  segmaps = funcs.materialize_whitelist([('object0', 1)], ['object0'], max_workers=1,
+                                        progress=None)[0]
+  funcs.materialize_whitelist([('object0', 1)], ['object0'], max_workers=1, progress=None)
+  snapshot = instrument.get_stats()
+  assert snapshot['spans']['whitelist.knockout']['count'] == 2
+  assert snapshot['counters']['whitelist.segmaps_written'] == len(segmaps)
+  assert snapshot['counters']['whitelist.segmaps_skipped'] == len(segmaps)
+  assert capsys.readouterr().out == ''
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+import pytest
+from skimage.io import imread
+from lemonade20k import funcs, labelstore, loader, segcodes
+
+'''
+Segmaps converted once into a label store: the codes of every record, views
+of the memory-mapped data file, and the readers that use the store
+'''
+
+def _segmap_paths():
+  ade_index = funcs.get_index()
+  return [path for paths in ade_index.path_manifest.segmap_paths(
+            range(ade_index.num_images_total), True) for path in paths]
+
+@pytest.mark.parametrize('compress', [0, 6])
+def test_records_are_the_decoded_codes(dataset, compress):
+  reports = []
+  store = funcs.convert_segmaps(compress=compress, max_workers=2, chunksize=3,
+                                progress=lambda *report: reports.append(report))
+  segmap_paths = _segmap_paths()
+  assert len(store) == len(segmap_paths) > 0
+  assert reports[-1] == (len(segmap_paths), len(segmap_paths))
+
+  for path in segmap_paths:
+    assert path in store
+    labels = store.get(path)
+    assert labels.dtype == np.uint16
+    assert np.array_equal(labels, segcodes.decode_object_codes(imread(path)))
+    if not compress:
+      # a read-only view of the data file, starting on an aligned offset
+      assert not labels.flags.writeable and not labels.flags.owndata
+      assert labels.ctypes.data % labelstore._ALIGNMENT == 0
+  with pytest.raises(KeyError):
+    store.get(os.path.join(dataset, 'missing_seg.png'))
+
+  data_size = os.path.getsize(os.path.join(store.folder, labelstore.DATA_FILENAME))
+  raw_size = sum(store.get(path).nbytes for path in segmap_paths)
+  assert (data_size < raw_size) if compress else (data_size >= raw_size)
+
+def test_store_is_found_again_and_replaced(dataset):
+  assert funcs.get_label_store() is None
+  funcs.convert_segmaps(max_workers=1)
+  funcs._label_store = False
+  store = funcs.get_label_store()
+  assert store is not None and store.compression == 0
+
+  funcs.convert_segmaps(compress=1, max_workers=1)
+  # the new store replaced the old one in place, leaving nothing next to it
+  parent = os.path.dirname(store.folder)
+  assert [name for name in os.listdir(parent) if name.startswith('labels')] == ['labels']
+  assert labelstore.load(store.folder, dataset).compression == 1
+
+def test_readers_use_the_store(dataset, monkeypatch):
+  funcs.convert_segmaps(max_workers=1)
+  subset = funcs.get_images([('object0', 1)], use_label_store=True)
+  count = sum(1 for paths in subset.segmap_paths if paths)
+  expected = [segcodes.decode_object_codes(imread(paths[0]))
+              for paths in subset.segmap_paths[:count]]
+  batch_loader = loader.BatchLoader(subset[:count], count)
+
+  # segmaps are no longer decoded from their PNG
+  imread_png = loader.batchio.imread
+  monkeypatch.setattr(loader.batchio, 'imread',
+                      lambda path: None if path.endswith('.png') else imread_png(path))
+  for i in range(count):
+    assert np.array_equal(subset.segmaps[i], expected[i])
+  images, labels = next(iter(batch_loader))
+  assert np.array_equal(labels, np.stack(expected))
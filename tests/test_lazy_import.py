@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from lemonade20k import ADEIndex as ind_class
+from lemonade20k import funcs
+
+'''
+Importing the package loads neither the index nor the heavy dependencies;
+the index is loaded once, on first use
+'''
+
+_HEAVY = ('scipy', 'pandas', 'skimage')
+
+_SCRIPT = '''
+import json, os, sys
+loaded = lambda: sorted(set(name.split('.')[0] for name in sys.modules) & set(%r))
+import lemonade20k
+after_package = loaded()
+from lemonade20k import funcs
+query = lemonade20k.Has('object0') & lemonade20k.Scene('abbey')
+print(json.dumps({'package': after_package, 'funcs': loaded(), 'loaded': funcs._index is not None,
+                  'files': sorted(os.listdir('ADE20K_2016_07_26'))}))
+''' % (_HEAVY,)
+
+def test_import_loads_nothing_heavy(dataset):
+  files = sorted(os.listdir(os.path.join(dataset, 'ADE20K_2016_07_26')))
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  # the package finds the dataset at sys.path[0], the working directory here
+  output = subprocess.run([sys.executable, '-c', _SCRIPT], cwd=dataset, env=env,
+                          check=True, stdout=subprocess.PIPE).stdout
+  result = json.loads(output.decode())
+  assert result == {'package': [], 'funcs': [], 'loaded': False, 'files': files}
+
+def test_index_is_loaded_once(dataset, monkeypatch):
+  builds = []
+
+  class ADEIndex(ind_class.ADEIndex):
+    def __init__(self, *args):
+      builds.append(threading.get_ident())
+      # widens the window in which other threads could start a second build
+      time.sleep(0.1)
+      super().__init__(*args)
+
+  monkeypatch.setattr(ind_class, 'ADEIndex', ADEIndex)
+  indexes = []
+  threads = [threading.Thread(target=lambda: indexes.append(funcs.get_index()))
+             for i in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(builds) == 1
+  assert len(indexes) == 8 and all(index is indexes[0] for index in indexes)
+  assert funcs.index is indexes[0]
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from skimage.io import imread
+from lemonade20k import funcs, loader, resizing, segcodes
+from .conftest import SIZE
+
+'''
+Batches of BatchLoader: their shapes and pixel values, the shuffling order and
+the number of batches decoded ahead of the consumer
+'''
+
+def _filepaths():
+  image_paths, segmap_paths, folder_paths = funcs.get_filepaths([('object0', 1)])
+  # only the first images of the dataset have files, and they come first
+  count = sum(1 for paths in segmap_paths if paths)
+  return image_paths[:count], segmap_paths[:count]
+
+def _sample(image_path, segmap_path):
+  return imread(image_path), segcodes.decode_object_codes(imread(segmap_path))
+
+def test_batches(dataset):
+  image_paths, segmap_paths = _filepaths()
+  assert len(image_paths) > 4
+  batch_loader = loader.BatchLoader((image_paths, segmap_paths), 4, num_workers=2)
+  batches = list(batch_loader)
+  assert len(batches) == len(batch_loader) == -(-len(image_paths) // 4)
+
+  for k, (images, labels) in enumerate(batches):
+    count = min(4, len(image_paths) - 4 * k)
+    assert images.shape == (count,) + SIZE + (3,) and images.dtype == np.uint8
+    assert labels.shape == (count,) + SIZE
+    for j in range(count):
+      image, codes = _sample(image_paths[4 * k + j], segmap_paths[4 * k + j][0])
+      assert np.array_equal(images[j], image)
+      assert np.array_equal(labels[j], codes)
+
+  dropped = loader.BatchLoader((image_paths, segmap_paths), 4, drop_last=True)
+  assert len(dropped) == len(list(dropped)) == len(image_paths) // 4
+
+def test_resized_and_cropped_batches(dataset):
+  image_paths, segmap_paths = _filepaths()
+  batch_loader = loader.BatchLoader(funcs.get_images([('object0', 1)])[:len(image_paths)],
+                                    3, size=(12, 16), crop=(8, 10), drop_last=True)
+  images, labels = next(iter(batch_loader))
+  assert images.shape == (3, 8, 10, 3) and labels.shape == (3, 8, 10)
+  for j in range(3):
+    codes = _sample(image_paths[j], segmap_paths[j][0])[1]
+    # nearest neighbour labels, center crop
+    assert np.array_equal(labels[j], resizing.resize_labels(codes, (12, 16))[2:10, 3:13])
+
+  with pytest.raises(ValueError, match='larger'):
+    next(iter(loader.BatchLoader((image_paths, segmap_paths), 2, crop=(48, 10))))
+  with pytest.raises(ValueError, match='different shapes'):
+    loader.BatchLoader((image_paths, segmap_paths), 2)._collate(
+      [(np.zeros((2, 2, 3)), np.zeros((2, 2))), (np.zeros((3, 2, 3)), np.zeros((3, 2)))], [0, 1])
+
+def test_shuffling_order(dataset):
+  image_paths, segmap_paths = _filepaths()
+  sums = [_sample(path, paths[0])[0].sum() for path, paths in zip(image_paths, segmap_paths)]
+
+  def order(seed, epoch):
+    batch_loader = loader.BatchLoader((image_paths, segmap_paths), 4, shuffle=True, seed=seed)
+    batch_loader.set_epoch(epoch)
+    return [sums.index(image.sum()) for images, labels in batch_loader for image in images]
+
+  first = order(0, 0)
+  assert sorted(first) == list(range(len(image_paths)))
+  assert first != list(range(len(image_paths)))
+  assert order(0, 0) == first
+  assert order(0, 1) != first
+  assert order(1, 0) != first
+
+@pytest.mark.parametrize('prefetch_batches', [0, 1, 3])
+def test_batches_in_flight(dataset, monkeypatch, prefetch_batches):
+  submitted = []
+
+  class Executor(ThreadPoolExecutor):
+    def submit(self, *args):
+      submitted.append(args[1])
+      return super().submit(*args)
+
+  monkeypatch.setattr(loader, 'ThreadPoolExecutor', Executor)
+  image_paths, segmap_paths = _filepaths()
+  batch_loader = loader.BatchLoader((image_paths, segmap_paths), 2,
+                                    prefetch_batches=prefetch_batches)
+  in_flight = max(1, prefetch_batches)
+  for k, batch in enumerate(batch_loader):
+    # batch k is consumed, the next ones are decoded ahead
+    assert len(submitted) == 2 * min(k + in_flight, len(batch_loader))
+  assert submitted == list(range(len(image_paths)))
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from lemonade20k import ADEIndex as ind_class
+from lemonade20k import funcs, metaindex
+from .conftest import NUM_IMAGES
+
+'''
+Indexes over the categorical metadata columns, checked against comparing the
+value of every row
+'''
+
+VALUES = ['b/kitchen', 'a/abbey', None, 'b/bathroom', 'a/abbey', 'b/kitchen', 'c/street',
+          None, 'b/kitchen']
+
+def _brute_rows(predicate):
+  return [row for row, value in enumerate(VALUES) if value is not None and predicate(value)]
+
+def _check(index):
+  assert len(index) == len(VALUES)
+  assert [index[row] for row in range(len(VALUES))] == VALUES
+  assert list(index) == VALUES
+  assert index[2:6].tolist() == VALUES[2:6]
+  assert index.take(np.array([8, 2, 0])).tolist() == ['b/kitchen', None, 'b/kitchen']
+
+  for values in (['b/kitchen'], ['a/abbey', 'c/street'], ['missing'], []):
+    assert index.rows_for_values(values).tolist() == _brute_rows(lambda value: value in values)
+  for prefix in ('b/', 'a/abbey', 'd/', ''):
+    assert index.rows_with_prefix(prefix).tolist()\
+           == _brute_rows(lambda value: value.startswith(prefix))
+
+def test_category_index():
+  column = pd.Series(VALUES, dtype='category')
+  index = metaindex.CategoryIndex(column)
+  # rows are only grouped by the first lookup
+  assert index._rows is None
+  _check(index)
+
+  codes = column.cat.codes.to_numpy()
+  categories = np.asarray(column.cat.categories, dtype=str)
+  _check(metaindex.CategoryIndex.from_codes(codes, categories))
+
+def test_index_columns(dataset, fields):
+  funcs.get_index()
+  # loaded from the stored codes of the index cache
+  ade_index = ind_class.ADEIndex()
+  for index, key in ((ade_index.folder_index, 'folder'), (ade_index.scene_index, 'scene')):
+    values = [str(value) for value in fields[key][0]]
+    assert index.take(np.arange(NUM_IMAGES)).tolist() == values
+    for value in sorted(set(values))[:3]:
+      assert index.rows_for_values([value]).tolist()\
+             == [row for row, other in enumerate(values) if other == value]
+  folders = [str(value) for value in fields['folder'][0]]
+  prefix = 'ADE20K_2016_07_26/images/validation/'
+  assert ade_index.folder_index.rows_with_prefix(prefix).tolist()\
+         == [row for row, folder in enumerate(folders) if folder.startswith(prefix)]
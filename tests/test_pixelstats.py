@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from skimage.io import imread
+from lemonade20k import ADEIndex as ind_class
+from lemonade20k import batchio, funcs, segcodes
+from lemonade20k.query import Area, Has
+
+'''
+Per-image object areas: the measured areas against pixel counts of the
+decoded segmaps, and Area() queries over them
+'''
+
+def _brute_areas(ade_index):
+  num_objects = len(ade_index.object_names())
+  areas = np.zeros((ade_index.num_images_total, num_objects), dtype=np.int64)
+  pixels = np.zeros(ade_index.num_images_total, dtype=np.int64)
+  for row, paths in enumerate(ade_index.path_manifest.segmap_paths(
+                                range(ade_index.num_images_total))):
+    if paths:
+      codes = segcodes.decode_object_codes(imread(paths[0]))
+      for column in range(num_objects):
+        areas[row, column] = np.count_nonzero(codes == column + 1)
+      pixels[row] = codes.size
+  return areas, pixels
+
+def _brute_area_rows(ade_index, phrase, min_fraction, max_fraction=None):
+  areas, pixels = _brute_areas(ade_index)
+  covered = areas[:, ade_index.columns_matching(phrase)].sum(axis=1)
+  fractions = covered / np.maximum(pixels, 1)
+  mask = (pixels > 0) & (fractions >= min_fraction)
+  if max_fraction is not None:
+    mask &= fractions <= max_fraction
+  return np.flatnonzero(mask)
+
+@pytest.mark.parametrize('use_label_store', [False, True])
+def test_areas_match_pixel_counts(dataset, use_label_store):
+  if use_label_store:
+    funcs.convert_segmaps(max_workers=1)
+  with pytest.raises(ValueError, match='index_object_areas'):
+    funcs.get_filepaths(Area('object0', 0.1))
+
+  funcs.index_object_areas(max_workers=2, chunksize=3, progress=None)
+  ade_index = funcs.get_index()
+  areas, pixels = _brute_areas(ade_index)
+  assert np.array_equal(ade_index.object_areas.toarray(), areas)
+  assert np.array_equal(ade_index.pixel_totals, pixels)
+  # objects only cover pixels of the images they are present in
+  assert not np.any(areas[ade_index.object_presence.toarray() == 0])
+
+  for phrase, min_fraction, max_fraction in [('object0', 0.05, None), ('object1', 0.0, 0.1),
+                                             ('object2', 0.2, 0.6)]:
+    rows = Area(phrase, min_fraction, max_fraction).rows(ade_index)
+    assert np.array_equal(rows, _brute_area_rows(ade_index, phrase, min_fraction, max_fraction))
+  query = Area('object0', 0.05) & Has('object1')
+  assert np.array_equal(funcs._query_cache.rows(query, ade_index),
+                        np.intersect1d(_brute_area_rows(ade_index, 'object0', 0.05),
+                                       Has('object1').rows(ade_index)))
+
+def test_areas_are_saved_with_the_index(dataset):
+  funcs.index_object_areas(max_workers=1, progress=None)
+  areas = funcs.get_index().object_areas.toarray()
+  reloaded = ind_class.ADEIndex()
+  assert np.array_equal(reloaded.object_areas.toarray(), areas)
+  assert reloaded.areas_id == funcs.get_index().areas_id
+
+  funcs.refresh_csv_tables()
+  assert funcs.get_index().object_areas is None
+
+def test_measuring_again_invalidates_area_results(dataset):
+  funcs.index_object_areas(max_workers=1, progress=None)
+  ade_index = funcs.get_index()
+  query = Area('object0', 0.9)
+  assert funcs._query_cache.rows(query, ade_index).size == 0
+
+  # the first segmap now shows nothing but object0
+  row, paths = next((row, paths) for row, paths in enumerate(
+    ade_index.path_manifest.segmap_paths(range(ade_index.num_images_total))) if paths)
+  segmap = imread(paths[0])
+  segmap[:, :, 0], segmap[:, :, 1] = 0, 1
+  batchio.imsave(paths[0], segmap)
+
+  funcs.index_object_areas(max_workers=1, progress=None)
+  assert funcs._query_cache.rows(query, funcs.get_index()).tolist() == [row]
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from lemonade20k import batchquery, funcs
+from lemonade20k.query import And, Area, Folder, Has, Not, Or, Scene, Typeset
+
+'''
+Query masks and batch evaluation, checked against a brute-force scan of the
+fields of the MATLAB index
+'''
+
+def _names(fields):
+  return [str(name) for name in fields['objectnames'][0]]
+
+def _column(fields, key):
+  return [str(value) for value in fields[key][0]]
+
+def _brute_has(fields, phrases, min_count=1, max_count=None):
+  phrases = {phrases} if isinstance(phrases, str) else set(phrases)
+  columns = [col for col, name in enumerate(_names(fields))
+             if phrases & set(name.split(', '))]
+  totals = fields['objectPresence'][columns].astype(np.int64).sum(axis=0)
+  mask = totals >= min_count
+  if max_count is not None:
+    mask &= totals <= max_count
+  return mask
+
+def _brute_scene(fields, *scenes):
+  return np.isin(_column(fields, 'scene'), scenes)
+
+def _brute_folder(fields, prefix):
+  return np.array([folder.startswith(prefix) for folder in _column(fields, 'folder')])
+
+def _synonym(fields):
+  for name in _names(fields):
+    if ', ' in name:
+      return name.split(', ')[1]
+  pytest.skip('no object of the synthetic index has a synonym')
+
+# (query, brute-force mask) pairs, built from the fields
+def _cases(fields):
+  synonym = _synonym(fields)
+  everything = np.ones(fields['objectPresence'].shape[1], dtype=bool)
+  return [
+    (Has('object0'), _brute_has(fields, 'object0')),
+    (Has(['object1', 'object2'], 2), _brute_has(fields, ['object1', 'object2'], 2)),
+    (Has('object3', 1, 2), _brute_has(fields, 'object3', 1, 2)),
+    (Has(synonym), _brute_has(fields, synonym)),
+    (Has('no such object'), ~everything),
+    (Has('object0') & ~Has('object1'),
+     _brute_has(fields, 'object0') & ~_brute_has(fields, 'object1')),
+    (Scene('street') | Has('object4', 3),
+     _brute_scene(fields, 'street') | _brute_has(fields, 'object4', 3)),
+    (Scene('abbey', 'beach'), _brute_scene(fields, 'abbey', 'beach')),
+    (Folder('ADE20K_2016_07_26/images/validation'),
+     _brute_folder(fields, 'ADE20K_2016_07_26/images/validation')),
+    (Not(Folder('ADE20K_2016_07_26/images/training/b')) & Has('object2'),
+     ~_brute_folder(fields, 'ADE20K_2016_07_26/images/training/b')
+     & _brute_has(fields, 'object2')),
+    (Typeset(1), everything),
+    (And(), everything),
+    (Or(), ~everything),
+  ]
+
+def test_masks_match_brute_force(dataset, fields):
+  ade_index = funcs.get_index()
+  for query, expected in _cases(fields):
+    assert np.array_equal(query.mask(ade_index), expected), query
+    assert np.array_equal(query.rows(ade_index), np.flatnonzero(expected)), query
+
+def test_phrases_match_has_queries(dataset, fields):
+  phrases = [('object0', 1), (['object1', 'object2'], 2)]
+  expected = _brute_has(fields, 'object0') & _brute_has(fields, ['object1', 'object2'], 2)
+  image_paths = funcs.get_filepaths(phrases)[0]
+  assert len(image_paths) == expected.sum()
+
+@pytest.mark.parametrize('max_workers, chunk_rows', [(1, 8192), (1, 7), (2, 16)])
+def test_batch_evaluate_matches_rows(dataset, fields, max_workers, chunk_rows):
+  ade_index = funcs.get_index()
+  funcs.index_object_areas(max_workers=1, progress=None)
+  queries = [query for query, expected in _cases(fields)]
+  queries += [Area('object0', 0.05), Area(['object1', 'object2'], 0.0, 0.2) & Has('object1'),
+              Has('object0') & Has('object0')]
+
+  results = batchquery.evaluate(queries, ade_index, max_workers, chunk_rows)
+  assert len(results) == len(queries)
+  for query, rows in zip(queries, results):
+    assert np.array_equal(rows, query.rows(ade_index)), query
+
+def test_batch_evaluate_without_queries(dataset):
+  assert batchquery.evaluate([], funcs.get_index()) == []
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from benchmarks import synthetic
+from lemonade20k import funcs, querycache
+from lemonade20k.query import Has
+from .test_query import _brute_has
+
+'''
+Memoized query results: hits and misses, eviction, results saved next to the
+index cache, and invalidation when the index is rebuilt
+'''
+
+def test_results_are_memoized(dataset, fields):
+  rows = funcs.get_filepaths([('object0', 1), ('object1', 2)])
+  assert funcs.query_cache_stats()['misses'] == 1
+  # the same phrases in another order share the result
+  assert funcs.get_filepaths([('object1', 2), ('object0', 1)]) == rows
+  stats = funcs.query_cache_stats()
+  assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+  cache = funcs._query_cache
+  ade_index = funcs.get_index()
+  query = Has('object0') & Has('object1', 2)
+  memoized = cache.rows(query, ade_index)
+  assert not memoized.flags.writeable
+  assert np.array_equal(memoized, np.flatnonzero(_brute_has(fields, 'object0')
+                                                 & _brute_has(fields, 'object1', 2)))
+  assert len(rows[0]) == len(memoized)
+
+def test_least_recently_used_results_are_evicted(dataset):
+  ade_index = funcs.get_index()
+  cache = querycache.QueryCache(max_entries=2)
+  for phrase in ('object0', 'object1', 'object0', 'object2'):
+    cache.rows(Has(phrase), ade_index)
+  assert [key[-1] for key in cache._results] == [Has('object0').key(), Has('object2').key()]
+  assert (cache.hits, cache.misses) == (1, 3)
+
+  cache.configure(1, False)
+  assert [key[-1] for key in cache._results] == [Has('object2').key()]
+  cache.configure(0, False)
+  assert np.array_equal(cache.rows(Has('object1'), ade_index), Has('object1').rows(ade_index))
+  assert len(cache._results) == 0 and cache.misses == 3
+
+def test_results_on_disk(dataset):
+  ade_index = funcs.get_index()
+  queries_folder = os.path.join(ade_index._cache_folderpath, querycache.QUERIES_DIRNAME)
+  rows = querycache.QueryCache(on_disk=True).rows(Has('object3'), ade_index)
+  assert len(os.listdir(queries_folder)) == 1
+
+  # another process reads the saved result
+  cache = querycache.QueryCache(on_disk=True)
+  assert np.array_equal(cache.rows(Has('object3'), ade_index), rows)
+  assert (cache.hits, cache.misses) == (1, 0)
+
+  # saved results go away with the index cache they were computed from
+  funcs.refresh_csv_tables()
+  assert not os.path.exists(queries_folder)
+  cache.clear()
+  cache.rows(Has('object3'), funcs.get_index())
+  assert (cache.hits, cache.misses) == (1, 1)
+
+def test_rebuilding_the_index_invalidates_results(dataset, fields):
+  funcs.set_query_cache(on_disk=True)
+  old = funcs.get_filepaths([('object0', 1)])[0]
+
+  # the rebuilt index swaps the names of the first two objects
+  swapped = dict(fields)
+  names = fields['objectnames'].copy()
+  names[0, 0], names[0, 1] = fields['objectnames'][0, 1], fields['objectnames'][0, 0]
+  swapped['objectnames'] = names
+  synthetic._write_fields(dataset, swapped)
+  funcs.refresh_csv_tables()
+
+  new = funcs.get_filepaths([('object0', 1)])[0]
+  assert funcs.query_cache_stats()['misses'] == 2
+  assert new != old
+  ade_index = funcs.get_index()
+  assert new == funcs._filepaths(ade_index, np.flatnonzero(_brute_has(fields, 'object1')),
+                                 None, False)[0]
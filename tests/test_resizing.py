@@ -0,0 +1,85 @@
+import os
+import numpy as np
+from skimage.io import imread
+from benchmarks import synthetic
+from lemonade20k import funcs, resizing, segcodes
+from .conftest import SIZE
+
+'''
+Resized and tiled copies of the dataset: output dimensions, label values
+(nearest neighbour gathers of the source labels), and when outputs are reused
+'''
+
+PHRASES = [('object0', 1)]
+
+def _sources(phrases):
+  segmap_paths = funcs.get_filepaths(phrases)[1]
+  return [paths[0] for paths in segmap_paths if paths]
+
+def _name(path):
+  return os.path.basename(path).split('_seg.png')[0]
+
+def test_resized_dimensions_and_labels(dataset):
+  reports = []
+  progress = lambda *report: reports.append(report)
+  image_paths, segmap_paths, folder_paths = funcs.materialize_resized(
+    PHRASES, size=(12, 16), max_workers=2, chunksize=2, progress=progress)
+  sources = _sources(PHRASES)
+  assert len(image_paths) == len(segmap_paths) == len(folder_paths) == len(sources)
+
+  for image_path, (segmap_path,), source in zip(image_paths, segmap_paths, sources):
+    assert _name(segmap_path) == _name(source)
+    assert imread(image_path).shape == (12, 16, 3)
+    labels = imread(segmap_path)
+    assert labels.dtype == np.uint16
+    codes = segcodes.decode_object_codes(imread(source))
+    assert np.array_equal(labels, resizing.resize_labels(codes, (12, 16)))
+    assert set(np.unique(labels)) <= set(np.unique(codes))
+  assert reports[-1] == (len(sources), len(sources), len(sources), 0)
+
+  # nothing changed, so the second run reads the sidecars only
+  funcs.materialize_resized(PHRASES, size=(12, 16), progress=progress)
+  assert reports[-1] == (len(sources), len(sources), 0, len(sources))
+
+def test_tiles_cover_the_image(dataset):
+  tile, stride = (16, 16), (8, 16)
+  image_paths, segmap_paths, folder_paths = funcs.materialize_resized(
+    PHRASES, tile=tile, stride=stride, max_workers=1, progress=None)
+  boxes = resizing.tile_boxes(SIZE, tile, stride)
+  assert boxes == [(0, 0), (0, 16), (8, 0), (8, 16)]
+  sources = _sources(PHRASES)
+  assert len(segmap_paths) == len(boxes) * len(sources)
+
+  for i, source in enumerate(sources):
+    codes = segcodes.decode_object_codes(imread(source))
+    for j, (top, left) in enumerate(boxes):
+      (segmap_path,) = segmap_paths[i * len(boxes) + j]
+      assert _name(segmap_path) == _name(source) + '_t' + str(j)
+      assert np.array_equal(imread(segmap_path), codes[top:top + 16, left:left + 16])
+
+def test_whitelisted_outputs_follow_a_rebuilt_index(dataset, fields):
+  whitelist = ['object0', 'object1']
+  old_paths = funcs.materialize_resized(PHRASES, size=(12, 16), whitelist=whitelist,
+                                        progress=None)[1]
+
+  # the rebuilt index swaps the names of the first two objects
+  swapped = dict(fields)
+  names = fields['objectnames'].copy()
+  names[0, 0], names[0, 1] = fields['objectnames'][0, 1], fields['objectnames'][0, 0]
+  swapped['objectnames'] = names
+  synthetic._write_fields(dataset, swapped)
+  funcs.refresh_csv_tables()
+
+  new_paths = funcs.materialize_resized(PHRASES, size=(12, 16), whitelist=whitelist,
+                                        progress=None)[1]
+  assert os.path.dirname(new_paths[0][0]) != os.path.dirname(old_paths[0][0])
+  ade_index = funcs.get_index()
+  lut = segcodes.build_label_lut([ade_index.columns_matching(word) for word in whitelist])
+  relabelled = 0
+  for (segmap_path,), source in zip(new_paths, _sources(PHRASES)):
+    codes = resizing.resize_labels(segcodes.decode_object_codes(imread(source)), (12, 16))
+    expected = segcodes.apply_label_lut(codes, lut)
+    assert np.array_equal(imread(segmap_path), expected)
+    # pixels of the first object are labelled as 'object1' now
+    relabelled += np.count_nonzero(expected[codes == 1] == 2)
+  assert relabelled > 0
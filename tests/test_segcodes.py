@@ -0,0 +1,68 @@
+import numpy as np
+from skimage.io import imread
+from lemonade20k import funcs, segcodes
+
+'''
+Whitelist knockout through a lookup table, checked against masking the
+segmap once per object code
+'''
+
+# The pre-LUT knockout: one full-image mask per code, earlier labels first
+def _knockout_per_code(codes, columns_per_label):
+  labels = np.zeros(codes.shape, dtype=np.int64)
+  for label, columns in enumerate(columns_per_label, 1):
+    for column in columns:
+      labels[(codes == column + 1) & (labels == 0)] = label
+  return labels
+
+def _encode(codes):
+  segmap = np.zeros(codes.shape + (3,), dtype=np.uint8)
+  segmap[:, :, 0] = (codes // 256) * 10
+  segmap[:, :, 1] = codes % 256
+  return segmap
+
+def test_decode_object_codes():
+  codes = np.random.default_rng(0).integers(0, segcodes.MAX_OBJECT_CODE + 1, size=(16, 16))
+  decoded = segcodes.decode_object_codes(_encode(codes))
+  assert decoded.dtype == np.uint16
+  assert np.array_equal(decoded, codes)
+
+def test_lut_matches_per_code_masking():
+  rng = np.random.default_rng(1)
+  codes = rng.integers(0, 3200, size=(40, 50))
+  # overlapping labels: a column listed twice keeps its first label
+  columns_per_label = [rng.choice(3200, size=20, replace=False) for label in range(6)]
+  columns_per_label.append(columns_per_label[0][:5])
+  columns_per_label.append([])
+
+  lut = segcodes.build_label_lut(columns_per_label)
+  assert lut.dtype == np.uint8
+  assert np.array_equal(segcodes.apply_label_lut(codes, lut),
+                        _knockout_per_code(codes, columns_per_label))
+
+def test_lut_uses_uint16_for_many_labels():
+  columns_per_label = [[column] for column in range(300)]
+  codes = np.arange(302).reshape(2, 151)
+
+  lut = segcodes.build_label_lut(columns_per_label)
+  assert lut.dtype == np.uint16
+  assert np.array_equal(segcodes.apply_label_lut(codes, lut),
+                        _knockout_per_code(codes, columns_per_label))
+
+def test_knockout_segmap_matches_per_code_masking(dataset):
+  image_paths, segmap_paths, folder_paths = funcs.get_filepaths([('object0', 1)])
+  whitelist = ['object0', 'object2', 'object1']
+  ade_index = funcs.get_index()
+  columns_per_label = [ade_index.columns_matching(word) for word in whitelist]
+
+  checked = 0
+  for segmap_paths_of_image, folder_path in zip(segmap_paths, folder_paths):
+    if not segmap_paths_of_image:
+      continue
+    new_segmap_path, new_folder_path = funcs._knockout_segmap(
+      segmap_paths_of_image[0], folder_path, whitelist)
+    codes = segcodes.decode_object_codes(imread(segmap_paths_of_image[0]))
+    assert np.array_equal(imread(new_segmap_path),
+                          _knockout_per_code(codes, columns_per_label))
+    checked += 1
+  assert checked > 0
@@ -0,0 +1,88 @@
+import io
+import os
+import numpy as np
+from skimage.io import imread
+from lemonade20k import funcs, shards
+
+'''
+Subsets exported as tar shards: the members of every sample, their metadata,
+the size bound of the shards and index.json
+'''
+
+PHRASES = [('object0', 1)]
+
+def _filepaths():
+  image_paths, segmap_paths, folder_paths = funcs.get_filepaths(PHRASES)
+  # only the first images of the dataset have files, and they come first
+  count = sum(1 for paths in segmap_paths if paths)
+  return image_paths[:count], segmap_paths[:count], folder_paths[:count]
+
+def _read(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+def test_exported_samples(dataset, fields):
+  whitelist = ['object0', 'object1']
+  out_dir = os.path.join(dataset, 'shards')
+  image_paths, segmap_paths, folder_paths = funcs.get_filepaths(PHRASES, whitelist=whitelist)[:3]
+  sample_bytes = [os.path.getsize(image_path) + os.path.getsize(paths[0])
+                  for image_path, paths in zip(image_paths, segmap_paths)]
+  assert segmap_paths[0][0].startswith(os.path.join(dataset, funcs._whitelist_root(whitelist)))
+  max_bytes = 3 * max(sample_bytes)
+  index = funcs.export_shards(PHRASES, out_dir, whitelist=whitelist, max_bytes=max_bytes,
+                              max_workers=2, progress=None)
+
+  assert index == shards.read_index(out_dir)
+  assert index['num_samples'] == len(image_paths)
+  assert len(index['shards']) > 1
+  assert sorted(os.listdir(out_dir)) == sorted([shard['name'] for shard in index['shards']]
+                                              + [shards.INDEX_FILENAME])
+
+  filenames = [str(name) for name in fields['filename'][0]]
+  names = [str(name) for name in fields['objectnames'][0]]
+  i = 0
+  for shard in index['shards']:
+    samples = list(shards.iter_shard(os.path.join(out_dir, shard['name'])))
+    assert [key for key, sample in samples] == shard['keys']
+    assert len(samples) == shard['num_samples']
+    assert shard['bytes'] == os.path.getsize(os.path.join(out_dir, shard['name']))
+    assert sum(sample_bytes[i:i + len(samples)]) <= max_bytes
+
+    for key, sample in samples:
+      assert sorted(sample) == ['jpg', 'json', 'seg.png']
+      assert sample['jpg'] == _read(image_paths[i])
+      # the whitelisted segmap, not the source one
+      assert np.array_equal(imread(io.BytesIO(sample['seg.png'])), imread(segmap_paths[i][0]))
+
+      metadata = sample['json']
+      row = filenames.index(metadata['filename'])
+      assert metadata['filename'] == key + '.jpg' == os.path.basename(image_paths[i])
+      assert metadata['folder'] == folder_paths[i] == str(fields['folder'][0, row])
+      assert metadata['scene'] == str(fields['scene'][0, row])
+      assert metadata['typeset'] == fields['typeset'][row, 0]
+      counts = fields['objectPresence'][:, row]
+      assert metadata['objects'] == {names[col]: int(counts[col])
+                                     for col in np.flatnonzero(counts)}
+      i += 1
+  assert i == len(image_paths)
+
+def test_shard_limits_and_shuffling(dataset):
+  source = _filepaths()
+  count = len(source[0])
+  out_dir = os.path.join(dataset, 'shards')
+
+  index = shards.write_shards(source, out_dir, max_samples=3, progress=None)
+  assert [shard['num_samples'] for shard in index['shards']]\
+         == [3] * (count // 3) + ([count % 3] if count % 3 else [])
+  keys = [key for shard in index['shards'] for key in shard['keys']]
+  assert keys == [shards._sample_key(path) for path in source[0]]
+
+  # a sample larger than max_bytes gets a shard of its own
+  assert len(shards.write_shards(source, out_dir, max_bytes=1, progress=None)['shards']) == count
+
+  shuffled = [shards.write_shards(source, os.path.join(dataset, 'shuffled' + str(seed)),
+                                  shuffle=True, seed=seed, progress=None)
+              for seed in (0, 0, 1)]
+  orders = [[key for shard in index['shards'] for key in shard['keys']] for index in shuffled]
+  assert orders[0] == orders[1] != orders[2]
+  assert orders[0] != keys and sorted(orders[0]) == sorted(keys)
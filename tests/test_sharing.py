@@ -0,0 +1,62 @@
+import json
+import multiprocessing
+import os
+import numpy as np
+from lemonade20k import funcs, sharing
+from lemonade20k.query import Has, Scene
+
+'''
+An index published in shared memory: the arrays attached processes see, and
+the answers they give to queries
+'''
+
+QUERIES = [Has('object0'), Has('object1', 2) & ~Scene('abbey'), Has(['object2', 'object3'])]
+
+def _answers():
+  ade_index = funcs.get_index()
+  return ([query.rows(ade_index).tolist() for query in QUERIES],
+          funcs.get_filepaths([('object0', 1)]))
+
+def _attached_answers(handle):
+  loaded = funcs._index is not None
+  funcs.attach_shared_index(handle)
+  return loaded, _answers()
+
+def test_attached_index_matches_the_published_one(dataset):
+  directory = os.path.join(dataset, 'shm')
+  os.makedirs(directory)
+  expected = _answers()
+  ade_index = funcs.get_index()
+  handle = funcs.share_index(directory)
+  try:
+    with open(handle.layout_path) as f:
+      layout = json.load(f)['layout']
+    # the synthetic dataset has no parts segmaps: empty arrays are shared too
+    assert any(0 in entry['shape'] for entry in layout)
+    end = max(entry['offset'] + np.dtype(entry['dtype']).itemsize
+              * int(np.prod(entry['shape'])) for entry in layout)
+    size = os.path.getsize(handle.data_path)
+    assert size % sharing._ALIGNMENT == 0 and end <= size < end + sharing._ALIGNMENT
+
+    attached = sharing.attach(handle.name, directory)
+    assert attached.build_id == ade_index.build_id
+    presence = attached.object_presence
+    assert np.array_equal(presence.toarray(), ade_index.object_presence.toarray())
+    # views of the shared file, not copies
+    assert not presence.data.flags.owndata and not presence.data.flags.writeable
+    assert attached.column_values('filename').tolist()\
+           == ade_index.column_values('filename').tolist()
+    rows = range(ade_index.num_images_total)
+    assert attached.path_manifest.segmap_paths(rows, withParts=True)\
+           == ade_index.path_manifest.segmap_paths(rows, withParts=True)
+
+    # worker processes attach instead of loading the index
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(2) as pool:
+      results = pool.map(_attached_answers, [handle] * 2)
+    for loaded, answers in results:
+      assert not loaded
+      assert answers == expected
+  finally:
+    sharing.release(handle)
+  assert os.listdir(directory) == []
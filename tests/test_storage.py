@@ -0,0 +1,114 @@
+import asyncio
+import os
+import shutil
+import numpy as np
+import pytest
+from skimage.io import imread
+from lemonade20k import funcs, storage
+from .conftest import NUM_FILES
+
+'''
+Files read through storage backends: a dataset served over HTTP, a mirror
+directory, and the retries of AsyncFetcher
+'''
+
+def _move_images(dataset):
+  # the images and segmaps only exist on the "remote" side
+  remote = os.path.join(dataset, 'remote')
+  os.makedirs(os.path.join(remote, 'ADE20K_2016_07_26'))
+  shutil.move(os.path.join(dataset, 'ADE20K_2016_07_26', 'images'),
+              os.path.join(remote, 'ADE20K_2016_07_26', 'images'))
+  return remote
+
+def _remote_path(remote, dataset, path):
+  return os.path.join(remote, os.path.relpath(path, dataset))
+
+def _files_on_disk(fields, phrase_column):
+  rows = np.flatnonzero(fields['objectPresence'][phrase_column])
+  return int(np.count_nonzero(rows < NUM_FILES))
+
+@pytest.mark.parametrize('served', [True, False])
+def test_subsets_read_through_storage(dataset, fields, served):
+  remote = _move_images(dataset)
+  if served:
+    server, url = storage.serve(remote)
+  try:
+    subset = funcs.get_images([('object0', 1)], prefetch=3,
+                              storage=url if served else remote, concurrency=4)
+    count = _files_on_disk(fields, 0)
+    assert 0 < count < len(subset)
+    # segmap names are derived, since the folders are not there locally
+    assert all(len(paths) == 1 for paths in subset.segmap_paths)
+
+    entries = list(subset[:count])
+    for i, (image, segmap) in enumerate(entries):
+      assert np.array_equal(image, imread(_remote_path(remote, dataset, subset.img_paths[i])))
+      assert np.array_equal(segmap, imread(_remote_path(remote, dataset,
+                                                        subset.segmap_paths[i][0])))
+    assert [entry[0].shape for entry in subset.fetch([count - 1, 0])]\
+           == [entries[-1][0].shape, entries[0][0].shape]
+    with pytest.raises(FileNotFoundError):
+      subset[count]
+  finally:
+    funcs.close_storage()
+    if served:
+      server.shutdown()
+
+def test_http_connections_are_reused(dataset):
+  server, url = storage.serve(dataset)
+  backend = storage.HTTPStorage(url + 'ADE20K_2016_07_26/', dataset_root=os.path.join(
+    dataset, 'ADE20K_2016_07_26'))
+  connections = []
+  new_connection = backend._new_connection
+  backend._new_connection = lambda: connections.append(1) or new_connection()
+  fetcher = storage.AsyncFetcher(backend, concurrency=2)
+  try:
+    path = os.path.join(dataset, 'ADE20K_2016_07_26', 'index_ade20k.mat')
+    with open(path, 'rb') as f:
+      contents = f.read()
+    assert fetcher.fetch_all([path] * 10) == [contents] * 10
+    assert 1 <= len(connections) <= 2
+    with pytest.raises(FileNotFoundError):
+      fetcher.fetch_all([path + '.missing'])
+  finally:
+    fetcher.close()
+    server.shutdown()
+  with pytest.raises(ValueError):
+    storage.HTTPStorage('ftp://example.com/')
+
+class _FlakyBackend:
+  def __init__(self, failures, error=storage.StorageError):
+    self.failures = failures
+    self.error = error
+    self.reads = []
+
+  def read(self, path):
+    self.reads.append(path)
+    if len(self.reads) <= self.failures:
+      raise self.error(path)
+    return path.encode()
+
+  def close(self):
+    pass
+
+def test_fetcher_retries():
+  backend = _FlakyBackend(2)
+  fetcher = storage.AsyncFetcher(backend, retries=2, backoff=0)
+  assert fetcher.fetch_all(['a']) == [b'a']
+  assert backend.reads == ['a'] * 3
+
+  backend = _FlakyBackend(3)
+  with pytest.raises(storage.StorageError):
+    storage.AsyncFetcher(backend, retries=2, backoff=0).fetch_all(['a'])
+  assert len(backend.reads) == 3
+
+  # missing files are not retried
+  backend = _FlakyBackend(1, FileNotFoundError)
+  with pytest.raises(FileNotFoundError):
+    storage.AsyncFetcher(backend, retries=2, backoff=0).fetch_all(['a'])
+  assert len(backend.reads) == 1
+
+  # from a running event loop, too
+  async def fetch():
+    return storage.AsyncFetcher(_FlakyBackend(0)).fetch_all(['a', 'b'])
+  assert asyncio.run(fetch()) == [b'a', b'b']
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from skimage.io import imread
+from lemonade20k import ADESubset as subset_class
+from lemonade20k import batchio, funcs
+
+'''
+Lazy ADESubsets: what is decoded and when, the bounded LRU of decoded
+entries, prefetching iteration and subsets built from filenames
+'''
+
+PHRASES = [('object0', 1)]
+
+@pytest.fixture
+def reads(monkeypatch):
+  paths = []
+  imread = batchio.imread
+  monkeypatch.setattr(batchio, 'imread', lambda path: paths.append(path) or imread(path))
+  return paths
+
+# only the first images of the dataset have files, and they come first
+def _subset(**kwargs):
+  subset = funcs.get_images(PHRASES, **kwargs)
+  return subset[:sum(1 for paths in subset.segmap_paths if paths)]
+
+def _assert_entry(subset, i, entry):
+  image, segmap = entry
+  assert np.array_equal(image, imread(subset.img_paths[i]))
+  assert np.array_equal(segmap, imread(subset.segmap_paths[i][0]))
+
+def test_entries_are_decoded_on_access(dataset, reads):
+  subset = _subset(cache_size=2)
+  assert len(subset) > 3
+  assert reads == []
+
+  _assert_entry(subset, 1, subset[1])
+  assert reads == [subset.img_paths[1], subset.segmap_paths[1][0]]
+  assert np.array_equal(subset.segmaps[1], imread(subset.segmap_paths[1][0]))
+  assert np.array_equal(subset.imgs[-1], imread(subset.img_paths[-1]))
+  assert len(reads) == 4
+
+  # entries 1 and -1 fill the LRU: the next one evicts entry 1
+  subset[2]
+  assert list(subset._cache) == [len(subset) - 1, 2]
+  subset[1]
+  assert len(reads) == 8
+  with pytest.raises(IndexError):
+    subset[len(subset)]
+
+def test_prefetching_iteration(dataset, reads):
+  subset = _subset(cache_size=3, prefetch=2)
+  entries = list(subset)
+  assert len(entries) == len(subset)
+  for i, entry in enumerate(entries):
+    _assert_entry(subset, i, entry)
+  # every entry was decoded once, and only the last ones are kept
+  assert sorted(reads) == sorted(subset.img_paths + [paths[0] for paths in subset.segmap_paths])
+  assert len(subset._cache) == 3
+
+  tail = subset[2:]
+  assert len(tail) == len(subset) - 2 and tail.prefetch == 2
+  assert len(tail.imgs) == len(tail)
+  for i, image in enumerate(tail.imgs):
+    assert np.array_equal(image, imread(subset.img_paths[i + 2]))
+
+def test_from_filename(dataset):
+  ade_index = funcs.get_index()
+  filenames = ade_index.column_values('filename').tolist()
+  names = [filenames[5], filenames[0]]
+  subset = subset_class.ADESubset.from_filename(names, cache_size=1)
+  assert subset.cache_size == 1
+  assert [path.split('/')[-1] for path in subset.img_paths] == names
+  assert subset.img_paths == funcs._filepaths(ade_index, [5, 0], None, False)[0]
+  for i in range(len(subset)):
+    assert np.array_equal(subset.imgs[i], imread(subset.img_paths[i]))
+
+  assert len(subset_class.ADESubset.from_filename(filenames[3])) == 1
+  with pytest.raises(ValueError, match='missing.jpg'):
+    subset_class.ADESubset.from_filename([filenames[0], 'missing.jpg'])
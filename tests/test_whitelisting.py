@@ -0,0 +1,149 @@
+import os
+import threading
+import numpy as np
+from skimage.io import imread
+from benchmarks import synthetic
+from lemonade20k import batchio, funcs, segcodes, whitelisting
+from .conftest import NUM_FILES
+
+'''
+Whitelisted segmaps written in batches: their pixel values, the cache folder
+they are written to, and the temporary files they are written through
+'''
+
+WHITELIST = ['object0', 'object2', 'object1']
+
+def _expected_labels(segmap_path, whitelist):
+  ade_index = funcs.get_index()
+  codes = segcodes.decode_object_codes(imread(segmap_path))
+  labels = np.zeros(codes.shape, dtype=np.int64)
+  for label, word in enumerate(whitelist, 1):
+    for column in ade_index.columns_matching(word):
+      labels[(codes == column + 1) & (labels == 0)] = label
+  return labels
+
+def _source_segmaps(phrases):
+  image_paths, segmap_paths, folder_paths = funcs.get_filepaths(phrases)
+  return [paths[0] for paths in segmap_paths if paths]
+
+def test_materialize_whitelist_pixels(dataset):
+  reports = []
+  progress = lambda *report: reports.append(report)
+  phrases = [('object0', 1)]
+  sources = _source_segmaps(phrases)
+  assert sources
+
+  new_segmap_paths, folder_paths = funcs.materialize_whitelist(
+    phrases, WHITELIST, max_workers=2, chunksize=2, progress=progress)
+  assert len(new_segmap_paths) == len(sources)
+  for source, output in zip(sources, new_segmap_paths):
+    assert output.startswith(os.path.join(dataset, funcs._whitelist_root(WHITELIST)))
+    assert os.path.basename(output) == os.path.basename(source)
+    assert np.array_equal(imread(output), _expected_labels(source, WHITELIST))
+  assert reports[-1] == (len(sources), len(sources), len(sources), 0)
+
+  # a second run only checks the outputs, and get_filepaths() agrees
+  funcs.materialize_whitelist(phrases, WHITELIST, max_workers=1, progress=progress)
+  assert reports[-1] == (len(sources), len(sources), 0, len(sources))
+  segmap_paths = funcs.get_filepaths(phrases, whitelist=WHITELIST)[1]
+  assert [paths[0] for paths in segmap_paths if paths] == new_segmap_paths
+
+def test_whitelisted_segmaps_follow_a_rebuilt_index(dataset, fields):
+  phrases = [('object0', 1)]
+  old_paths = funcs.materialize_whitelist(phrases, WHITELIST, progress=None)[0]
+
+  # the rebuilt index swaps the names of the first two objects: the same
+  # words now knock out other object codes
+  swapped = dict(fields)
+  names = fields['objectnames'].copy()
+  names[0, 0], names[0, 1] = fields['objectnames'][0, 1], fields['objectnames'][0, 0]
+  swapped['objectnames'] = names
+  synthetic._write_fields(dataset, swapped)
+  funcs.refresh_csv_tables()
+
+  new_paths = funcs.materialize_whitelist(phrases, WHITELIST, progress=None)[0]
+  assert os.path.dirname(new_paths[0]) != os.path.dirname(old_paths[0])
+  sources = _source_segmaps(phrases)
+  assert len(new_paths) == len(sources)
+  relabelled = 0
+  for source, output in zip(sources, new_paths):
+    expected = _expected_labels(source, WHITELIST)
+    assert np.array_equal(imread(output), expected)
+    # pixels of the second object are labelled as 'object0' now
+    codes = segcodes.decode_object_codes(imread(source))
+    relabelled += np.count_nonzero(expected[codes == 2] == 1)
+  assert relabelled > 0
+
+def test_atomic_write_from_many_threads(tmp_path):
+  path = str(tmp_path / 'labels.npy')
+  errors = []
+
+  def write(value):
+    try:
+      for attempt in range(50):
+        batchio.atomic_write(path, lambda tmp_path: np.save(tmp_path, np.full(1000, value)))
+    except Exception as e:
+      errors.append(e)
+
+  threads = [threading.Thread(target=write, args=(value,)) for value in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert errors == []
+  assert os.listdir(str(tmp_path)) == ['labels.npy']
+  assert len(set(np.load(path).tolist())) == 1
+
+def _disk_bytes(root):
+  return sum(os.path.getsize(os.path.join(dirpath, name))
+             for dirpath, dirnames, names in os.walk(root) for name in names
+             if name != 'whitelist.json')
+
+def _folder(whitelist):
+  return os.path.join(funcs._segmap_cache.root, os.path.basename(funcs._whitelist_root(whitelist)))
+
+def test_cache_evicts_least_recently_used_segmaps(dataset, monkeypatch):
+  cache = funcs._segmap_cache
+  walks = []
+  entries = cache._entries
+  monkeypatch.setattr(cache, '_entries', lambda: walks.append(1) or entries())
+  assert cache.bytes == 0
+
+  first = funcs.materialize_whitelist([('object0', 1)], ['object0'], progress=None)[0]
+  second = funcs.materialize_whitelist([('object1', 1)], ['object1'], progress=None)[0]
+  size = _disk_bytes(cache.root)
+  assert cache.bytes == size
+  assert walks == [1]
+
+  # room for the second whitelist only: the first one is evicted
+  funcs.set_cache_limit(_disk_bytes(_folder(['object1'])))
+  assert all(os.path.exists(path) for path in second)
+  assert not any(os.path.exists(path) for path in first)
+  assert cache.bytes == _disk_bytes(cache.root) <= cache.max_bytes
+  assert cache.evictions == len(first)
+
+  # using the first whitelist again evicts the second one, but never the
+  # segmaps the call returns, even when they alone exceed the limit
+  funcs.set_cache_limit(1)
+  first = funcs.materialize_whitelist([('object0', 1)], ['object0'], progress=None)[0]
+  assert all(os.path.exists(path) for path in first)
+  assert not any(os.path.exists(path) for path in second)
+  assert cache.bytes == _disk_bytes(cache.root)
+  stats = funcs.cache_stats()
+  assert (stats['hits'], stats['misses']) == (0, 2 * len(first) + len(second))
+  # the segmaps were listed once, when the cache was first used
+  assert walks == [1]
+
+def test_cache_order_survives_a_restart(dataset):
+  first = funcs.materialize_whitelist([('object0', 1)], ['object0'], progress=None)[0]
+  second = funcs.materialize_whitelist([('object1', 1)], ['object1'], progress=None)[0]
+  # mtimes are coarse: the segmaps written so far are made a minute older,
+  # then a hit makes the first whitelist the most recently used one
+  for path in first + second:
+    os.utime(path, (os.path.getmtime(path) - 60,) * 2)
+  funcs.materialize_whitelist([('object0', 1)], ['object0'], progress=None)
+  funcs._segmap_cache = whitelisting.SegmapCache(funcs._segmap_cache.root)
+
+  funcs.set_cache_limit(_disk_bytes(_folder(['object0'])))
+  assert all(os.path.exists(path) for path in first)
+  assert not any(os.path.exists(path) for path in second)